@@ -0,0 +1,104 @@
+"""Compares per-row image HDU reads with contiguous-run and full HDU reads
+on synthetic healpix coadd files.
+
+Usage::
+
+    python benchmarks/read_imagehdu.py --nrows 2000 --nwave 2751
+"""
+import argparse
+import tempfile
+import time
+
+import fitsio
+import numpy as np
+
+import qsonic.io
+
+
+def read_per_row(imhdu, quasar_indices):
+    """Reads one row per call as before."""
+    dims = imhdu.get_dims()
+    data = np.empty((quasar_indices.size, *dims[1:]),
+                    dtype=imhdu._get_image_numpy_dtype())
+    for idata, iqso in enumerate(quasar_indices):
+        if len(dims) == 3:
+            data[idata] = imhdu[int(iqso), :, :]
+        else:
+            data[idata] = imhdu[int(iqso), :]
+
+    return data
+
+
+def read_runs(imhdu, quasar_indices):
+    """Reads contiguous runs without the full HDU read shortcut."""
+    frac = qsonic.io._FULL_READ_FRACTION
+    qsonic.io._FULL_READ_FRACTION = 1.1
+    try:
+        return qsonic.io._read_imagehdu(imhdu, quasar_indices)
+    finally:
+        qsonic.io._FULL_READ_FRACTION = frac
+
+
+def read_full(imhdu, quasar_indices):
+    """Reads the entire HDU and selects rows."""
+    return imhdu.read()[quasar_indices]
+
+
+def write_synthetic_file(fname, nrows, nwave, ndiags, seed=0):
+    rng = np.random.default_rng(seed)
+    with fitsio.FITS(fname, 'rw', clobber=True) as fts:
+        fts.write(rng.random((nrows, nwave), dtype='f4'), extname="B_FLUX")
+        fts.write(
+            rng.random((nrows, ndiags, nwave), dtype='f4'),
+            extname="B_RESOLUTION")
+
+
+def time_reader(reader, imhdu, quasar_indices, nrepeat):
+    times = []
+    for _ in range(nrepeat):
+        t1 = time.perf_counter()
+        reader(imhdu, quasar_indices)
+        times.append(time.perf_counter() - t1)
+
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--nrows", type=int, default=2000)
+    parser.add_argument("--nwave", type=int, default=2751)
+    parser.add_argument("--ndiags", type=int, default=11)
+    parser.add_argument(
+        "--fractions", type=float, nargs='+', default=[0.05, 0.25, 0.5, 0.9],
+        help="Fractions of rows selected.")
+    parser.add_argument("--nrepeat", type=int, default=3)
+    args = parser.parse_args()
+
+    readers = {
+        "per-row": read_per_row, "runs": read_runs, "full": read_full,
+        "_read_imagehdu": qsonic.io._read_imagehdu}
+    rng = np.random.default_rng(1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = f"{tmpdir}/synthetic.fits"
+        write_synthetic_file(fname, args.nrows, args.nwave, args.ndiags)
+
+        print(f"{'HDU':>12} {'fraction':>8} "
+              + " ".join(f"{key:>14}" for key in readers))
+        with fitsio.FITS(fname) as fts:
+            for hdu in ["B_FLUX", "B_RESOLUTION"]:
+                for frac in args.fractions:
+                    nsel = max(1, int(frac * args.nrows))
+                    quasar_indices = rng.choice(
+                        args.nrows, nsel, replace=False)
+                    times = [
+                        time_reader(reader, fts[hdu], quasar_indices,
+                                    args.nrepeat)
+                        for reader in readers.values()]
+                    print(f"{hdu:>12} {frac:8.2f} "
+                          + " ".join(f"{t:13.4f}s" for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ import numpy as np
 from numpy.lib.recfunctions import rename_fields, append_fields
 
 from qsonic import QsonicException
-from qsonic.mpi_utils import balance_load, mpi_fnc_bcast
+from qsonic.mpi_utils import balance_load, mpi_fnc_bcast, DynamicQueue
 
 _accepted_extnames = set(['QSO_CAT', 'ZCATALOG', 'METADATA'])
 """set: Accepted extensions for quasar catalog."""
@@ -132,10 +132,13 @@ def mpi_read_quasar_catalog(
 
 def mpi_get_local_queue(
         filename, comm=None, mpi_rank=0, mpi_size=1, is_mock=False,
-        is_tile=False, keep_surveys=None, zmin=0, zmax=100.0
+        is_tile=False, keep_surveys=None, zmin=0, zmax=100.0,
+        cost_function=None, dynamic=False
 ):
     """Reads catalog on master and scatter a list of catalogs to every
-    mpi_rank. If in tile format, sort key is 'TILEID'.
+    mpi_rank. If in tile format, sort key is 'TILEID'. If ``dynamic``, all
+    catalogs are broadcast and ranks receive them as they iterate over the
+    returned :class:`qsonic.mpi_utils.DynamicQueue`.
 
     Arguments
     ----------
@@ -158,11 +161,18 @@ def mpi_get_local_queue(
         Minimum quasar redshift
     zmax: float, default: 100
         Maximum quasar redshift
+    cost_function: Callable or None, default: None
+        Estimated cost of a catalog for load balancing, e.g.
+        :class:`qsonic.mpi_utils.LoadCostModel`. None balances the number
+        of spectra.
+    dynamic: bool, default: False
+        Schedule catalogs dynamically.
 
     Returns
     ----------
     local_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
-        List of sorted catalogs.
+        List of sorted catalogs. :class:`qsonic.mpi_utils.DynamicQueue` if
+        ``dynamic``.
     """
     # We decide forest filename list
     # Group into unique pixels
@@ -189,11 +199,25 @@ def mpi_get_local_queue(
         logging.info(
             f"There are {unique_pix.size} keys ({split_key})."
             " Don't use more MPI processes.")
+    else:
+        split_catalog = None
+
+    if dynamic:
+        logging.info("Scheduling dynamically.")
+        split_catalog = comm.bcast(split_catalog)
+        return DynamicQueue(split_catalog, comm, cost_function)
 
-        # Roughly equal number of spectra
+    if mpi_rank == 0:
+        # Roughly equal number of spectra or estimated cost
         logging.info("Load balancing.")
         # Returns a list of catalog (ndarray)
-        local_queue = balance_load(split_catalog, mpi_size)
+        local_queue = balance_load(split_catalog, mpi_size, cost_function)
+        if cost_function is not None:
+            costs = [sum(cost_function(cat) for cat in q)
+                     for q in local_queue]
+            logging.info(
+                "Estimated load imbalance (max / mean cost) is "
+                f"{np.max(costs) / np.mean(costs):.2f}.")
     else:
         local_queue = None
 
@@ -1,9 +1,10 @@
 from .base_continuum_model import BaseContinuumModel
+from .batched_picca_continuum_model import BatchedPiccaContinuumModel
 from .input_continuum_model import InputContinuumModel
 from .picca_continuum_model import PiccaContinuumModel
 from .true_continuum_model import TrueContinuumModel
 
 __all__ = [
     "BaseContinuumModel", "PiccaContinuumModel", "InputContinuumModel",
-    "TrueContinuumModel"
+    "TrueContinuumModel", "BatchedPiccaContinuumModel"
 ]
@@ -4,30 +4,33 @@ class BaseContinuumModel():
     def __init__(self):
         raise NotImplementedError
 
-    def stack_spectra(self, valid_spectra_list, flux_stacker):
+    def stack_spectra(self, batch, flux_stacker, w=None):
         """Stacks spectra in the observed and rest-frame. Observed frame
         stacking is performed over f/C. Rest-frame stacking is performed over C
         only.
 
         Arguments
         ---------
-        valid_spectra_list: list(Spectrum)
-            Valid spectra objects to iterate.
+        batch: SpectraBatch
+            Batch of spectra with continua.
         flux_stacker: FluxStacker
             Flux stacker object.
+        w: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Bool array of pixels to stack. None stacks
+            :meth:`SpectraBatch.get_valid_pixels
+            <qsonic.spectrum.SpectraBatch.get_valid_pixels>`.
         """
-        for spec in valid_spectra_list:
-            for arm, wave_arm in spec.forestwave.items():
-                wave_rf_arm = wave_arm / (1 + spec.z_qso)
+        if w is None:
+            w = batch.get_valid_pixels()
 
-                cont = spec.cont_params['cont'][arm]
-                weight = spec.forestweight[arm] * cont**2
-                weighted_flux = weight * spec.forestflux[arm] / cont
-                weighted_cont = weight * cont
+        cont = batch.cont[w]
+        weight = batch.weight[w] * cont**2
+        weighted_flux = weight * batch.flux[w] / cont
+        weighted_cont = weight * cont
 
-                flux_stacker.add(
-                    wave_arm, wave_rf_arm, weighted_flux, weighted_cont, weight
-                )
+        flux_stacker.add(
+            batch.wave[w], batch.get_wave_rf()[w], weighted_flux,
+            weighted_cont, weight)
 
     def fit_continuum(self, spec):
         """Fits the continuum for a single Spectrum. Should modify
@@ -42,6 +45,19 @@ class BaseContinuumModel():
         """
         raise NotImplementedError
 
+    def fit_continua(self, spectra_list):
+        """Fits the continua for a list of Spectrum objects. Default
+        implementation calls :meth:`fit_continuum` one by one. Models that can
+        fit many spectra simultaneously should override this.
+
+        Arguments
+        ---------
+        spectra_list: list(Spectrum)
+            Spectrum objects to fit.
+        """
+        for spec in spectra_list:
+            self.fit_continuum(spec)
+
     def init_spectra(self, spectra_list):
         """ Initializes
         :attr:`cont_params <qsonic.spectrum.Spectrum.cont_params>` for a list
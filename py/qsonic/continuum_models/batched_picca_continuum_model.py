@@ -0,0 +1,310 @@
+import logging
+import numpy as np
+
+from qsonic.continuum_models.picca_continuum_model import (
+    PiccaContinuumModel, _irls_solve, _pixel_cost_derivatives)
+
+
+class BatchedPiccaContinuumModel(PiccaContinuumModel):
+    """Picca continuum model that fits many spectra simultaneously.
+
+    Forests of ``batch_size`` spectra are concatenated over arms and packed
+    into padded 2D arrays of shape ``(nspec, npix_max)`` by :meth:`_pack`.
+    Spectra are sorted by size to reduce padding. Padded pixels have zero
+    inverse variance, so they do not contribute to the cost. Polynomial
+    coefficients of every spectrum are then found at once by :meth:`_solve`.
+    The ``irls`` minimizer uses the iteratively reweighted least squares of
+    :func:`_irls_solve
+    <qsonic.continuum_models.picca_continuum_model._irls_solve>`. Other
+    minimizers use a vectorized Fisher scoring (Gauss-Newton-like)
+    iteration with the analytic gradient of the modified chi2 in
+    :meth:`_continuum_costfn
+    <qsonic.continuum_models.PiccaContinuumModel._continuum_costfn>` and a
+    step-halving line search. Spectra that do not converge are refit with
+    the single-spectrum ``minimizer``.
+
+    ``xcov`` is the inverse of the Fisher matrix evaluated at the best fit,
+    which is equivalent to the covariance given by iminuit with
+    ``errordef=LEAST_SQUARES``.
+
+    Parameters
+    ----------
+    meancont_interp: FastCubic1DInterp
+        Fast cubic spline object for the mean continuum.
+    meanflux_interp: FastLinear1DInterp
+        Interpolator for mean flux. If fiducial is not set, this equals to 1.
+    varlss_interp: FastLinear1DInterp or FastCubic1DInterp
+        Cubic spline for var_lss if fitting. Linear if from file.
+    eta_interp: FastCubic1DInterp
+        Interpolator for eta. Returns one if fiducial var_lss is set.
+    cont_order: int
+        Order of continuum polynomial from ``args.cont_order``.
+    rfwave0: float
+        First rest-frame wavelength center for the mean continuum.
+    denom: float
+        Denominator for the slope term in the continuum model.
+    minimizer: str
+        ``iminuit``, ``l_bfgs_b``, ``numba`` or ``irls``. Selects the batched
+        solver and the minimizer for spectra that fail to converge.
+    max_cache_mb: float, default: 1024
+        Maximum memory in MB for the per-spectrum model cache.
+    warm_start: bool, default: False
+        Start each fit from the previous valid solution.
+    refit_tol: float, default: 0
+        Skip minimizing spectra whose estimated distance to the new minimum
+        is below this value.
+    validate_irls: bool, default: False
+        Report agreement with iminuit for ``irls`` fits.
+    fit_workers: int, default: 1
+        Number of threads to fit batches. Only used for minimizers in
+        :attr:`_threaded_minimizers
+        <qsonic.continuum_models.PiccaContinuumModel._threaded_minimizers>`,
+        since spectra that do not converge are refit with ``minimizer``
+        while holding the GIL otherwise.
+    batch_size: int, default: 1024
+        Number of spectra to fit simultaneously. Bounds the memory usage.
+    maxiter: int, default: 100
+        Maximum number of iterations of the batched solver.
+    tol: float, default: 1e-6
+        Convergence tolerance on the estimated distance to the minimum.
+
+    Attributes
+    ----------
+    num_fallbacks: int
+        Number of spectra refit by ``minimizer`` in the last
+        :meth:`fit_continua` call.
+    """
+
+    def __init__(
+            self, meancont_interp, meanflux_interp, varlss_interp,
+            eta_interp, cont_order, rfwave0, denom, minimizer,
+            max_cache_mb=1024., warm_start=False, refit_tol=0,
+            validate_irls=False, fit_workers=1, batch_size=1024, maxiter=100,
+            tol=1e-6
+    ):
+        super().__init__(
+            meancont_interp, meanflux_interp, varlss_interp, eta_interp,
+            cont_order, rfwave0, denom, minimizer, max_cache_mb, warm_start,
+            refit_tol, validate_irls, fit_workers)
+        self.batch_size = max(1, batch_size)
+        self.maxiter = maxiter
+        self.tol = tol
+        self.num_fallbacks = 0
+
+    def _pack(self, spectra_list):
+        """Packs the model caches of spectra into padded 2D arrays.
+
+        Arguments
+        ---------
+        spectra_list: list(Spectrum)
+            Spectrum objects to pack.
+
+        Returns
+        -------
+        packed: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            2D arrays of shape ``(nspec, npix_max)`` for keys ``template``
+            (mean continuum times mean flux), ``basis`` (:math:`2x - 1`,
+            where x is the log-slope), ``flux``, ``ivar``, ``varlss`` and
+            ``eta``.
+        """
+        caches = [self.get_model_cache(spec) for spec in spectra_list]
+        nspec = len(caches)
+        sizes = np.array([c['flux'].size for c in caches], dtype=int)
+        npix_max = max(1, sizes.max(initial=0))
+
+        rows = np.repeat(np.arange(nspec), sizes)
+        cols = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes,
+                                                  sizes)
+        packed = {}
+        for key in caches[0].keys():
+            packed[key] = np.zeros((nspec, npix_max))
+            packed[key][rows, cols] = np.concatenate([c[key] for c in caches])
+
+        # Padded pixels need a finite eta to keep weights zero.
+        packed['eta'][packed['ivar'] == 0] = 1
+
+        return packed
+
+    def _get_design(self, packed):
+        """Design tensor of packed spectra such that the continuum is
+        ``design @ x``. Shape is ``(nspec, npix_max, cont_order + 1)``."""
+        powers = np.arange(self.cont_order + 1)
+        return (packed['template'][:, :, None]
+                * packed['basis'][:, :, None]**powers)
+
+    def _batch_cost(self, design, x, packed):
+        cont = np.einsum('npk,nk->np', design, x)
+        cost, dcost, fisher = _pixel_cost_derivatives(
+            cont, packed['flux'], packed['ivar'], packed['varlss'],
+            packed['eta'])
+        return cost.sum(axis=1), dcost, fisher
+
+    @staticmethod
+    def _get_fisher(design, fisher):
+        """Fisher matrices of packed spectra and a bool array for singular
+        ones, which are replaced with identity."""
+        fmat = np.einsum('npk,np,npq->nkq', design, fisher, design)
+        singular = ~(np.linalg.det(fmat) > 0)
+        fmat[singular] = np.eye(fmat.shape[-1])
+        return fmat, singular
+
+    def _fisher_scoring(self, design, packed, x0):
+        """Vectorized Fisher scoring with step-halving line search.
+
+        Arguments
+        ---------
+        design: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Output of :meth:`_get_design`.
+        packed: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Output of :meth:`_pack`.
+        x0: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Initial guesses of shape ``(nspec, cont_order + 1)``.
+
+        Returns
+        -------
+        x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Best-fitting parameters.
+        converged: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Bool array for convergence.
+        """
+        nspec = x0.shape[0]
+        x = x0.copy()
+
+        cost, dcost, fisher = self._batch_cost(design, x, packed)
+        converged = np.zeros(nspec, dtype=bool)
+        failed = np.zeros(nspec, dtype=bool)
+
+        for _ in range(self.maxiter):
+            grad = np.einsum('npk,np->nk', design, dcost)
+            fmat, singular = self._get_fisher(design, fisher)
+            # Fisher matrix is half of the Hessian
+            step = 0.5 * np.linalg.solve(fmat, grad[:, :, None])[:, :, 0]
+            edm = 0.5 * np.sum(grad * step, axis=1)
+
+            failed |= singular | ~np.isfinite(edm)
+            converged = (edm < self.tol) & ~failed
+            active = ~(converged | failed)
+            if not active.any():
+                break
+
+            # Backtracking line search only on active spectra
+            alpha = np.where(active, 1., 0.)
+            for _ in range(30):
+                x_new = x - alpha[:, None] * step
+                cost_new, dcost_new, fisher_new = self._batch_cost(
+                    design, x_new, packed)
+                accept = active & (alpha > 0) & (cost_new <= cost)
+                retry = active & ~accept & (alpha > 0)
+                if not retry.any():
+                    break
+                alpha[retry] /= 2
+                alpha[retry & (alpha < 1e-8)] = 0
+
+            x[accept] = x_new[accept]
+            cost[accept] = cost_new[accept]
+            dcost[accept] = dcost_new[accept]
+            fisher[accept] = fisher_new[accept]
+            # No descent direction found. These are refit one by one.
+            failed |= active & ~accept
+
+        return x, converged
+
+    def _solve(self, packed, x0):
+        """Solves packed spectra with :func:`_irls_solve
+        <qsonic.continuum_models.picca_continuum_model._irls_solve>` if the
+        minimizer is ``irls`` and :meth:`_fisher_scoring` otherwise.
+
+        Arguments
+        ---------
+        packed: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Output of :meth:`_pack`.
+        x0: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Initial guesses of shape ``(nspec, cont_order + 1)``.
+
+        Returns
+        -------
+        x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Best-fitting parameters.
+        xcov: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Inverse Fisher matrices at ``x``.
+        converged: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Bool array for convergence.
+        """
+        design = self._get_design(packed)
+        if self.minimizer == self._irls_minimizer:
+            x, converged = _irls_solve(
+                design, packed['flux'], packed['ivar'], packed['varlss'],
+                packed['eta'], x0, maxiter=self.maxiter, tol=self.tol)
+        else:
+            x, converged = self._fisher_scoring(design, packed, x0)
+
+        # Both solvers must end at a stationary point
+        cost, dcost, fisher = self._batch_cost(design, x, packed)
+        fmat, singular = self._get_fisher(design, fisher)
+        xcov = np.linalg.inv(fmat)
+        grad = np.einsum('npk,np->nk', design, dcost)
+        edm = 0.25 * np.einsum('nk,nkq,nq->n', grad, xcov, grad)
+        converged &= ~singular & np.isfinite(cost) & (edm < self.tol)
+
+        return x, xcov, converged
+
+    def _fit_batch(self, batch):
+        packed = self._pack(batch)
+
+        x0_list = [self._get_x0(spec) for spec in batch]
+        x0 = np.vstack([_[0] for _ in x0_list])
+
+        x, xcov, converged = self._solve(packed, x0)
+        del packed
+
+        for jj, spec in enumerate(batch):
+            if converged[jj]:
+                result = {'valid': True, 'x': x[jj], 'xcov': xcov[jj]}
+                if self.minimizer == self._irls_minimizer:
+                    self._validate_irls(spec, x[jj], *x0_list[jj])
+            else:
+                with self._lock:
+                    self.num_fallbacks += 1
+                result = self.minimizer(spec, *x0_list[jj])
+
+            self._set_continuum_from_result(spec, result)
+
+    def fit_continua(self, spectra_list):
+        """Fits the continua for a list of Spectrum objects in batches of
+        :attr:`batch_size`. Spectra are sorted by size to reduce padding.
+        Batches are distributed over :attr:`fit_workers` threads, so that
+        many batches are in memory at the same time. Spectra that fail to
+        converge are refit with :attr:`minimizer`. Spectra that pass the
+        :attr:`refit_tol` test are not fit. See
+        :meth:`fit_continuum
+        <qsonic.continuum_models.PiccaContinuumModel.fit_continuum>` for the
+        keys modified in ``cont_params``.
+
+        Arguments
+        ---------
+        spectra_list: list(Spectrum)
+            Spectrum objects to fit.
+        """
+        self.num_fallbacks = 0
+        self.num_skipped = 0
+        self.num_irls_fallbacks = 0
+
+        fit_list = []
+        for spec in spectra_list:
+            result = self._get_skipped_fit_result(spec)
+            if result is None:
+                fit_list.append(spec)
+            else:
+                self._set_continuum_from_result(spec, result)
+
+        fit_list.sort(key=lambda spec: sum(
+            wave_arm.size for wave_arm in spec.forestwave.values()))
+        self._map_chunks(self._fit_batch, fit_list, self.batch_size)
+
+        self.log_cache_usage(len(spectra_list))
+        self._log_irls_validation()
+
+        if self.num_fallbacks > 0:
+            logging.debug(
+                f"{self.num_fallbacks} spectra did not converge in batched "
+                "fitting and are refit one by one.")
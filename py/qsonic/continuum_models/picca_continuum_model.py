@@ -1,6 +1,11 @@
 import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from iminuit import Minuit
+from numba import njit
 from scipy.optimize import minimize
 
 from qsonic import QsonicException
@@ -8,6 +13,215 @@ from qsonic.mathtools import mypoly1d
 from qsonic.continuum_models.base_continuum_model import BaseContinuumModel
 
 
+def _pixel_cost_derivatives(cont, flux, ivar, varlss, eta):
+    """Per-pixel modified chi2 and its derivatives with respect to the
+    continuum :math:`C`. Works element-wise on arrays of any shape.
+
+    .. math::
+
+        c &= w (f - C)^2 - \\ln w, \\quad
+        w = i / (\\eta + i \\sigma^2_\\mathrm{LSS} C^2) \\\\
+        \\partial c / \\partial C &= -2 w (f - C)
+        + 2 \\sigma^2_\\mathrm{LSS} C w [1 - w (f - C)^2]
+
+    The Fisher weight is half of the expected second derivative, i.e.
+    :math:`w + 2 (\\sigma^2_\\mathrm{LSS} C w)^2`, which is always
+    non-negative.
+
+    Arguments
+    ---------
+    cont: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Continuum (including mean flux).
+    flux: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Flux.
+    ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Smooth inverse variance.
+    varlss: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        var_lss on deltas (not multiplied by the continuum).
+    eta: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        eta values.
+
+    Returns
+    -------
+    cost: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Cost of each pixel.
+    dcost: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        First derivative of cost with respect to the continuum.
+    fisher: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Fisher weight of each pixel.
+    """
+    weight = ivar / (eta + ivar * varlss * cont**2)
+    resid = flux - cont
+    wr2 = weight * resid**2
+    scw = varlss * cont * weight
+
+    cost = wr2 - np.log(weight, out=np.zeros_like(weight), where=weight > 0)
+    dcost = -2 * weight * resid + 2 * scw * (1 - wr2)
+    fisher = weight + 2 * scw**2
+
+    return cost, dcost, fisher
+
+
+@njit("f8(f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:], f8[:])",
+      nogil=True)
+def _fused_continuum_cost(x, template, basis, flux, ivar, varlss, eta, grad):
+    """JIT modified chi2 and its gradient in a single pass without
+    temporary arrays. Arrays are the concatenated arms as given by
+    :meth:`PiccaContinuumModel.get_model_cache`. Gradient is computed and
+    written into ``grad`` only if its size matches ``x``. Pass an empty
+    array to compute only the cost."""
+    ncoef = x.size
+    do_grad = grad.size == ncoef
+    if do_grad:
+        grad[:] = 0
+
+    cost = 0.
+    for i in range(flux.size):
+        # Zero weight pixels contribute nothing to cost and gradient.
+        if ivar[i] == 0:
+            continue
+
+        poly = 0.
+        for j in range(ncoef - 1, -1, -1):
+            poly = poly * basis[i] + x[j]
+
+        cont = template[i] * poly
+        weight = ivar[i] / (eta[i] + ivar[i] * varlss[i] * cont * cont)
+        resid = flux[i] - cont
+        wr2 = weight * resid * resid
+
+        cost += wr2
+        if weight > 0:
+            cost -= np.log(weight)
+
+        if do_grad:
+            dcost = template[i] * (
+                -2 * weight * resid
+                + 2 * varlss[i] * cont * weight * (1 - wr2))
+            t = 1.
+            for j in range(ncoef):
+                grad[j] += dcost * t
+                t *= basis[i]
+
+    return cost
+
+
+def _replace_not_positive_definite(mat):
+    """Replaces matrices that are not finite or not positive definite with
+    identity in place, so that the rest can be solved at once. Matrices are
+    symmetric with any number of leading dimensions.
+
+    Arguments
+    ---------
+    mat: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Symmetric matrices of shape ``(..., n, n)``.
+
+    Returns
+    -------
+    replaced: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Bool array for replaced matrices.
+    """
+    eye = np.eye(mat.shape[-1])
+    replaced = ~np.all(np.isfinite(mat), axis=(-2, -1))
+    mat[replaced] = eye
+    evals = np.linalg.eigvalsh(mat)
+    replaced |= ~(evals[..., 0] > np.finfo(mat.dtype).eps * evals[..., -1])
+    mat[replaced] = eye
+
+    return replaced
+
+
+def _irls_solve(design, flux, ivar, varlss, eta, x0, maxiter=20, tol=1e-6):
+    """Iteratively reweighted linear least squares. The continuum is linear
+    in ``x`` when the weights are held fixed, so each iteration solves the
+    normal equations with weights evaluated at the previous solution.
+    Arrays can have any number of leading dimensions to solve many spectra
+    simultaneously.
+
+    The stationarity condition of the modified chi2 including the
+    :math:`-\\ln w` term is
+
+    .. math::
+
+        \\sum_p A_{pj} w_p [f_p - g_p C_p] = 0, \\quad
+        g = 1 + \\sigma^2_\\mathrm{LSS} [1 - w (f - C)^2],
+
+    so both :math:`w` and :math:`g` are reweighted and the fixed point is
+    the exact minimum of :meth:`PiccaContinuumModel._continuum_costfn`.
+    :math:`g` is negative for large residuals, so the normal equations can
+    be indefinite far from the minimum. Convergence is therefore tested
+    with the estimated distance to the minimum
+    :math:`d^T F^{-1} d / 4` from the analytic gradient :math:`d` and the
+    positive definite Fisher matrix :math:`F` (see
+    :func:`_pixel_cost_derivatives`), the same as the EDM of iminuit.
+
+    Arguments
+    ---------
+    design: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Design matrix of shape ``(..., npix, ncoef)``.
+    flux: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Flux of shape ``(..., npix)``.
+    ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Smooth inverse variance.
+    varlss: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        var_lss on deltas (not multiplied by the continuum).
+    eta: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        eta values.
+    x0: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Initial parameters of shape ``(..., ncoef)``.
+    maxiter: int, default: 20
+        Maximum number of iterations.
+    tol: float, default: 1e-6
+        Convergence is reached when the estimated distance to the minimum is
+        below this value.
+
+    Returns
+    -------
+    x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Solution.
+    converged: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Bool array for convergence. Spectra with singular or indefinite
+        normal equations, e.g. fully masked forests or large outliers, are
+        not converged and keep their last solution. Other spectra are not
+        affected.
+    """
+    x = x0.copy()
+    converged = np.zeros(x.shape[:-1], dtype=bool)
+    failed = np.zeros(x.shape[:-1], dtype=bool)
+
+    for it in range(maxiter + 1):
+        cont = np.einsum('...pk,...k->...p', design, x)
+        _, dcost, fisher = _pixel_cost_derivatives(
+            cont, flux, ivar, varlss, eta)
+        grad = np.einsum('...pk,...p->...k', design, dcost)
+        fmat = np.einsum('...pk,...p,...pq->...kq', design, fisher, design)
+        failed |= _replace_not_positive_definite(fmat)
+        edm = 0.25 * np.einsum(
+            '...k,...k->...', grad,
+            np.linalg.solve(fmat, grad[..., np.newaxis])[..., 0])
+
+        failed |= ~np.isfinite(edm)
+        converged = ~failed & (edm < tol)
+        if it == maxiter or np.all(converged | failed):
+            break
+
+        weight = ivar / (eta + ivar * varlss * cont**2)
+        gfactor = 1 + varlss * (1 - weight * (flux - cont)**2)
+        wdesign = design * weight[..., np.newaxis]
+        amat = np.einsum(
+            '...pk,...p,...pq->...kq', wdesign, gfactor, design)
+        bvec = np.einsum('...pk,...p->...k', wdesign, flux)
+
+        # Indefinite systems do not step towards the minimum
+        failed |= _replace_not_positive_definite(amat)
+
+        x_new = np.linalg.solve(amat, bvec[..., np.newaxis])[..., 0]
+        active = ~(converged | failed)
+        x[active] = x_new[active]
+
+    return x, converged
+
+
 class PiccaContinuumModel(BaseContinuumModel):
     """Picca continuum model class.
 
@@ -28,17 +242,51 @@ class PiccaContinuumModel(BaseContinuumModel):
     denom: float
         Denominator for the slope term in the continuum model.
     minimizer: str
-        ``iminuit`` or ``l_bfgs_b`` to select the minimizer function.
+        ``iminuit``, ``l_bfgs_b``, ``numba`` or ``irls`` to select the
+        minimizer function. ``numba`` runs iminuit with the JIT compiled
+        :func:`_fused_continuum_cost` kernel. ``irls`` solves iteratively
+        reweighted least squares with :func:`_irls_solve` and falls back to
+        iminuit if it does not converge. :class:`BatchedPiccaContinuumModel
+        <qsonic.continuum_models.BatchedPiccaContinuumModel>` solves
+        ``irls`` for many spectra at once.
+    max_cache_mb: float, default: 1024
+        Maximum memory in MB for the per-spectrum model cache. See
+        :meth:`get_model_cache`.
+    warm_start: bool, default: False
+        Start each fit from the previous valid solution using its
+        covariance for step sizes. See :meth:`_get_x0`.
+    refit_tol: float, default: 0
+        Skip minimizing spectra whose estimated distance to the new minimum
+        is below this value. Zero refits all spectra. See
+        :meth:`_get_skipped_fit_result`.
+    validate_irls: bool, default: False
+        Also fit with iminuit when minimizer is ``irls`` and report the
+        agreement in :meth:`fit_continua`.
+    fit_workers: int, default: 1
+        Number of threads to fit spectra in :meth:`fit_continua`. Only used
+        for minimizers in :attr:`_threaded_minimizers`. Other minimizers
+        evaluate the cost in Python while holding the GIL, so they are
+        fit in a single thread.
 
     Attributes
     ----------
     minimizer: function
         Function that points to one of the minimizer options.
+    num_skipped: int
+        Number of spectra that were not minimized in the last
+        :meth:`fit_continua` call.
     """
 
+    _threaded_minimizers = ("numba", "irls")
+    """tuple(str): Minimizers that spend most of their time without the GIL
+    (in the ``nogil`` JIT kernel or in LAPACK) and benefit from
+    ``fit_workers``."""
+
     def __init__(
             self, meancont_interp, meanflux_interp, varlss_interp,
-            eta_interp, cont_order, rfwave0, denom, minimizer
+            eta_interp, cont_order, rfwave0, denom, minimizer,
+            max_cache_mb=1024., warm_start=False, refit_tol=0,
+            validate_irls=False, fit_workers=1
     ):
         self.meancont_interp = meancont_interp
         self.meanflux_interp = meanflux_interp
@@ -47,58 +295,177 @@ class PiccaContinuumModel(BaseContinuumModel):
         self.cont_order = cont_order
         self.rfwave0 = rfwave0
         self.denom = denom
+        self.max_cache_mb = max_cache_mb
+        self.warm_start = warm_start
+        self.refit_tol = refit_tol
+        self.num_skipped = 0
+        self.validate_irls = validate_irls
+        self.num_irls_fallbacks = 0
+        self._irls_diffs = []
+        self.fit_workers = max(1, fit_workers)
+        if self.fit_workers > 1 and minimizer not in self._threaded_minimizers:
+            logging.warning(
+                f"Minimizer {minimizer} does not release the GIL. Ignoring "
+                f"fit_workers={self.fit_workers}.")
+            self.fit_workers = 1
+        self._lock = threading.Lock()
+        self.clear_cache()
 
         if minimizer == "iminuit":
             self.minimizer = self._iminuit_minimizer
         elif minimizer == "l_bfgs_b":
             self.minimizer = self._scipy_l_bfgs_b_minimizer
+        elif minimizer == "numba":
+            self.minimizer = self._numba_minimizer
+        elif minimizer == "irls":
+            self.minimizer = self._irls_minimizer
         else:
             raise QsonicException(
                 "Undefined minimizer. Developer forgot to implement.")
 
-    def _continuum_costfn(self, x, wave, flux, ivar_sm, z_qso):
+    def _interp_versions(self):
+        return tuple(
+            (id(interp), getattr(interp, 'version', 0)) for interp in (
+                self.meancont_interp, self.meanflux_interp,
+                self.varlss_interp, self.eta_interp)
+        )
+
+    def clear_cache(self):
+        """Drops all precomputed model components. Called automatically
+        when any of the interpolators is :meth:`reset
+        <qsonic.mathtools.FastCubic1DInterp.reset>` or replaced."""
+        self._cache = weakref.WeakKeyDictionary()
+        self._cache_nbytes = 0
+        self._cache_versions = self._interp_versions()
+
+    @property
+    def cache_nbytes(self):
+        """int: Memory used by the model cache in bytes."""
+        return self._cache_nbytes
+
+    def _precompute(self, spec):
+        wave = np.concatenate(list(spec.forestwave.values()))
+        wave_rf = wave / (1 + spec.z_qso)
+        slope = np.log(wave_rf / self.rfwave0) / self.denom
+
+        return {
+            'template': (self.meancont_interp(wave_rf)
+                         * self.meanflux_interp(wave)),
+            'basis': 2 * slope - 1,
+            'flux': np.concatenate(
+                list(spec.forestflux.values()), dtype=np.float64),
+            'ivar': np.concatenate(
+                list(spec.forestivar_sm.values()), dtype=np.float64),
+            'varlss': self.varlss_interp(wave),
+            'eta': self.eta_interp(wave)
+        }
+
+    def get_model_cache(self, spec):
+        """Returns the model components of a spectrum that are fixed during
+        one iteration. Arms are concatenated. Components are evaluated once
+        and stored until an interpolator changes. Spectra that do not fit
+        into :attr:`max_cache_mb` are evaluated on every call.
+
+        Arguments
+        ---------
+        spec: Spectrum
+            Spectrum object.
+
+        Returns
+        ---------
+        cache: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Dictionary with keys ``template`` (mean continuum times mean
+            flux), ``basis`` (:math:`2x - 1`, where x is the log-slope),
+            ``flux``, ``ivar`` (smooth), ``varlss`` and ``eta``.
+        """
+        with self._lock:
+            if self._cache_versions != self._interp_versions():
+                self.clear_cache()
+
+            cache = self._cache.get(spec)
+            if cache is not None:
+                return cache
+
+        cache = self._precompute(spec)
+        nbytes = sum(arr.nbytes for arr in cache.values())
+        with self._lock:
+            if self._cache_nbytes + nbytes <= self.max_cache_mb * 2**20:
+                self._cache[spec] = cache
+                self._cache_nbytes += nbytes
+
+        return cache
+
+    def _continuum_costfn(self, x, cache):
         """Cost function to minimize for each quasar.
 
         This is a modified chi2 where amplitude is also part of minimization.
-        Cost of each arm is simply added to the total cost.
+        Arms are concatenated in ``cache``.
 
         Arguments
         ---------
         x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
             Polynomial coefficients for quasar diversity.
-        wave: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
-            Observed-frame wavelengths.
-        flux: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
-            Flux.
-        ivar_sm: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
-            Smooth inverse variance.
-        z_qso: float
-            Quasar redshift.
+        cache: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Model components from :meth:`get_model_cache`.
 
         Returns
         ---------
         cost: float
             Cost (modified chi2) for a given ``x``.
         """
-        cost = 0
+        cont_est = cache['template'] * mypoly1d(x, cache['basis'])
+        # no_neg = np.sum(cont_est<0)
+        # penalty = wave_arm.size * no_neg**2
+
+        weight = cache['ivar'] / (
+            cache['eta'] + cache['ivar'] * cache['varlss'] * cont_est**2)
+        w = weight > 0
 
-        for arm, wave_arm in wave.items():
-            cont_est = self.get_continuum_model(x, wave_arm / (1 + z_qso))
-            # no_neg = np.sum(cont_est<0)
-            # penalty = wave_arm.size * no_neg**2
+        cost = np.dot(
+            weight, (cache['flux'] - cont_est)**2
+        ) - np.log(weight[w]).sum()  # + penalty
 
-            cont_est *= self.meanflux_interp(wave_arm)
+        return cost
 
-            var_lss = self.varlss_interp(wave_arm) * cont_est**2
-            eta = self.eta_interp(wave_arm)
-            weight = ivar_sm[arm] / (eta + ivar_sm[arm] * var_lss)
-            w = weight > 0
+    def _get_design_matrix(self, cache):
+        """Design matrix :math:`A` such that the continuum (including mean
+        flux) is ``A @ x``. Shape is ``(npix, cont_order + 1)``."""
+        return np.vander(
+            cache['basis'], self.cont_order + 1, increasing=True
+        ) * cache['template'][:, np.newaxis]
 
-            cost += np.dot(
-                weight, (flux[arm] - cont_est)**2
-            ) - np.log(weight[w]).sum()  # + penalty
+    def _continuum_costfn_grad(self, x, cache):
+        """Analytic gradient of :meth:`_continuum_costfn` including the
+        :math:`-\\ln w` term. Arguments are the same.
 
-        return cost
+        Returns
+        ---------
+        grad: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Gradient with respect to ``x``.
+        """
+        design = self._get_design_matrix(cache)
+        _, dcost, _ = _pixel_cost_derivatives(
+            design @ x, cache['flux'], cache['ivar'], cache['varlss'],
+            cache['eta'])
+
+        return dcost @ design
+
+    def _continuum_fisher(self, x, cache):
+        """Fisher matrix (half of the expected Hessian) of
+        :meth:`_continuum_costfn`. Its inverse is the covariance of ``x``.
+        Arguments are the same.
+
+        Returns
+        ---------
+        fisher: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            2D array of shape ``(cont_order + 1, cont_order + 1)``.
+        """
+        design = self._get_design_matrix(cache)
+        _, _, fisher_pix = _pixel_cost_derivatives(
+            design @ x, cache['flux'], cache['ivar'], cache['varlss'],
+            cache['eta'])
+
+        return design.T @ (fisher_pix[:, np.newaxis] * design)
 
     def get_continuum_model(self, x, wave_rf_arm):
         """Returns interpolated continuum model.
@@ -123,16 +490,38 @@ class PiccaContinuumModel(BaseContinuumModel):
 
         return cont
 
-    def _iminuit_minimizer(self, spec, a0):
+    def _iminuit_minimizer(self, spec, x0, xerr=None):
+        cache = self.get_model_cache(spec)
+
+        def _cost(x):
+            return self._continuum_costfn(x, cache)
+
+        def _grad(x):
+            return self._continuum_costfn_grad(x, cache)
+
+        return self._migrad(x0, xerr, _cost, _grad)
+
+    def _numba_minimizer(self, spec, x0, xerr=None):
+        cache = self.get_model_cache(spec)
+        args = (cache['template'], cache['basis'], cache['flux'],
+                cache['ivar'], cache['varlss'], cache['eta'])
+        nograd = np.empty(0)
+
         def _cost(x):
-            return self._continuum_costfn(
-                x, spec.forestwave, spec.forestflux, spec.forestivar_sm,
-                spec.z_qso)
+            return _fused_continuum_cost(x, *args, nograd)
 
-        x0 = np.zeros_like(spec.cont_params['x'])
-        x0[0] = a0
-        mini = Minuit(_cost, x0)
+        def _grad(x):
+            grad = np.empty(x.size)
+            _fused_continuum_cost(x, *args, grad)
+            return grad
+
+        return self._migrad(x0, xerr, _cost, _grad)
+
+    def _migrad(self, x0, xerr, cost, grad):
+        mini = Minuit(cost, x0, grad=grad)
         mini.errordef = Minuit.LEAST_SQUARES
+        if xerr is not None:
+            mini.errors = xerr
         mini.migrad()
 
         result = {}
@@ -143,51 +532,149 @@ class PiccaContinuumModel(BaseContinuumModel):
 
         return result
 
-    def _scipy_l_bfgs_b_minimizer(self, spec, a0):
-        x0 = np.zeros_like(spec.cont_params['x'])
-        x0[0] = a0
+    def _irls_minimizer(self, spec, x0, xerr=None):
+        cache = self.get_model_cache(spec)
+        design = self._get_design_matrix(cache)
+        x, converged = _irls_solve(
+            design, cache['flux'], cache['ivar'], cache['varlss'],
+            cache['eta'], x0)
+
+        return self._get_irls_result(spec, x, converged, x0, xerr)
+
+    def _get_irls_result(self, spec, x, converged, x0, xerr=None):
+        """Result of an IRLS solution with the covariance from
+        :meth:`_continuum_fisher`. Falls back to iminuit if the solution has
+        not converged or the Fisher matrix is singular.
+
+        Arguments
+        ---------
+        spec: Spectrum
+            Spectrum object that is fit.
+        x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            IRLS solution.
+        converged: bool
+            Convergence of the solution.
+        x0: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Initial parameters.
+        xerr: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Step sizes for iminuit.
+
+        Returns
+        -------
+        result: dict
+            Result with ``valid``, ``x`` and ``xcov`` keys.
+        """
+        cache = self.get_model_cache(spec)
+        result = None
+        if converged and np.all(np.isfinite(x)):
+            try:
+                xcov = np.linalg.inv(self._continuum_fisher(x, cache))
+                result = {'valid': True, 'x': x, 'xcov': xcov}
+            except np.linalg.LinAlgError:
+                pass
+
+        if result is None:
+            with self._lock:
+                self.num_irls_fallbacks += 1
+            return self._iminuit_minimizer(spec, x0, xerr)
+
+        self._validate_irls(spec, x, x0, xerr)
+        return result
+
+    def _validate_irls(self, spec, x, x0, xerr=None):
+        """Fits with iminuit and stores the maximum difference from the IRLS
+        solution ``x`` in units of iminuit errors if :attr:`validate_irls`
+        is set. See :meth:`_log_irls_validation`.
+
+        Arguments
+        ---------
+        spec: Spectrum
+            Spectrum object that is fit.
+        x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            IRLS solution.
+        x0: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Initial parameters.
+        xerr: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Step sizes for iminuit.
+        """
+        if not self.validate_irls:
+            return
+
+        iminuit_result = self._iminuit_minimizer(spec, x0, xerr)
+        if iminuit_result['valid']:
+            xerr = np.sqrt(np.diag(iminuit_result['xcov']))
+            with self._lock:
+                self._irls_diffs.append(
+                    np.max(np.abs(x - iminuit_result['x']) / xerr))
+
+    def _log_irls_validation(self):
+        """Logs the number of fallbacks and, if :attr:`validate_irls`, the
+        agreement between IRLS and iminuit in units of iminuit errors."""
+        if self.num_irls_fallbacks > 0:
+            logging.info(
+                f"IRLS did not converge for {self.num_irls_fallbacks} "
+                "spectra, which are fit with iminuit.")
+
+        if not self._irls_diffs:
+            return
+
+        diffs = np.array(self._irls_diffs)
+        logging.info(
+            "IRLS vs iminuit max |dx| / sigma over parameters: "
+            f"median {np.median(diffs):.2e}, 95th percentile "
+            f"{np.percentile(diffs, 95):.2e}, max {diffs.max():.2e} "
+            f"for {diffs.size} spectra.")
+        self._irls_diffs = []
+
+    def _scipy_l_bfgs_b_minimizer(self, spec, x0, xerr=None):
+        cache = self.get_model_cache(spec)
         mini = minimize(
             self._continuum_costfn,
             x0,
-            args=(spec.forestwave,
-                  spec.forestflux,
-                  spec.forestivar_sm,
-                  spec.z_qso),
+            args=(cache,),
             method='L-BFGS-B',
             bounds=None,
-            jac=None
+            jac=self._continuum_costfn_grad
         )
 
         result = {}
 
         result['valid'] = mini.success
         result['x'] = mini.x
-        result['xcov'] = mini.hess_inv.todense()
+        try:
+            result['xcov'] = np.linalg.inv(
+                self._continuum_fisher(mini.x, cache))
+        except np.linalg.LinAlgError:
+            result['valid'] = False
+            result['xcov'] = mini.hess_inv.todense()
 
         return result
 
-    def stack_spectra(self, valid_spectra_list, flux_stacker):
+    def stack_spectra(self, batch, flux_stacker, w=None):
         """Stacks spectra in the observed and rest-frame. Observed-frame and
         rest-frame stacking is performed over residuals f/C.
 
         Arguments
         ---------
-        valid_spectra_list: list(Spectrum)
-            Valid spectra objects to iterate.
+        batch: SpectraBatch
+            Batch of spectra with continua.
         flux_stacker: FluxStacker
             Flux stacker object.
+        w: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Bool array of pixels to stack. None stacks
+            :meth:`SpectraBatch.get_valid_pixels
+            <qsonic.spectrum.SpectraBatch.get_valid_pixels>`.
         """
-        for spec in valid_spectra_list:
-            for arm, wave_arm in spec.forestwave.items():
-                wave_rf_arm = wave_arm / (1 + spec.z_qso)
+        if w is None:
+            w = batch.get_valid_pixels()
 
-                cont = spec.cont_params['cont'][arm]
-                weight = spec.forestweight[arm] * cont**2
-                weighted_flux = weight * spec.forestflux[arm] / cont
+        cont = batch.cont[w]
+        weight = batch.weight[w] * cont**2
+        weighted_flux = weight * batch.flux[w] / cont
 
-                flux_stacker.add(
-                    wave_arm, wave_rf_arm, weighted_flux, weighted_flux, weight
-                )
+        flux_stacker.add(
+            batch.wave[w], batch.get_wave_rf()[w], weighted_flux,
+            weighted_flux, weight)
 
     def fit_continuum(self, spec):
         """Fits the continuum for a single Spectrum.
@@ -201,9 +688,12 @@ class PiccaContinuumModel(BaseContinuumModel):
         If the best-fitting continuum is **negative at any point**, the fit is
         **invalidated**. Chi2 is set separately without using the
         :meth:`cost function <._continuum_costfn>`.
-        ``x`` key is the best-fitting parameter, and ``xcov`` is their inverse
-        Hessian ``hess_inv`` given by
-        :external+scipy:func:`scipy.optimize.minimize` using 'L-BFGS-B' method.
+        ``x`` key is the best-fitting parameter, and ``xcov`` is their
+        covariance. This is given by iminuit for the ``iminuit`` minimizer,
+        and is the inverse of the analytic Fisher matrix
+        (:meth:`_continuum_fisher`) for the ``l_bfgs_b`` minimizer. Both
+        minimizers use the analytic gradient
+        (:meth:`_continuum_costfn_grad`).
 
         Arguments
         ---------
@@ -212,17 +702,168 @@ class PiccaContinuumModel(BaseContinuumModel):
         """
         # We can precalculate meanflux and varlss here,
         # and store them in respective keys to spec.cont_params
+        result = self._get_skipped_fit_result(spec)
+        if result is None:
+            result = self.minimizer(spec, *self._get_x0(spec))
+        self._set_continuum_from_result(spec, result)
+
+    def fit_continua(self, spectra_list):
+        """Fits the continua for a list of Spectrum objects one by one using
+        :attr:`fit_workers` threads and reports the memory used by the model
+        cache. Resets :attr:`num_skipped`.
+
+        Arguments
+        ---------
+        spectra_list: list(Spectrum)
+            Spectrum objects to fit.
+        """
+        self.num_skipped = 0
+        self.num_irls_fallbacks = 0
+
+        def _fit_chunk(chunk):
+            for spec in chunk:
+                self.fit_continuum(spec)
+
+        chunk_size = max(1, len(spectra_list) // (4 * self.fit_workers))
+        self._map_chunks(_fit_chunk, spectra_list, chunk_size)
+
+        self.log_cache_usage(len(spectra_list))
+        self._log_irls_validation()
+
+    def _map_chunks(self, func, items, chunk_size):
+        """Calls ``func`` on consecutive chunks of ``items``. Chunks are
+        distributed over :attr:`fit_workers` threads if it is larger than
+        one. Each spectrum is fit independently, so results do not depend on
+        the number of workers.
+
+        Arguments
+        ---------
+        func: Callable
+            Function that takes a list.
+        items: list
+            Items to split into chunks.
+        chunk_size: int
+            Number of items in each chunk.
+        """
+        chunks = [items[i:i + chunk_size]
+                  for i in range(0, len(items), chunk_size)]
+
+        if self.fit_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=self.fit_workers) as executor:
+                # Consume to propagate exceptions
+                for _ in executor.map(func, chunks):
+                    pass
+        else:
+            for chunk in chunks:
+                func(chunk)
+
+    def log_cache_usage(self, nspec):
+        """Logs the number of cached spectra and memory usage.
+
+        Arguments
+        ---------
+        nspec: int
+            Total number of spectra.
+        """
+        logging.info(
+            f"Model cache holds {len(self._cache)}/{nspec} spectra "
+            f"using {self._cache_nbytes / 2**20:.1f} MB.")
+
+    def _get_skipped_fit_result(self, spec):
+        """Decides if the minimization can be skipped when
+        :attr:`refit_tol` is positive.
+
+        The gradient :math:`g` of the cost under the current global
+        functions is evaluated at the previous solution :math:`x`. Using the
+        previous covariance :math:`V`, which is twice the inverse Hessian,
+        the estimated distance to the new minimum is
+        :math:`\\mathrm{EDM} = g^T V g / 4`. If this is smaller than
+        :attr:`refit_tol`, a single Newton step :math:`x - V g / 2` is
+        taken instead of a full minimization and :attr:`num_skipped` is
+        incremented.
+
+        Arguments
+        ---------
+        spec: Spectrum
+            Spectrum object to fit.
+
+        Returns
+        -------
+        result: dict or None
+            Result with ``valid``, ``x`` and ``xcov`` keys if skipped.
+            None if the spectrum needs to be refit.
+        """
+        if self.refit_tol <= 0 or not spec.cont_params['valid']:
+            return None
+
+        xcov = spec.cont_params['xcov']
+        grad = self._continuum_costfn_grad(
+            spec.cont_params['x'], self.get_model_cache(spec))
+        step = 0.5 * (xcov @ grad)
+        edm = 0.5 * np.dot(grad, step)
+
+        if not (0 <= edm < self.refit_tol):
+            return None
+
+        with self._lock:
+            self.num_skipped += 1
+        return {'valid': True, 'x': spec.cont_params['x'] - step,
+                'xcov': xcov}
+
+    def _get_x0(self, spec):
+        """Initial parameters and step sizes for the minimizer.
+
+        If :attr:`warm_start` is set and the previous fit is valid, starts
+        from the previous solution with step sizes from its covariance.
+        Otherwise, starts from ``[a0, 0, ...]``, where a0 is the inverse
+        variance weighted mean flux, and lets the minimizer choose the step
+        sizes.
+
+        Arguments
+        ---------
+        spec: Spectrum
+            Spectrum object to fit.
+
+        Returns
+        -------
+        x0: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Initial parameters.
+        xerr: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Step sizes.
+        """
+        if self.warm_start and spec.cont_params['valid']:
+            xerr = np.sqrt(np.diag(spec.cont_params['xcov']))
+            if np.all(xerr > 0):
+                return spec.cont_params['x'].copy(), xerr
 
-        def get_a0():
-            a0 = 0
-            n0 = 1e-6
-            for arm, ivar_arm in spec.forestivar_sm.items():
-                a0 += np.dot(spec.forestflux[arm], ivar_arm)
-                n0 += np.sum(ivar_arm)
+        x0 = np.zeros(self.cont_order + 1)
+        x0[0] = self._get_a0(spec)
 
-            return a0 / n0
+        return x0, None
 
-        result = self.minimizer(spec, get_a0())
+    def _get_a0(self, spec):
+        """Inverse variance weighted mean flux as the initial amplitude."""
+        a0 = 0
+        n0 = 1e-6
+        for arm, ivar_arm in spec.forestivar_sm.items():
+            a0 += np.dot(spec.forestflux[arm], ivar_arm)
+            n0 += np.sum(ivar_arm)
+
+        return a0 / n0
+
+    def _set_continuum_from_result(self, spec, result):
+        """Sets :attr:`cont_params <qsonic.spectrum.Spectrum.cont_params>`
+        given the result of a minimizer. Invalidates the fit if the
+        continuum is negative at any point. Also sets the forest weights and
+        the chi2.
+
+        Arguments
+        ---------
+        spec: Spectrum
+            Spectrum object that is fit.
+        result: dict
+            Must have ``valid``, ``x`` and ``xcov`` keys.
+        """
         spec.cont_params['valid'] = result['valid']
 
         if spec.cont_params['valid']:
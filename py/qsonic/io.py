@@ -3,6 +3,12 @@ imported without a need for MPI."""
 
 import argparse
 import functools
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
 import warnings
 
 import fitsio
@@ -52,6 +58,45 @@ def add_io_parser(parser=None):
     ingroup.add_argument(
         "--arms", default=['B', 'R'], choices=['B', 'R', 'Z'], nargs='+',
         help="Arms to read.")
+    ingroup.add_argument(
+        "--storage-dtype", default="float64", choices=["float64", "float32"],
+        help=("Floating point type to store flux, ivar, weights and "
+              "resolution matrices. Sums are accumulated in float64."))
+    ingroup.add_argument(
+        "--cache-dir",
+        help=("Directory to cache preprocessed (read, calibrated and masked) "
+              "spectra for each healpix. Cached spectra are reused if the "
+              "catalog, limits, masks and calibration files are the same."))
+    ingroup.add_argument(
+        "--cache-mmap", action="store_true",
+        help=("Memory-map cached spectra (copy-on-write) instead of reading "
+              "them into private memory."))
+    ingroup.add_argument(
+        "--prefetch-depth", type=int, default=2,
+        help=("Number of healpix files to read ahead in a background "
+              "thread. 0 reads serially."))
+    ingroup.add_argument(
+        "--load-balance", default="cost", choices=["cost", "count"],
+        help=("Balance files between MPI processes by the estimated cost "
+              "(from the number of quasars and forest pixels) or by the "
+              "number of quasars."))
+    ingroup.add_argument(
+        "--dynamic-schedule", action="store_true",
+        help=("MPI processes take the next files as they finish reading "
+              "instead of a fixed list. Not supported with --cache-dir."))
+    ingroup.add_argument(
+        "--redistribute-spectra", action="store_true",
+        help=("Move spectra between MPI processes after reading to equalize "
+              "the number of forest pixels for continuum fitting."))
+    ingroup.add_argument(
+        "--timing-log",
+        help=("Timing log of a previous run (see --save-timing-log) to "
+              "calibrate the cost coefficients for load balancing. Only read "
+              "times are calibrated. Use --redistribute-spectra to balance "
+              "continuum fitting."))
+    ingroup.add_argument(
+        "--save-timing-log",
+        help="Filename to save the read time of each file.")
 
     outgroup = parser.add_argument_group('Output options')
     outgroup.add_argument(
@@ -71,12 +116,21 @@ def add_io_parser(parser=None):
     outgroup.add_argument(
         "--save-by-hpx", action="store_true",
         help="Save by healpix. If not, saves by MPI rank.")
+    outgroup.add_argument(
+        "--delta-format", default="hdu", choices=["hdu", "flat"],
+        help=("Save each arm to a separate HDU or all arms to one table "
+              "with an index table."))
+    outgroup.add_argument(
+        "--writer-queue-size", type=int, default=2,
+        help=("Number of delta files queued for the background writer. "
+              "Writes in the main thread if 0."))
     return parser
 
 
 def get_spectra_reader_function(
         input_dir, arms_to_keep, mock_analysis, skip_resomat,
-        read_true_continuum, is_tile, read_exposures, program="dark"
+        read_true_continuum, is_tile, read_exposures, program="dark",
+        forest_limits=None
 ):
     """ Returns a callable object (function) that returns a list of Spectrum
     objects for a given catalog of a single healpix. Essentially, a wrapper
@@ -109,6 +163,12 @@ def get_spectra_reader_function(
         If true, reads exposures for healpix format only.
     program: str, default: "dark"
         Always use dark program.
+    forest_limits: tuple(float), default: None
+        ``(w1, w2, lya1, lya2)`` limits passed to
+        :meth:`Spectrum.set_forest_region
+        <qsonic.spectrum.Spectrum.set_forest_region>`. If set, only the
+        pixels in the forest and above Lya are read. See
+        :func:`_get_forest_windows`.
 
     Returns
     ---------
@@ -124,31 +184,223 @@ def get_spectra_reader_function(
         return functools.partial(
             read_onehealpix_file_mock,
             input_dir=input_dir, arms_to_keep=arms_to_keep,
-            skip_resomat=skip_resomat, read_true_continuum=read_true_continuum
+            skip_resomat=skip_resomat, read_true_continuum=read_true_continuum,
+            forest_limits=forest_limits
         )
 
     elif is_tile:
         return functools.partial(
             read_onetile_coaddfile_data,
             input_dir=input_dir, arms_to_keep=arms_to_keep,
-            skip_resomat=skip_resomat
+            skip_resomat=skip_resomat, forest_limits=forest_limits
         )
 
     elif read_exposures:
         return functools.partial(
             read_onehealpix_file_data_uncoadd,
             input_dir=input_dir, arms_to_keep=arms_to_keep,
-            skip_resomat=skip_resomat, program=program
+            skip_resomat=skip_resomat, program=program,
+            forest_limits=forest_limits
         )
 
     else:
         return functools.partial(
             read_onehealpix_file_data_coadd,
             input_dir=input_dir, arms_to_keep=arms_to_keep,
-            skip_resomat=skip_resomat, program=program
+            skip_resomat=skip_resomat, program=program,
+            forest_limits=forest_limits
         )
 
 
+def prefetch_spectra(reader_function, local_queue, depth=2):
+    """Generator that reads the next healpix files in a background thread
+    while the caller processes the current one. At most ``depth`` healpix
+    files are held in the queue. Exceptions raised by the reader are raised
+    in the caller.
+
+    Arguments
+    ---------
+    reader_function: Callable
+        Function that returns a list of Spectrum objects for a catalog. See
+        :func:`get_spectra_reader_function`.
+    local_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Catalogs of healpixels to read.
+    depth: int, default: 2
+        Maximum number of healpix files read ahead. Reads serially in the
+        calling thread if zero or less.
+
+    Yields
+    ------
+    spectra_list: list(Spectrum)
+        Spectra of each healpix in the order of ``local_queue``.
+    """
+    if depth <= 0:
+        for cat in local_queue:
+            yield reader_function(cat)
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item):
+        # Time out periodically so that the thread ends if the consumer stops
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker():
+        for cat in local_queue:
+            try:
+                item = (reader_function(cat), None)
+            except Exception as e:
+                _put((None, e))
+                return
+
+            if not _put(item):
+                return
+
+        _put((None, None))
+
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            spectra_list, error = buffer.get()
+            if error is not None:
+                raise error
+            if spectra_list is None:
+                break
+            yield spectra_list
+    finally:
+        stop.set()
+        thread.join()
+
+
+_CACHE_VERSION = 1
+"""int: Increment when the cached arrays or preprocessing change."""
+_CACHE_ARGS = (
+    'input_dir', 'tile_format', 'mock_analysis', 'skip_resomat', 'arms',
+    'storage_dtype', 'true_continuum', 'exposures', 'coadd_arms', 'wave1',
+    'wave2', 'forest_w1', 'forest_w2', 'min_rsnr', 'min_forestsnr', 'skip',
+    'noise_calibration', 'flux_calibration', 'sky_mask', 'bal_mask',
+    'dla_mask')
+"""tuple(str): Options that change preprocessed spectra."""
+_CACHE_FILE_ARGS = (
+    'noise_calibration', 'flux_calibration', 'sky_mask', 'dla_mask')
+"""tuple(str): Options that are filenames. Their sizes and modification times
+are part of the cache key."""
+
+
+def get_spectra_cache_fname(catalog, args):
+    """Returns the cache directory name for a healpix (or tile) catalog. The
+    name contains a hash of the catalog and the options in ``_CACHE_ARGS``.
+    Sizes and modification times of calibration and mask files are hashed
+    as well, so that changing these files invalidates the cache.
+
+    Arguments
+    ---------
+    catalog: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Catalog of one healpix from the local queue.
+    args: argparse.Namespace
+        Options passed to script. Must have ``cache_dir``.
+
+    Returns
+    -------
+    fname: str
+    """
+    group = catalog['TILEID'][0] if args.tile_format else \
+        catalog['HPXPIXEL'][0]
+
+    hasher = hashlib.sha256()
+    hasher.update(f"v{_CACHE_VERSION}".encode())
+    hasher.update(str(catalog.dtype.descr).encode())
+    hasher.update(np.ascontiguousarray(catalog).tobytes())
+    for key in _CACHE_ARGS:
+        value = getattr(args, key, None)
+        if key == 'arms':
+            value = sorted(value)
+        hasher.update(f"{key}={value};".encode())
+
+        if key in _CACHE_FILE_ARGS and value:
+            stat = os.stat(value)
+            hasher.update(f"{stat.st_size},{stat.st_mtime_ns};".encode())
+
+    return f"{args.cache_dir}/{group}-{hasher.hexdigest()[:24]}"
+
+
+def save_spectra_cache(spectra_list, fname):
+    """Saves forests of spectra as a directory of ``.npy`` files, one for
+    each key of :meth:`SpectraBatch.to_arrays
+    <qsonic.spectrum.SpectraBatch.to_arrays>`, and the common wavelength
+    grid. The directory is written under a temporary name and renamed, so
+    that incomplete caches are never read. Existing caches are kept.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectra of one healpix after reading, calibration and masking. Can be
+        empty.
+    fname: str
+        Directory name from :func:`get_spectra_cache_fname`.
+    """
+    arrays = qsonic.spectrum.SpectraBatch(spectra_list).to_arrays()
+    if qsonic.spectrum.Spectrum._wave:
+        for arm, wave_arm in qsonic.spectrum.Spectrum._wave.items():
+            arrays[f'grid_{arm}'] = wave_arm
+
+    tmpdir = f"{fname}.tmp{os.getpid()}"
+    os.makedirs(tmpdir, exist_ok=True)
+    for key, arr in arrays.items():
+        np.save(f"{tmpdir}/{key}.npy", arr, allow_pickle=False)
+
+    try:
+        os.rename(tmpdir, fname)
+    except OSError:
+        # Another process saved the same cache.
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def load_spectra_cache(fname, mmap_mode=None):
+    """Loads spectra saved by :func:`save_spectra_cache`. Also sets the
+    common wavelength grid if it is not set.
+
+    If ``mmap_mode`` is set, files are memory-mapped and forests of spectra
+    are views of the mapped arrays without any copy. Pages are then loaded
+    on access and shared in the page cache between processes on a node.
+    Use ``'c'`` (copy-on-write) so that in-place modifications copy only
+    the modified pages and never change the files.
+
+    Arguments
+    ---------
+    fname: str
+        Directory name from :func:`get_spectra_cache_fname`.
+    mmap_mode: str, default: None
+        Passed to :external+numpy:py:func:`numpy.load`. ``None`` reads
+        arrays into memory.
+
+    Returns
+    -------
+    spectra_list: list(Spectrum)
+    """
+    arrays = {}
+    for npyfile in os.listdir(fname):
+        key, ext = os.path.splitext(npyfile)
+        if ext == ".npy":
+            arrays[key] = np.load(
+                f"{fname}/{npyfile}", mmap_mode=mmap_mode, allow_pickle=False)
+
+    grid = {key[5:]: arrays.pop(key) for key in list(arrays)
+            if key.startswith('grid_')}
+    if grid:
+        qsonic.spectrum.Spectrum._set_wave(grid)
+
+    return qsonic.spectrum.SpectraBatch.from_arrays(arrays).spectra
+
+
 def read_resolution_matrices_onehealpix_data(
         catalog_hpx, input_dir, spectra_list, program="dark"
 ):
@@ -199,13 +451,118 @@ def read_resolution_matrices_onehealpix_data(
     return spectra_list
 
 
-def read_deltas(fname):
-    """ Returns a list of all Delta objects in a file.
+_DELTA_REQUIRED_COLUMNS = ['LAMBDA', 'LOGLAM', 'DELTA', 'DELTA_BLIND', 'IVAR']
+"""list(str): Delta columns that are always read."""
+
+
+def _get_delta_columns(colnames, columns=None, skip_resomat=False):
+    """Columns to read from a delta table.
+
+    Arguments
+    ---------
+    colnames: list(str)
+        Column names in the table.
+    columns: list(str) or None, default: None
+        Columns to read in addition to :data:`_DELTA_REQUIRED_COLUMNS`.
+        Reads all columns if None.
+    skip_resomat: bool, default: False
+        Does not read ``RESOMAT``.
+
+    Returns
+    -------
+    list(str)
+    """
+    if columns is None:
+        cols = list(colnames)
+    else:
+        cols = [col for col in colnames
+                if col in columns or col in _DELTA_REQUIRED_COLUMNS]
+
+    if skip_resomat and 'RESOMAT' in cols:
+        cols.remove('RESOMAT')
+
+    return cols
+
+
+def _read_flat_deltas(fts, predicate=None, columns=None, skip_resomat=False):
+    """Reads the flat delta format. See :meth:`SpectraBatch.write_flat
+    <qsonic.spectrum.SpectraBatch.write_flat>`. Header of each Delta is a
+    dictionary of the common header keys and its row in the ``INDEX`` table.
+    Only the rows of selected deltas are read from the ``DELTAS`` table. See
+    :func:`read_deltas` for arguments.
+    """
+    common_header = {
+        key: fts['INDEX'].read_header()[key]
+        for key in qsonic.spectrum.SpectraBatch._flat_header_keys}
+    index = fts['INDEX'].read()
+
+    key = qsonic.spectrum.Delta._accepted_targetid_keys.intersection(
+        index.dtype.names)
+    if predicate is not None and key:
+        key = key.pop()
+        keep = [predicate(row[key], row['MEANSNR']) for row in index]
+        index = index[np.array(keep, dtype=bool)]
+
+    if index.size == 0:
+        return []
+
+    cols = _get_delta_columns(
+        fts['DELTAS'].get_colnames(), columns, skip_resomat)
+    rows = np.concatenate([
+        np.arange(i1, i1 + n) for i1, n in zip(
+            index['OFFSET'], index['LENGTH'])])
+    if rows.size == fts['DELTAS'].get_nrows():
+        rows = None
+    data = fts['DELTAS'].read(columns=cols, rows=rows)
+
+    hdr_keys = [key for key in index.dtype.names
+                if key not in ['ARM', 'OFFSET', 'LENGTH']]
+    deltas_list = []
+    i1 = 0
+    for row in index:
+        header = common_header.copy()
+        for key in hdr_keys:
+            header[key] = row[key].item()
+
+        i2 = i1 + row['LENGTH']
+        deltas_list.append(qsonic.spectrum.Delta.from_table(
+            header, data[i1:i2]))
+        i1 = i2
+
+    return deltas_list
+
+
+def _get_header_targetid(header):
+    """TARGETID from the first accepted header key. None if missing."""
+    for key in qsonic.spectrum.Delta._accepted_targetid_keys:
+        if key in header:
+            return header[key]
+    return None
+
+
+def read_deltas(fname, predicate=None, columns=None, skip_resomat=False):
+    """ Returns a list of all Delta objects in a file. Both one HDU per arm
+    and flat (``INDEX`` and ``DELTAS`` tables) formats are supported. See
+    :meth:`SpectraBatch.write_flat
+    <qsonic.spectrum.SpectraBatch.write_flat>`.
+
+    Deltas can be selected before reading their data by passing
+    ``predicate``, which is evaluated on TARGETID and MEANSNR from the
+    headers (or the index table). Only the selected HDUs (or rows) are read.
 
     Arguments
     ---------
     fname: str
         FITS file name
+    predicate: Callable or None, default: None
+        Function of ``(targetid, mean_snr)`` that returns True to keep the
+        delta. Keeps all if None.
+    columns: list(str) or None, default: None
+        Columns to read in addition to wavelength, delta and ``IVAR``, e.g.
+        ``['WEIGHT']``. Reads all columns if None. Attributes of columns
+        not read are None.
+    skip_resomat: bool, default: False
+        Does not read the resolution matrix.
 
     Returns
     ---------
@@ -218,13 +575,143 @@ def read_deltas(fname):
     """
 
     with fitsio.FITS(fname) as fts:
-        deltas_list = [qsonic.spectrum.Delta(hdu) for hdu in fts[1:]]
+        if 'INDEX' in fts:
+            return _read_flat_deltas(fts, predicate, columns, skip_resomat)
+
+        if predicate is None and columns is None and not skip_resomat:
+            return [qsonic.spectrum.Delta(hdu) for hdu in fts[1:]]
+
+        deltas_list = []
+        for hdu in fts[1:]:
+            header = hdu.read_header()
+            if predicate is not None and not predicate(
+                    _get_header_targetid(header), header['MEANSNR']):
+                continue
+
+            cols = _get_delta_columns(
+                hdu.get_colnames(), columns, skip_resomat)
+            deltas_list.append(qsonic.spectrum.Delta.from_table(
+                header, hdu.read(columns=cols)))
 
     return deltas_list
 
 
+def write_tables(fname, tables):
+    """Writes tables to a new FITS file. Overwrites existing files.
+
+    Arguments
+    ---------
+    fname: str
+        Filename.
+    tables: list(dict)
+        Keyword arguments to ``fitsio.FITS.write`` for each table. See
+        :meth:`SpectraBatch.get_tables
+        <qsonic.spectrum.SpectraBatch.get_tables>`.
+
+    Returns
+    -------
+    nbytes: int
+        Bytes in the data columns written.
+    """
+    nbytes = 0
+    with fitsio.FITS(fname, 'rw', clobber=True) as fts:
+        for table in tables:
+            fts.write(**table)
+            nbytes += sum(col.nbytes for col in table['data'])
+
+    return nbytes
+
+
+class DeltaWriter():
+    """Writes delta files in a background thread. Tables are generated by
+    the caller and put into a bounded queue, so that the caller continues
+    with the next healpix or other work while files are written. Errors in
+    the writer thread are raised in the caller on the next :meth:`put` or
+    on :meth:`close`. Spectra must not be modified until :meth:`close`,
+    since tables may hold views of their arrays.
+
+    Arguments
+    ---------
+    maxsize: int, default: 2
+        Maximum number of files waiting in the queue. :meth:`put` blocks
+        when the queue is full.
+
+    Attributes
+    ----------
+    nbytes: int
+        Bytes written.
+    write_time: float
+        Time spent in writing in seconds.
+    wait_time: float
+        Time spent in the caller waiting for the queue in seconds.
+    """
+
+    def __init__(self, maxsize=2):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self.nbytes = 0
+        self.write_time = 0
+        self.wait_time = 0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+
+            t1 = time.time()
+            try:
+                self.nbytes += write_tables(*item)
+            except Exception as e:
+                self._error = e
+            self.write_time += time.time() - t1
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def put(self, fname, tables):
+        """Queues tables to be written to ``fname``. Blocks if the queue is
+        full.
+
+        Arguments
+        ---------
+        fname: str
+            Filename.
+        tables: list(dict)
+            Keyword arguments to ``fitsio.FITS.write`` for each table.
+        """
+        self._raise_error()
+        t1 = time.time()
+        self._queue.put((fname, tables))
+        self.wait_time += time.time() - t1
+
+    def close(self):
+        """Waits for all files to be written and stops the thread.
+
+        Returns
+        -------
+        throughput: float
+            Write throughput in MB/s.
+        """
+        t1 = time.time()
+        self._queue.put(None)
+        self._thread.join()
+        self.wait_time += time.time() - t1
+        self._raise_error()
+
+        if self.write_time == 0:
+            return 0.
+        return self.nbytes / 1e6 / self.write_time
+
+
 def save_deltas(
-        spectra_list, outdir, save_by_hpx=False, mpi_rank=None
+        spectra_list, outdir, save_by_hpx=False, mpi_rank=None,
+        delta_format="hdu", writer=None
 ):
     """ Saves given list of spectra as deltas. NO coaddition of arms.
     Each arm is saved separately. Only valid spectra are saved.
@@ -239,6 +726,14 @@ def save_deltas(
         Saves by healpix if True. Has priority over mpi_rank
     mpi_rank: int, default: None
         Rank of the MPI process. Save by `mpi_rank` if passed.
+    delta_format: str, default: "hdu"
+        ``hdu`` saves each arm to a separate HDU. ``flat`` saves one table
+        for all arms with an index table. See
+        :meth:`SpectraBatch.write_flat
+        <qsonic.spectrum.SpectraBatch.write_flat>`.
+    writer: DeltaWriter, default: None
+        Queues files to this background writer if passed. Otherwise, writes
+        in the calling thread.
 
     Raises
     ---------
@@ -266,35 +761,131 @@ def save_deltas(
         raise QsonicException("Blinding is not set. Cannot save delta.")
 
     for healpix, hp_specs in zip(unique_pix, split_spectra):
-        results = fitsio.FITS(
-            f"{outdir}/delta-{healpix}.fits", 'rw', clobber=True)
+        fname = f"{outdir}/delta-{healpix}.fits"
+        batch = qsonic.spectrum.SpectraBatch(
+            qsonic.spectrum.valid_spectra(hp_specs))
+        tables = batch.get_tables(delta_format)
 
-        for spec in qsonic.spectrum.valid_spectra(hp_specs):
-            spec.write(results)
+        if writer is None:
+            write_tables(fname, tables)
+        else:
+            writer.put(fname, tables)
 
-        results.close()
 
+_FULL_READ_FRACTION = 0.75
+"""float: Image HDUs are read entirely if the fraction of selected rows is
+above this value."""
 
-def _read_resoimage(imhdu, quasar_indices, nwave):
-    # Reading into sorted order is faster
-    # Since the output catalog is already sorted, we place them in order
-    ndiags = imhdu.get_dims()[1]
-    dtype = imhdu._get_image_numpy_dtype()
-    data = np.empty((quasar_indices.size, ndiags, nwave), dtype=dtype)
-    for idata, iqso in enumerate(quasar_indices):
-        data[idata, :, :] = imhdu[int(iqso), :, :]
+
+def _get_contiguous_runs(quasar_indices):
+    """Coalesces row indices into runs of consecutive rows.
+
+    Arguments
+    ---------
+    quasar_indices: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Unique row indices in any order.
+
+    Returns
+    -------
+    isort: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Indices that sort ``quasar_indices``.
+    runs: list(tuple(int, int))
+        Start and end positions of each run in the sorted indices.
+    """
+    isort = np.argsort(quasar_indices)
+    rows = quasar_indices[isort]
+    breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+    starts = np.append(0, breaks)
+    ends = np.append(breaks, rows.size)
+    return isort, list(zip(starts, ends))
+
+
+def _read_block(imhdu, r1, r2, c1, c2):
+    """Reads rows ``r1:r2`` and wavelength pixels ``c1:c2`` of 2D (flux)
+    or 3D (resolution) images in one call."""
+    dims = imhdu.get_dims()
+    if c2 <= c1:
+        return np.empty((r2 - r1, *dims[1:-1], 0))
+    if len(dims) == 3:
+        return imhdu[r1:r2, :, c1:c2]
+    return imhdu[r1:r2, c1:c2]
+
+
+def _read_imagehdu(imhdu, quasar_indices, dtype=None):
+    # Works for 2D (flux, ivar, mask) and 3D (resolution) images.
+    # Rows are read in contiguous runs, and placed in the order of
+    # quasar_indices. Entire HDU is read if most rows are needed.
+    # dtype=None keeps the type in the file
+    dims = imhdu.get_dims()
+    if dtype is None:
+        dtype = imhdu._get_image_numpy_dtype()
+
+    if quasar_indices.size > _FULL_READ_FRACTION * dims[0]:
+        return imhdu.read()[quasar_indices].astype(dtype, copy=False)
+
+    data = np.empty((quasar_indices.size, *dims[1:]), dtype=dtype)
+    isort, runs = _get_contiguous_runs(quasar_indices)
+    for s1, s2 in runs:
+        r1 = int(quasar_indices[isort[s1]])
+        data[isort[s1:s2]] = _read_block(imhdu, r1, r1 + s2 - s1, 0, dims[-1])
 
     return data
 
 
-def _read_imagehdu(imhdu, quasar_indices, nwave):
-    dtype = imhdu._get_image_numpy_dtype()
-    data = np.empty((quasar_indices.size, nwave), dtype=dtype)
-    for idata, iqso in enumerate(quasar_indices):
-        data[idata, :] = imhdu[int(iqso), :]
+def _read_imagehdu_windows(imhdu, quasar_indices, pix1, pix2, dtype=None):
+    # Each run of consecutive rows is read in one call over the union of
+    # their pixel windows, then windows are copied out of the block.
+    if dtype is None:
+        dtype = imhdu._get_image_numpy_dtype()
+
+    data = [None] * quasar_indices.size
+    isort, runs = _get_contiguous_runs(quasar_indices)
+    for s1, s2 in runs:
+        jj = isort[s1:s2]
+        r1 = int(quasar_indices[jj[0]])
+        c1, c2 = int(pix1[jj].min()), int(pix2[jj].max())
+        block = _read_block(imhdu, r1, r1 + s2 - s1, c1, c2)
+
+        for k, j in enumerate(jj):
+            data[j] = block[k, ..., pix1[j] - c1:pix2[j] - c1].astype(dtype)
 
     return data
 
+
+def _get_forest_windows(wave_arm, z_qso, forest_limits):
+    """Pixel windows in one arm that :meth:`Spectrum.set_forest_region
+    <qsonic.spectrum.Spectrum.set_forest_region>` and RSNR calculation need.
+
+    Flux, ivar and mask are needed from the start of the forest or the Lya
+    line, whichever is bluer, to the end of the arm. Resolution matrices are
+    only needed until the end of the forest.
+
+    Arguments
+    ---------
+    wave_arm: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Wavelength grid of the arm.
+    z_qso: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Quasar redshifts.
+    forest_limits: tuple(float)
+        ``(w1, w2, lya1, lya2)`` observed and rest-frame forest limits.
+
+    Returns
+    -------
+    pix1: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        First pixel to read.
+    pix2_reso: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Last pixel (exclusive) to read for resolution matrices.
+    """
+    w1, w2, lya1, lya2 = forest_limits
+    l1 = np.maximum(w1, (1 + z_qso) * lya1)
+    l2 = np.minimum(w2, (1 + z_qso) * lya2)
+    lrsnr = (1 + z_qso) * qsonic.spectrum.Spectrum.WAVE_LYA_A
+
+    pix1 = np.searchsorted(wave_arm, np.minimum(l1, lrsnr))
+    pix2_reso = np.maximum(pix1, np.searchsorted(wave_arm, l2))
+    return pix1, pix2_reso
+
+
 # Timing showed this is slower
 # def _read_imagehdu_2(imhdu, quasar_indices):
 #     ndims = imhdu.get_info()['ndims']
@@ -353,7 +944,7 @@ def _read_true_continuum(targetids, fspec):
 
 def _read_onehealpix_file(
         targetids_by_survey, fspec, arms_to_keep, skip_resomat,
-        fbrmap_columns=['TARGETID']
+        fbrmap_columns=['TARGETID'], z_qso=None, forest_limits=None
 ):
     """Common function to read a single FITS file in DESI healpix grouping.
 
@@ -372,6 +963,13 @@ def _read_onehealpix_file(
         Columns to read from FIBERMAP. For coadded files, it should be
         ``['TARGETID']``. For uncoadded files (spectra-), you should read at
         least ``[TARGETID, PETAL_LOC, FIBER, NIGHT, EXPID, TILEID]``.
+    z_qso: :external+numpy:py:class:`ndarray <numpy.ndarray>`, default: None
+        Redshifts in the same order as ``targetids_by_survey``. Needed for
+        ``forest_limits``.
+    forest_limits: tuple(float), default: None
+        ``(w1, w2, lya1, lya2)``. If set, reads only the pixel windows from
+        :func:`_get_forest_windows` into lists of arrays, and the first
+        pixel of each window into ``data['pix0']``.
 
     Returns
     ---------
@@ -404,7 +1002,15 @@ def _read_onehealpix_file(
 
     idx_fbr = np.nonzero(np.isin(fbrmap['TARGETID'], targetids_by_survey))[0]
     targetids_fbr = fbrmap['TARGETID'][idx_fbr]
-    idx_fbr = idx_fbr[targetids_fbr.argsort()]
+    isort = targetids_fbr.argsort()
+    idx_fbr = idx_fbr[isort]
+
+    if forest_limits is not None:
+        targetids_fbr = targetids_fbr[isort]
+        icat = np.argsort(targetids_by_survey)
+        icat = icat[np.searchsorted(
+            targetids_by_survey, targetids_fbr, sorter=icat)]
+        z_fbr = np.asarray(z_qso)[icat]
 
     data = {
         'wave': {},
@@ -414,29 +1020,60 @@ def _read_onehealpix_file(
         'reso': {}
     }
 
+    dtype = qsonic.spectrum.Spectrum._storage_dtype
     for arm in arms_to_keep:
         # Cannot read by rows= argument.
         data['wave'][arm] = fitsfile[f'{arm}_WAVELENGTH'].read()
-        nwave = data['wave'][arm].size
+
+        if forest_limits is not None:
+            _read_onehealpix_arm_windows(
+                fitsfile, arm, idx_fbr, z_fbr, forest_limits, skip_resomat,
+                data)
+            continue
 
         data['flux'][arm] = _read_imagehdu(
-            fitsfile[f'{arm}_FLUX'], idx_fbr, nwave)
+            fitsfile[f'{arm}_FLUX'], idx_fbr, dtype)
         data['ivar'][arm] = _read_imagehdu(
-            fitsfile[f'{arm}_IVAR'], idx_fbr, nwave)
+            fitsfile[f'{arm}_IVAR'], idx_fbr, dtype)
         data['mask'][arm] = _read_imagehdu(
-            fitsfile[f'{arm}_MASK'], idx_fbr, nwave)
+            fitsfile[f'{arm}_MASK'], idx_fbr)
 
         if skip_resomat or f'{arm}_RESOLUTION' not in fitsfile:
             continue
 
-        data['reso'][arm] = _read_resoimage(
-            fitsfile[f'{arm}_RESOLUTION'], idx_fbr, nwave)
+        data['reso'][arm] = _read_imagehdu(
+            fitsfile[f'{arm}_RESOLUTION'], idx_fbr, dtype)
 
     fitsfile.close()
 
     return data, idx_cat, fbrmap[idx_fbr]
 
 
+def _read_onehealpix_arm_windows(
+        fitsfile, arm, idx_fbr, z_fbr, forest_limits, skip_resomat, data
+):
+    """Reads forest windows of one arm into ``data``. See
+    :func:`_read_onehealpix_file`."""
+    dtype = qsonic.spectrum.Spectrum._storage_dtype
+    pix1, pix2_reso = _get_forest_windows(
+        data['wave'][arm], z_fbr, forest_limits)
+    pix2 = np.full_like(pix1, data['wave'][arm].size)
+
+    data.setdefault('pix0', {})[arm] = pix1
+    data['flux'][arm] = _read_imagehdu_windows(
+        fitsfile[f'{arm}_FLUX'], idx_fbr, pix1, pix2, dtype)
+    data['ivar'][arm] = _read_imagehdu_windows(
+        fitsfile[f'{arm}_IVAR'], idx_fbr, pix1, pix2, dtype)
+    data['mask'][arm] = _read_imagehdu_windows(
+        fitsfile[f'{arm}_MASK'], idx_fbr, pix1, pix2)
+
+    if skip_resomat or f'{arm}_RESOLUTION' not in fitsfile:
+        return
+
+    data['reso'][arm] = _read_imagehdu_windows(
+        fitsfile[f'{arm}_RESOLUTION'], idx_fbr, pix1, pix2_reso, dtype)
+
+
 def _read_onehealpix_file_onlyreso(
         targetids_by_survey, fspec, arms_to_keep, spectra_list
 ):
@@ -479,17 +1116,24 @@ def _read_onehealpix_file_onlyreso(
             f"healpix:{common_targetids.size}!", RuntimeWarning)
 
     for arm in arms_to_keep:
-        imhdu = fitsfile[f'{arm}_RESOLUTION']
-
+        # assert (common_targetids[jj] == spec.targetid)
+        specs_arm, rows = [], []
         for jj, spec in zip(idx_fbr, spectra_list):
-            # assert (common_targetids[jj] == spec.targetid)
+            if arm in spec.forestwave.keys():
+                specs_arm.append(spec)
+                rows.append(jj)
 
-            if arm not in spec.forestwave.keys():
-                continue
+        if not rows:
+            continue
 
-            f1 = spec._f1[arm]
-            f2 = spec._f2[arm]
-            spec._forestreso[arm] = imhdu[int(jj), :, f1:f2][0]
+        pix1 = np.array([spec._f1[arm] for spec in specs_arm])
+        pix2 = np.array([spec._f2[arm] for spec in specs_arm])
+        reso = _read_imagehdu_windows(
+            fitsfile[f'{arm}_RESOLUTION'], np.array(rows), pix1, pix2,
+            qsonic.spectrum.Spectrum._storage_dtype)
+
+        for spec, reso_arm in zip(specs_arm, reso):
+            spec._forestreso[arm] = reso_arm
 
     fitsfile.close()
 
@@ -497,7 +1141,8 @@ def _read_onehealpix_file_onlyreso(
 
 
 def read_onehealpix_file_data_coadd(
-        catalog_hpx, input_dir, arms_to_keep, skip_resomat, program="dark"
+        catalog_hpx, input_dir, arms_to_keep, skip_resomat, program="dark",
+        forest_limits=None
 ):
     """Read FITS files for all surveys needed for data.
 
@@ -513,6 +1158,8 @@ def read_onehealpix_file_data_coadd(
         If true, do not read resomat.
     program: str, default: "dark"
         Program.
+    forest_limits: tuple(float), default: None
+        Reads only forest windows if set. See :func:`_read_onehealpix_file`.
 
     Returns
     ---------
@@ -536,7 +1183,8 @@ def read_onehealpix_file_data_coadd(
         fspec = (f"{input_dir}/{survey}/{program}/{pixnum//100}/"
                  f"{pixnum}/coadd-{survey}-{program}-{pixnum}.fits")
         data, idx_cat, _ = _read_onehealpix_file(
-            cat_by_survey['TARGETID'], fspec, arms_to_keep, skip_resomat)
+            cat_by_survey['TARGETID'], fspec, arms_to_keep, skip_resomat,
+            z_qso=cat_by_survey['Z'], forest_limits=forest_limits)
 
         if idx_cat.size != cat_by_survey.size:
             cat_by_survey = cat_by_survey[idx_cat]
@@ -550,7 +1198,8 @@ def read_onehealpix_file_data_coadd(
 
 
 def read_onehealpix_file_data_uncoadd(
-        catalog_hpx, input_dir, arms_to_keep, skip_resomat, program="dark"
+        catalog_hpx, input_dir, arms_to_keep, skip_resomat, program="dark",
+        forest_limits=None
 ):
     """Read uncoadded spectra from FITS files for all surveys needed for data.
 
@@ -566,6 +1215,8 @@ def read_onehealpix_file_data_uncoadd(
         If true, do not read resomat.
     program: str, default: "dark"
         Program.
+    forest_limits: tuple(float), default: None
+        Reads only forest windows if set. See :func:`_read_onehealpix_file`.
 
     Returns
     ---------
@@ -586,7 +1237,8 @@ def read_onehealpix_file_data_uncoadd(
 
         data, idx_cat, fbrmap = _read_onehealpix_file(
             cat_by_survey['TARGETID'], fspec, arms_to_keep, skip_resomat,
-            ['TARGETID', 'PETAL_LOC', 'FIBER', 'NIGHT', 'EXPID', 'TILEID'])
+            ['TARGETID', 'PETAL_LOC', 'FIBER', 'NIGHT', 'EXPID', 'TILEID'],
+            cat_by_survey['Z'], forest_limits)
 
         if idx_cat.size != cat_by_survey.size:
             cat_by_survey = cat_by_survey[idx_cat]
@@ -606,7 +1258,8 @@ def read_onehealpix_file_data_uncoadd(
 
 
 def read_onetile_coaddfile_data(
-        catalog_tile, input_dir, arms_to_keep, skip_resomat
+        catalog_tile, input_dir, arms_to_keep, skip_resomat,
+        forest_limits=None
 ):
     """Read all petal coadd FITS files for a given tile.
 
@@ -620,6 +1273,8 @@ def read_onetile_coaddfile_data(
         Must only contain B, R and Z.
     skip_resomat: bool
         If true, do not read resomat.
+    forest_limits: tuple(float), default: None
+        Reads only forest windows if set. See :func:`_read_onehealpix_file`.
 
     Returns
     ---------
@@ -645,7 +1300,8 @@ def read_onetile_coaddfile_data(
         fspec = (f"{input_dir}/{tileid}/{lastnight}/"
                  f"coadd-{petal}-{tileid}-thru{lastnight}.fits")
         data, idx_cat, _ = _read_onehealpix_file(
-            cat_by_petal['TARGETID'], fspec, arms_to_keep, skip_resomat)
+            cat_by_petal['TARGETID'], fspec, arms_to_keep, skip_resomat,
+            z_qso=cat_by_petal['Z'], forest_limits=forest_limits)
 
         if idx_cat.size != cat_by_petal.size:
             cat_by_petal = cat_by_petal[idx_cat]
@@ -660,7 +1316,7 @@ def read_onetile_coaddfile_data(
 
 def read_onehealpix_file_mock(
         catalog_hpx, input_dir, arms_to_keep, skip_resomat,
-        read_true_continuum, nside=16
+        read_true_continuum, nside=16, forest_limits=None
 ):
     """ Read a single FITS file for mocks.
 
@@ -678,6 +1334,10 @@ def read_onehealpix_file_mock(
         If true, reads the true continuum for mock analysis.
     nside: int, default: 16
         NSIDE for healpix.
+    forest_limits: tuple(float), default: None
+        Reads only forest windows if set. See :func:`_read_onehealpix_file`.
+        Resolution matrices of mocks are common to all quasars and read
+        fully.
 
     Returns
     ---------
@@ -691,7 +1351,8 @@ def read_onehealpix_file_mock(
     pixnum = catalog_hpx['HPXPIXEL'][0]
     fspec = f"{input_dir}/{pixnum//100}/{pixnum}/spectra-{nside}-{pixnum}.fits"
     data, idx_cat, _ = _read_onehealpix_file(
-        catalog_hpx['TARGETID'], fspec, arms_to_keep, skip_resomat)
+        catalog_hpx['TARGETID'], fspec, arms_to_keep, skip_resomat,
+        z_qso=catalog_hpx['Z'], forest_limits=forest_limits)
 
     if idx_cat.size != catalog_hpx.size:
         catalog_hpx = catalog_hpx[idx_cat]
@@ -18,6 +18,66 @@ sqrt_2 = 1.41421356237
 """float: Square root of 2."""
 
 
+def _get_range_mask(wave, wave_min, wave_max, group=None, range_group=None):
+    """ Returns True for pixels in any of ``wave_min <= wave < wave_max``
+    ranges. Number of ranges that contain a pixel is the number of
+    ``wave_min`` minus the number of ``wave_max`` not above it.
+
+    If ``group`` and ``range_group`` are given, ranges only apply to pixels
+    of the same group (e.g. spectrum). Pixels and range limits are then
+    compared as (group, wave) pairs, so ranges of other groups cancel out.
+
+    Arguments
+    ---------
+    wave: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Wavelength of pixels.
+    wave_min: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Lower limits of ranges.
+    wave_max: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Upper limits of ranges.
+    group: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+        Group index of pixels.
+    range_group: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+        Group index of ranges.
+
+    Returns
+    -------
+    w: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Bool array. True for masked pixels.
+    """
+    w = wave_min < wave_max
+    if group is None:
+        pixels, lower, upper = wave, wave_min[w], wave_max[w]
+    else:
+        dtype = [('group', 'i8'), ('wave', 'f8')]
+
+        def _pairs(g, x):
+            pairs = np.empty(x.size, dtype=dtype)
+            pairs['group'] = g
+            pairs['wave'] = x
+            return pairs
+
+        pixels = _pairs(group, wave)
+        lower = _pairs(range_group[w], wave_min[w])
+        upper = _pairs(range_group[w], wave_max[w])
+
+    nmin = np.searchsorted(np.sort(lower), pixels, side='right')
+    nmax = np.searchsorted(np.sort(upper), pixels, side='right')
+    return nmin > nmax
+
+
+def _get_pixel_spec_index(batch):
+    """ Spectrum index of every pixel in a SpectraBatch."""
+    return np.repeat(batch.spec_index, batch.segment_sizes)
+
+
+def _concatenate_ranges(starts, stops):
+    """ Concatenation of ``np.arange(start, stop)`` for each pair."""
+    sizes = stops - starts
+    return (np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+            + np.arange(sizes.sum()))
+
+
 def add_mask_parser(parser=None):
     """ Adds masking related arguments to parser. These arguments are grouped
     under 'Masking options'.
@@ -104,6 +164,24 @@ class SkyMask():
             spec.forestflux[arm][w] = 0
             spec.forestivar[arm][w] = 0
 
+    def apply_batch(self, batch):
+        """ Apply the mask to all spectra in a batch at once by setting
+        **only** ``forestivar`` and ``forestflux`` to zero.
+
+        Arguments
+        ----------
+        batch: SpectraBatch
+            Bound SpectraBatch object to mask.
+        """
+        w = _get_range_mask(
+            batch.wave, self.mask_obs_frame['wave_min'],
+            self.mask_obs_frame['wave_max'])
+        w |= _get_range_mask(
+            batch.get_wave_rf(), self.mask_rest_frame['wave_min'],
+            self.mask_rest_frame['wave_max'])
+
+        batch.mask(w)
+
 
 class BALMask():
     """ BAL masking object.
@@ -153,51 +231,87 @@ class BALMask():
             raise QsonicException("Input catalog is missing BAL columns.")
 
     @staticmethod
-    def apply(spec):
-        """ Apply the mask by setting **only** ``spec.forestivar`` and
-        ``spec.forestflux`` to zero.
+    def get_ranges(spec):
+        """ Observed wavelength ranges to mask for a spectrum.
 
         Arguments
         ----------
         spec: Spectrum
-            Spectrum object to mask.
+            Spectrum object.
+
+        Returns
+        -------
+        wave_min: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Lower limits of ranges.
+        wave_max: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Upper limits of ranges. Empty if there is no BAL.
         """
         min_velocities = np.concatenate(
             (spec.catrow['VMIN_CIV_450'], spec.catrow['VMIN_CIV_2000']))
         max_velocities = np.concatenate(
             (spec.catrow['VMAX_CIV_450'], spec.catrow['VMAX_CIV_2000']))
         w = (min_velocities > 0) & (max_velocities > 0)
-        min_velocities = min_velocities[w]
-        max_velocities = max_velocities[w]
-        num_velocities = min_velocities.size
-
-        if num_velocities == 0:
-            return
+        min_velocities = 1 - min_velocities[w] / LIGHT_SPEED
+        max_velocities = 1 - max_velocities[w] / LIGHT_SPEED
 
         bal_obs_lines = BALMask.lines['value'] * (1 + spec.z_qso)
-        min_velocities = 1 - min_velocities / LIGHT_SPEED
-        max_velocities = 1 - max_velocities / LIGHT_SPEED
+        wave1 = np.outer(bal_obs_lines, max_velocities).ravel()
+        wave2 = np.outer(bal_obs_lines, min_velocities).ravel()
+
+        # Make sure the first limit comes before the second
+        return np.minimum(wave1, wave2), np.maximum(wave1, wave2)
+
+    @staticmethod
+    def apply(spec):
+        """ Apply the mask by setting **only** ``spec.forestivar`` and
+        ``spec.forestflux`` to zero.
 
-        mask = np.empty(num_velocities * BALMask.lines.size,
-                        dtype=[('wave_min', 'f8'), ('wave_max', 'f8')])
-        mask['wave_min'] = np.outer(bal_obs_lines, max_velocities).ravel()
-        mask['wave_max'] = np.outer(bal_obs_lines, min_velocities).ravel()
+        Arguments
+        ----------
+        spec: Spectrum
+            Spectrum object to mask.
+        """
+        wave_min, wave_max = BALMask.get_ranges(spec)
+
+        if wave_min.size == 0:
+            return
 
         for arm, wave_arm in spec.forestwave.items():
             w = np.zeros(wave_arm.size, dtype=bool)
 
             mask_idx_ranges = np.searchsorted(
-                wave_arm,
-                [mask['wave_min'], mask['wave_max']]
-            ).T
-            # Make sure first index comes before the second
-            mask_idx_ranges.sort(axis=1)
+                wave_arm, [wave_min, wave_max]).T
             for idx1, idx2 in mask_idx_ranges:
                 w[idx1:idx2] = 1
 
             spec.forestflux[arm][w] = 0
             spec.forestivar[arm][w] = 0
 
+    @staticmethod
+    def apply_batch(batch):
+        """ Apply the mask to all spectra in a batch at once by setting
+        **only** ``forestivar`` and ``forestflux`` to zero. Ranges of each
+        spectrum only mask its own pixels. See :meth:`apply`.
+
+        Arguments
+        ----------
+        batch: SpectraBatch
+            Bound SpectraBatch object to mask.
+        """
+        ranges = [BALMask.get_ranges(spec) for spec in batch.spectra]
+        range_spec_index = np.repeat(
+            np.arange(batch.nspec), [r[0].size for r in ranges])
+
+        if range_spec_index.size == 0:
+            return
+
+        w = _get_range_mask(
+            batch.wave, np.concatenate([r[0] for r in ranges]),
+            np.concatenate([r[1] for r in ranges]),
+            _get_pixel_spec_index(batch), range_spec_index)
+
+        batch.mask(w)
+
 
 class DLAMask():
     """ DLA masking object.
@@ -460,3 +574,56 @@ class DLAMask():
             spec.forestflux[arm][w] = 0
             spec.forestflux[arm] /= transmission
             spec.forestivar[arm] *= transmission**2
+
+    def apply_batch(self, batch):
+        """ Apply the mask to all spectra in a batch at once. Transmission of
+        every DLA is evaluated on the pixels of its spectrum, and only the
+        pixels of spectra with DLAs are modified. See :meth:`apply`.
+
+        Arguments
+        ----------
+        batch: SpectraBatch
+            Bound SpectraBatch object to mask.
+        """
+        if self.unique_targetids.size == 0:
+            return
+
+        targetids = np.array(
+            [spec.targetid for spec in batch.spectra], dtype=np.int64)
+        idx = np.searchsorted(self.unique_targetids, targetids)
+        idx[idx == self.unique_targetids.size] = 0
+        ispec = np.nonzero(self.unique_targetids[idx] == targetids)[0]
+
+        if ispec.size == 0:
+            return
+
+        # Pixels of spectra with DLAs
+        starts = batch.offsets[batch.spec_offsets[ispec]]
+        stops = batch.offsets[batch.spec_offsets[ispec + 1]]
+        pixels = _concatenate_ranges(starts, stops)
+        wave = batch.wave[pixels]
+
+        # Each DLA is evaluated on the pixels of its spectrum
+        dlas = [self.split_catalog[i] for i in idx[ispec]]
+        ndlas = np.array([spec_dlas.size for spec_dlas in dlas])
+        local_stops = np.cumsum(stops - starts)
+        local_starts = local_stops - (stops - starts)
+        local_pixels = _concatenate_ranges(
+            np.repeat(local_starts, ndlas), np.repeat(local_stops, ndlas))
+        dla_sizes = np.repeat(stops - starts, ndlas)
+        dlas = np.concatenate(dlas)
+
+        transmission = np.ones(wave.size)
+        np.multiply.at(
+            transmission, local_pixels, DLAMask.get_dla_flux(
+                wave[local_pixels], np.repeat(dlas['Z_DLA'], dla_sizes),
+                np.repeat(dlas['NHI'], dla_sizes)))
+        # Turn off DLA correction for l_rf > l_lya
+        z_qso = np.repeat(batch.z_qso[ispec], stops - starts)
+        transmission[wave >= (1 + z_qso) * DLAMask.wave_lya_A] = 1
+        w = transmission < self.dla_mask_limit
+        transmission[w] = 1
+
+        batch.mask(pixels[w])
+        batch.flux[pixels] /= transmission
+        batch.ivar[pixels] *= transmission**2
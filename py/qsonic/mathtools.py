@@ -105,6 +105,11 @@ def _spline_cubic_notaknot(fp, dxp):
     """
     N = fp.size
     y2p = np.empty(N)
+    # Single parabola through three points has a constant second derivative
+    if N == 3:
+        y2p[:] = (fp[0] - 2 * fp[1] + fp[2]) / dxp**2
+        return y2p
+
     # Solve the submatrix 1:-1 using precalculated u and p values
     u = np.array([
         6.000000000000000000e+00, 4.000000000000000000e+00,
@@ -350,6 +355,12 @@ class FastLinear1DInterp():
         Copy input data, specifically fp.
     ep: :external+numpy:py:class:`ndarray <numpy.ndarray>`, optional
         Error on fp points. Not used! Bookkeeping purposes only.
+
+    Attributes
+    ----------
+    version: int
+        Incremented by every :meth:`reset` call. Consumers that cache
+        interpolated values can compare this to invalidate their caches.
     """
 
     def __init__(self, xp0, dxp, fp, copy=False, ep=None):
@@ -360,6 +371,7 @@ class FastLinear1DInterp():
         else:
             self.fp = fp
         self.ep = ep
+        self.version = 0
 
     def __call__(self, x):
         return _fast_eval_interp1d_lin(x, self.xp0, self.dxp, self.fp)
@@ -371,6 +383,7 @@ class FastLinear1DInterp():
             self.fp = fp
 
         self.ep = ep
+        self.version += 1
 
 
 class FastCubic1DInterp():
@@ -396,6 +409,12 @@ class FastCubic1DInterp():
     bc_type: str, default: 'not-a-knot'
         Boundary condition type. Other option is 'natural'. See
         :external+scipy:py:class:`scipy.interpolate.CubicSpline`.
+
+    Attributes
+    ----------
+    version: int
+        Incremented by every :meth:`reset` call. Consumers that cache
+        interpolated values can compare this to invalidate their caches.
     """
 
     def __init__(
@@ -417,6 +436,7 @@ class FastCubic1DInterp():
             raise Exception("Unknown bc_type in FastCubic1DInterp.")
 
         self.ep = ep
+        self.version = 0
 
     def __call__(self, x):
         return _fast_eval_interp1d_cubic(
@@ -429,6 +449,7 @@ class FastCubic1DInterp():
             self.fp = fp
 
         self.ep = ep
+        self.version += 1
 
         if self._bc_type == 'not-a-knot':
             self._y2p = _spline_cubic_notaknot(fp, self.dxp)
@@ -466,6 +487,9 @@ class SubsampleCov():
         Number of samples. You can add more measurements then this.
     istart: int, default: 0
         Start index for the subsampling array
+    dtype: :external+numpy:py:class:`dtype <numpy.dtype>`, default: float64
+        Storage type of measurements and weights. Weights are stored once for
+        each sample and shared by all sets.
 
     Attributes
     ----------
@@ -489,7 +513,7 @@ class SubsampleCov():
         shape ``(nblock, blockdim, blockdim)``.
     """
 
-    def __init__(self, ndata, nsamples, istart=0):
+    def __init__(self, ndata, nsamples, istart=0, dtype=np.float64):
         self.nsamples = nsamples
         self._istart = istart % nsamples
         self._isample = self._istart
@@ -503,8 +527,8 @@ class SubsampleCov():
         else:
             raise QsonicException("ndata must be int or tuple of ints.")
 
-        self.all_measurements = np.zeros(newshape)
-        self.all_weights = np.zeros((nsamples, 1, self.ndata))
+        self.all_measurements = np.zeros(newshape, dtype=dtype)
+        self.all_weights = np.zeros((nsamples, 1, self.ndata), dtype=dtype)
         self._is_normalized = False
 
         self.mean = None
@@ -543,6 +567,72 @@ class SubsampleCov():
         self.all_weights[self._isample, 0, :] += wvec
         self._isample = (self._isample + 1) % self.nsamples
 
+    def reserve_samples(self, nmeasurements):
+        """ Reserves sample indices for the next ``nmeasurements``
+        measurements in the same order as :meth:`add_measurement`. The caller
+        adds these measurements directly into :attr:`all_measurements` and
+        :attr:`all_weights`, which avoids creating a data vector for each
+        measurement.
+
+        Arguments
+        ---------
+        nmeasurements: int
+            Number of measurements.
+
+        Returns
+        -------
+        isamples: :class:`ndarray <numpy.ndarray>`
+            Sample indices of measurements.
+
+        Raises
+        ---------
+        RuntimeError
+            If the object is normalized.
+        """
+        if self._is_normalized:
+            raise RuntimeError(
+                "SubsampleCov has already been normalized. "
+                "You cannot add more measurements.")
+
+        isamples = (self._isample + np.arange(nmeasurements)) % self.nsamples
+        self._isample = (self._isample + nmeasurements) % self.nsamples
+
+        return isamples
+
+    def take(self, keep=None, dtype=None):
+        """Returns a new subsampler with a subset of data bins, e.g. only the
+        populated bins, so that the Jackknife statistics are calculated on
+        smaller arrays. Measurements and weights are copied.
+
+        Arguments
+        ---------
+        keep: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Bool array of size ``ndata`` for the bins to keep. None keeps all
+            bins.
+        dtype: :external+numpy:py:class:`dtype <numpy.dtype>` or None
+            Storage type of the new subsampler. None keeps the same type.
+
+        Returns
+        -------
+        SubsampleCov
+            New subsampler.
+        """
+        if keep is None:
+            keep = np.ones(self.ndata, dtype=bool)
+        if dtype is None:
+            dtype = self.all_measurements.dtype
+
+        nset = self.all_measurements.shape[1]
+        new = SubsampleCov((nset, 0), self.nsamples, self._istart, dtype)
+        new.ndata = np.count_nonzero(keep)
+        new.all_measurements = self.all_measurements[:, :, keep].astype(
+            dtype, copy=False)
+        new.all_weights = self.all_weights[:, :, keep].astype(
+            dtype, copy=False)
+        new._isample = self._isample
+
+        return new
+
     def allreduce(self, comm, inplace):
         """Sums statistics from all MPI process.
 
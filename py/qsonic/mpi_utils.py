@@ -1,7 +1,9 @@
 import logging
+import time
 
 import fitsio
 import numpy as np
+from scipy.optimize import nnls
 
 from qsonic import QsonicException
 
@@ -107,8 +109,14 @@ def mpi_fnc_bcast(fnc, comm=None, mpi_rank=0, err_msg="", *args, **kwargs):
     return result
 
 
-def balance_load(split_catalog, mpi_size):
-    """Load balancing function. The return value can be scattered.
+def _catalog_size(cat):
+    return cat.size
+
+
+def balance_load(split_catalog, mpi_size, cost_function=None):
+    """Load balancing function. The return value can be scattered. Catalogs
+    are sorted by cost in descending order and each is assigned to the rank
+    with the lowest total cost.
 
     Arguments
     ---------
@@ -116,23 +124,481 @@ def balance_load(split_catalog, mpi_size):
         List of catalog. Each element is a ndarray with the same healpix.
     mpi_size: int
         Number of MPI tasks running.
+    cost_function: Callable or None, default: None
+        Estimated cost of a catalog, e.g. :class:`LoadCostModel`. None uses
+        the number of spectra.
 
     Returns
     ---------
     local_queue: list(list(:external+numpy:py:class:`ndarray <numpy.ndarray>`))
         Spectra that ranks are reponsible for in ``split_catalog`` format.
     """
-    number_of_spectra = np.zeros(mpi_size, dtype=int)
+    if cost_function is None:
+        cost_function = _catalog_size
+
+    total_cost = np.zeros(mpi_size)
     local_queues = [[] for _ in range(mpi_size)]
-    split_catalog.sort(key=lambda x: x.size, reverse=True)  # Descending order
+    costs = {id(cat): cost_function(cat) for cat in split_catalog}
+    # Descending order
+    split_catalog.sort(key=lambda x: costs[id(x)], reverse=True)
     for cat in split_catalog:
-        min_idx = np.argmin(number_of_spectra)
-        number_of_spectra[min_idx] += cat.size
+        min_idx = np.argmin(total_cost)
+        total_cost[min_idx] += costs[id(cat)]
         local_queues[min_idx].append(cat)
 
     return local_queues
 
 
+def get_redistribution_plan(loads):
+    """Plan to equalize loads by moving them from ranks above the mean to
+    ranks below the mean. Largest surpluses are matched with largest
+    deficits first, so that the number of messages is small.
+
+    Arguments
+    ---------
+    loads: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Load of each rank, e.g. number of forest pixels.
+
+    Returns
+    -------
+    plan: list(tuple(int, int, float))
+        ``(source, destination, amount)`` for each move.
+    """
+    excess = np.asarray(loads, dtype=float) - np.mean(loads)
+    senders = [r for r in np.argsort(excess)[::-1] if excess[r] > 0]
+    receivers = [r for r in np.argsort(excess) if excess[r] < 0]
+
+    plan = []
+    i, j = 0, 0
+    while i < len(senders) and j < len(receivers):
+        src, dest = senders[i], receivers[j]
+        amount = min(excess[src], -excess[dest])
+        plan.append((int(src), int(dest), amount))
+        excess[src] -= amount
+        excess[dest] += amount
+        if excess[src] <= 0:
+            i += 1
+        if excess[dest] >= 0:
+            j += 1
+
+    return plan
+
+
+def mpi_exchange_arrays(send_arrays, comm):
+    """Sends dictionaries of arrays to other ranks as raw buffers. Only dtypes
+    and shapes are pickled. Every rank must call this function. Sends are
+    nonblocking, so any rank can send to and receive from any other rank.
+
+    Arguments
+    ---------
+    send_arrays: dict(int, dict(:external+numpy:py:class:`ndarray \
+            <numpy.ndarray>`))
+        Arrays to send keyed by the destination rank.
+    comm: MPI.COMM_WORLD
+        MPI comm object.
+
+    Returns
+    -------
+    recv_arrays: dict(int, dict(:external+numpy:py:class:`ndarray \
+            <numpy.ndarray>`))
+        Received arrays keyed by the source rank.
+    """
+    from mpi4py import MPI
+
+    mpi_size = comm.Get_size()
+    has_data = comm.alltoall(
+        [dest in send_arrays for dest in range(mpi_size)])
+
+    requests, buffers = [], []
+    for dest, arrays in send_arrays.items():
+        arrays = {key: np.ascontiguousarray(arr)
+                  for key, arr in arrays.items()}
+        meta = [(key, np.lib.format.dtype_to_descr(arr.dtype), arr.shape)
+                for key, arr in arrays.items()]
+        requests.append(comm.isend(meta, dest))
+        for arr in arrays.values():
+            buf = arr.reshape(-1).view(np.uint8)
+            buffers.append(buf)
+            requests.append(comm.Isend([buf, MPI.BYTE], dest))
+
+    recv_arrays = {}
+    for source in range(mpi_size):
+        if not has_data[source]:
+            continue
+
+        arrays = {}
+        for key, descr, shape in comm.recv(source=source):
+            dtype = np.lib.format.descr_to_dtype(descr)
+            buf = np.empty(dtype.itemsize * int(np.prod(shape)), np.uint8)
+            comm.Recv([buf, MPI.BYTE], source)
+            arrays[key] = buf.view(dtype).reshape(shape)
+        recv_arrays[source] = arrays
+
+    MPI.Request.Waitall(requests)
+
+    return recv_arrays
+
+
+class PackedIallreduce():
+    """Sums arrays over all MPI processes with nonblocking ``Iallreduce``
+    calls instead of a blocking ``Allreduce`` for each array. Small arrays are
+    copied into a single packed float64 buffer on construction, and the sums
+    are copied back into the arrays by :meth:`wait`. Integer arrays are summed
+    exactly as long as the sums are smaller than 2^53. Large floating point
+    arrays are reduced in place with their own requests, since packing them
+    only doubles their memory. Every rank must construct this object with
+    arrays of the same shapes in the same order. Without a comm object,
+    arrays are left as they are.
+
+    Usage::
+
+        reduction = PackedIallreduce([counts, stacked_flux], comm)
+        # Local work that does not need the sums
+        reduction.wait()
+
+    Parameters
+    ----------
+    arrays: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Arrays to sum in place.
+    comm: MPI.COMM_WORLD or None
+        MPI comm object.
+    inplace_size: int, default: 2**20
+        Contiguous floating point arrays of at least this size are not
+        packed.
+
+    Attributes
+    ----------
+    overlap_time: float
+        Time between the start of the reduction and :meth:`wait` in seconds,
+        i.e. local work done while the reduction is in flight.
+    wait_time: float
+        Time spent waiting for the reduction in :meth:`wait` in seconds.
+    """
+
+    def __init__(self, arrays, comm, inplace_size=2**20):
+        self.overlap_time = 0
+        self.wait_time = 0
+        self._requests = []
+
+        if comm is None:
+            return
+
+        from mpi4py import MPI
+
+        self._packed = []
+        for arr in arrays:
+            if (arr.size >= inplace_size and arr.dtype.kind == 'f'
+                    and arr.flags.c_contiguous):
+                self._requests.append(comm.Iallreduce(MPI.IN_PLACE, arr))
+            else:
+                self._packed.append(arr)
+
+        self._offsets = np.append(0, np.cumsum(
+            [arr.size for arr in self._packed]))
+        self._buffer = np.empty(self._offsets[-1])
+        for i, arr in enumerate(self._packed):
+            self._buffer[self._offsets[i]:self._offsets[i + 1]] = arr.ravel()
+
+        self._requests.append(comm.Iallreduce(MPI.IN_PLACE, self._buffer))
+        self._start_time = time.time()
+
+    def wait(self):
+        """Waits for the reduction to complete and copies the sums back into
+        the packed arrays. Calling this more than once has no effect.
+
+        Returns
+        -------
+        wait_time: float
+            Time spent waiting in seconds.
+        """
+        if not self._requests:
+            return self.wait_time
+
+        from mpi4py import MPI
+
+        t1 = time.time()
+        self.overlap_time = t1 - self._start_time
+        MPI.Request.Waitall(self._requests)
+        self.wait_time = time.time() - t1
+        self._requests = []
+
+        for i, arr in enumerate(self._packed):
+            np.copyto(
+                arr,
+                self._buffer[self._offsets[i]:self._offsets[i + 1]].reshape(
+                    arr.shape),
+                casting='unsafe')
+        self._packed, self._buffer = [], None
+
+        return self.wait_time
+
+
+class LoadCostModel():
+    """Estimated cost of reading a catalog of one healpix (or tile) file for
+    :func:`balance_load`::
+
+        cost = file_cost + quasar_cost * N_qso + pixel_cost * N_pix,
+
+    where ``N_pix`` is the estimated number of forest pixels from ``Z`` and
+    the wavelength limits. Default coefficients are in units of the cost of
+    reading one quasar. Use :meth:`from_args` with a timing log to calibrate
+    them in seconds from a previous run.
+
+    The timing log records read times only, so the calibration covers I/O.
+    Continuum fitting is balanced separately by moving spectra between
+    ranks after reading (``--redistribute-spectra``).
+
+    Parameters
+    ----------
+    wave1, wave2: float
+        Observed wavelength limits in A.
+    forest_w1, forest_w2: float
+        Rest-frame forest limits in A.
+    dwave: float, default: 0.8
+        Observed wavelength spacing in A.
+    file_cost: float, default: 50
+        Cost per file, e.g. opening and reading the fibermap.
+    quasar_cost: float, default: 1
+        Cost per quasar.
+    pixel_cost: float, default: 0.01
+        Cost per forest pixel.
+    """
+    _reso_pixel_factor = 4
+    """int: Default ``pixel_cost`` is multiplied by this if resolution
+    matrices are read."""
+    _log_columns = ['NQSO', 'NPIX', 'TIME']
+    """list(str): Required columns in the timing log."""
+
+    def __init__(
+            self, wave1, wave2, forest_w1, forest_w2, dwave=0.8,
+            file_cost=50., quasar_cost=1., pixel_cost=0.01
+    ):
+        self.wave1 = wave1
+        self.wave2 = wave2
+        self.forest_w1 = forest_w1
+        self.forest_w2 = forest_w2
+        self.dwave = dwave
+        self.file_cost = file_cost
+        self.quasar_cost = quasar_cost
+        self.pixel_cost = pixel_cost
+
+    def get_forest_pixels(self, z_qso):
+        """Estimated number of forest pixels.
+
+        Arguments
+        ---------
+        z_qso: float or :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Quasar redshifts.
+
+        Returns
+        -------
+        npix: float or :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        """
+        w1 = np.maximum(self.wave1, self.forest_w1 * (1 + z_qso))
+        w2 = np.minimum(self.wave2, self.forest_w2 * (1 + z_qso))
+        return np.clip(w2 - w1, 0, None) / self.dwave
+
+    def __call__(self, cat):
+        """Estimated cost of a catalog with ``Z`` column.
+
+        Arguments
+        ---------
+        cat: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Catalog of one file.
+
+        Returns
+        -------
+        cost: float
+        """
+        npix = self.get_forest_pixels(cat['Z']).sum()
+        return (self.file_cost + self.quasar_cost * cat.size
+                + self.pixel_cost * npix)
+
+    def fit(self, nqso, npix, time):
+        """Fits cost coefficients to measured times by non-negative least
+        squares.
+
+        Arguments
+        ---------
+        nqso: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Number of quasars in each file.
+        npix: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Estimated number of forest pixels in each file.
+        time: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Time spent for each file.
+
+        Raises
+        ------
+        QsonicException
+            If there are fewer than three measurements or all coefficients
+            are zero.
+        """
+        if len(time) < 3:
+            raise QsonicException(
+                "Timing log needs at least three files to calibrate.")
+
+        design = np.column_stack((np.ones(len(time)), nqso, npix))
+        coeffs = nnls(design, np.asarray(time, dtype=float))[0]
+        if not np.any(coeffs > 0):
+            raise QsonicException("Cost model calibration failed.")
+
+        self.file_cost, self.quasar_cost, self.pixel_cost = coeffs
+
+    @staticmethod
+    def read_timing_log(fname):
+        """Reads ``NQSO, NPIX, TIME`` columns of a timing log saved by
+        :func:`qsonic.scripts.qsonic_fit.save_timing_log`.
+
+        Arguments
+        ---------
+        fname: str
+            Filename.
+
+        Returns
+        -------
+        data: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        """
+        with fitsio.FITS(fname) as fts:
+            data = fts['TIMING'].read(columns=LoadCostModel._log_columns)
+
+        return data
+
+    @classmethod
+    def from_args(cls, args, timing_log=None):
+        """Cost model for the wavelength limits in ``args``. Pixel cost is
+        higher if resolution matrices are read. Coefficients are calibrated
+        if ``timing_log`` is passed.
+
+        Arguments
+        ---------
+        args: argparse.Namespace
+            Options passed to script. Needs ``wave1, wave2, forest_w1,
+            forest_w2, skip_resomat``.
+        timing_log: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Timing log data. See :meth:`read_timing_log`.
+
+        Returns
+        -------
+        LoadCostModel
+        """
+        model = cls(args.wave1, args.wave2, args.forest_w1, args.forest_w2)
+        if not args.skip_resomat:
+            model.pixel_cost *= cls._reso_pixel_factor
+
+        if timing_log is not None:
+            model.fit(
+                timing_log['NQSO'], timing_log['NPIX'], timing_log['TIME'])
+
+        return model
+
+
+class DynamicQueue():
+    """Hands out catalogs to MPI ranks as they finish reading. Catalogs are
+    split into contiguous chunks of roughly equal cost, one for each rank, so
+    that each rank mostly reads neighbouring pixels. A rank that finishes its
+    chunk steals the next catalogs of the chunk with the most remaining
+    catalogs. Next indices of chunks are kept on the master node and
+    incremented with one-sided atomic operations (``MPI.Win``), so no rank
+    waits for a master process. Iterating is not collective, but
+    :meth:`close` is.
+
+    Parameters
+    ----------
+    split_catalog: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Catalogs of each healpix (or tile) sorted by pixel. Must be the same
+        on all ranks.
+    comm: MPI.COMM_WORLD
+        MPI comm object.
+    cost_function: Callable or None, default: None
+        Estimated cost of a catalog to split chunks, e.g.
+        :class:`LoadCostModel`. None uses the number of spectra.
+
+    Attributes
+    ----------
+    split_catalog: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        All catalogs.
+    local_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Catalogs this rank received so far.
+    nstolen: int
+        Number of catalogs this rank took from other chunks.
+    """
+
+    def __init__(self, split_catalog, comm, cost_function=None):
+        from mpi4py import MPI
+
+        if cost_function is None:
+            cost_function = _catalog_size
+
+        self.split_catalog = split_catalog
+        self.local_queue = []
+        self.nstolen = 0
+        self._mpi_rank = comm.Get_rank()
+        mpi_size = comm.Get_size()
+
+        costs = np.cumsum([cost_function(cat) for cat in split_catalog])
+        if costs.size > 0:
+            edges = np.searchsorted(
+                costs, costs[-1] * np.arange(1, mpi_size) / mpi_size,
+                side='right')
+        else:
+            edges = np.zeros(mpi_size - 1, dtype=int)
+        edges = np.concatenate(([0], edges, [len(split_catalog)]))
+        self._ends = edges[1:]
+
+        itemsize = MPI.INT64_T.Get_size()
+        nbytes = itemsize * mpi_size if self._mpi_rank == 0 else 0
+        self._win = MPI.Win.Allocate(nbytes, itemsize, comm=comm)
+        if self._mpi_rank == 0:
+            self._win.Lock(0, MPI.LOCK_EXCLUSIVE)
+            np.frombuffer(self._win, dtype=np.int64)[:] = edges[:-1]
+            self._win.Unlock(0)
+        comm.Barrier()
+
+        self._op_sum = MPI.SUM
+        self._op_noop = MPI.NO_OP
+        self._lock_shared = MPI.LOCK_SHARED
+
+    def _fetch_and_add(self, chunk, value=1):
+        result = np.zeros(1, dtype=np.int64)
+        self._win.Lock(0, self._lock_shared)
+        self._win.Fetch_and_op(
+            np.array([value], dtype=np.int64), result, 0, chunk,
+            self._op_sum)
+        self._win.Unlock(0)
+        return result[0]
+
+    def _find_victim(self):
+        """Chunk with the most remaining catalogs. None if all are done."""
+        nexts = np.zeros(self._ends.size, dtype=np.int64)
+        self._win.Lock(0, self._lock_shared)
+        self._win.Get_accumulate(
+            np.zeros_like(nexts), nexts, 0, op=self._op_noop)
+        self._win.Unlock(0)
+
+        remaining = self._ends - nexts
+        victim = np.argmax(remaining)
+        if remaining[victim] <= 0:
+            return None
+        return victim
+
+    def __iter__(self):
+        chunk = self._mpi_rank
+        while chunk is not None:
+            idx = self._fetch_and_add(chunk)
+            if idx >= self._ends[chunk]:
+                chunk = self._find_victim()
+                continue
+
+            cat = self.split_catalog[idx]
+            self.local_queue.append(cat)
+            self.nstolen += int(chunk != self._mpi_rank)
+            yield cat
+
+    def close(self):
+        """Frees the MPI window. Collective."""
+        self._win.Free()
+
+
 class MPISaver():
     """ A simple class to write to a FITS file on master node.
 
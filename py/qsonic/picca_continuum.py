@@ -12,8 +12,8 @@ from scipy.special import legendre
 from mpi4py import MPI
 
 from qsonic import QsonicException
-from qsonic.spectrum import valid_spectra
-from qsonic.mpi_utils import mpi_fnc_bcast, MPISaver
+from qsonic.spectrum import pack_spectra_batches, valid_spectra
+from qsonic.mpi_utils import mpi_fnc_bcast, MPISaver, PackedIallreduce
 from qsonic.mathtools import (
     block_covariance_of_square,
     FastLinear1DInterp, FastCubic1DInterp,
@@ -43,6 +43,20 @@ def add_picca_continuum_parser(parser=None):
     cont_group.add_argument(
         "--num-iterations", type=int, default=10,
         help="Number of iterations for continuum fitting.")
+    cont_group.add_argument(
+        "--subsample-fraction", type=float, default=1.,
+        help=("Fit a random subsample of this fraction of spectra in the "
+              "first iteration. The fraction is multiplied by "
+              "--subsample-growth every iteration. The full sample is fit "
+              "once the subsample has converged and in the last iteration."))
+    cont_group.add_argument(
+        "--subsample-growth", type=float, default=2.,
+        help="Growth factor of the subsample fraction per iteration.")
+    cont_group.add_argument(
+        "--freeze-varlss", action="store_true",
+        help=("Stop fitting var_lss and eta once they have converged. "
+              "Iterations then converge only when var_lss and eta have "
+              "converged too."))
     cont_group.add_argument(
         "--continuum-model", choices=["picca", "true", "input"],
         default="picca",
@@ -68,6 +82,13 @@ def add_picca_continuum_parser(parser=None):
     cont_group.add_argument(
         "--var-use-cov", action="store_true",
         help="Use covariance in varlss-eta fitting.")
+    cont_group.add_argument(
+        "--var-subsample-dtype", default="float64",
+        choices=["float64", "float32"],
+        help=("Floating point type to store Jackknife subsamples in "
+              "varlss-eta fitting. Each spectrum is summed in float64 before "
+              "it is added to a subsample, and statistics are calculated in "
+              "float64."))
     cont_group.add_argument(
         "--normalize-stacked-flux", action="store_true",
         help=("Force stacked flux to be one at the end."
@@ -81,12 +102,66 @@ def add_picca_continuum_parser(parser=None):
         "--rfdwave", type=float, default=0.8,
         help="Rest-frame wave steps. Complies with forest limits")
     cont_group.add_argument(
-        "--minimizer", default="iminuit", choices=["iminuit", "l_bfgs_b"],
-        help="Minimizer to fit the continuum.")
+        "--minimizer", default="iminuit",
+        choices=["iminuit", "l_bfgs_b", "numba", "irls"],
+        help=("Minimizer to fit the continuum. numba uses iminuit with a "
+              "JIT compiled cost function. irls solves iteratively "
+              "reweighted least squares for batches of spectra and falls "
+              "back to iminuit."))
+    cont_group.add_argument(
+        "--validate-irls", action="store_true",
+        help=("Also fit with iminuit when --minimizer irls and report the "
+              "agreement."))
+    cont_group.add_argument(
+        "--fit-workers", type=int, default=1,
+        help=("Number of threads per MPI process to fit continua. Only "
+              "speeds up --minimizer numba or irls. Ignored for iminuit and "
+              "l_bfgs_b, which hold the GIL. Results do not depend on this "
+              "number."))
+    cont_group.add_argument(
+        "--fit-batch-size", type=int, default=0,
+        help=("Number of spectra to fit simultaneously with a vectorized "
+              "Newton solver, or with IRLS if --minimizer irls. Zero fits "
+              "one by one with --minimizer, which is also used when the "
+              "vectorized solver fails. --minimizer irls uses 256 if zero."))
+    cont_group.add_argument(
+        "--max-model-cache-mb", type=float, default=1024.,
+        help=("Maximum memory in MB per process to cache interpolated model "
+              "components (mean continuum, var_lss etc.) of each spectrum "
+              "within an iteration. Zero disables caching."))
+    cont_group.add_argument(
+        "--warm-start", action="store_true",
+        help=("Start continuum fits from the previous iteration's solution "
+              "and use its errors as initial step sizes."))
+    cont_group.add_argument(
+        "--refit-tol", type=float, default=0,
+        help=("Do not minimize spectra whose estimated distance to the new "
+              "minimum (EDM) after updating global functions is below this "
+              "value. A single Newton step is taken instead. Zero refits "
+              "all spectra."))
 
     return parser
 
 
+def _has_converged(old, new, err):
+    """Returns True if all updates are less than 0.33 times the error
+    estimates. Points without positive error are ignored."""
+    w = err > 0
+    return bool(np.all(np.abs(new[w] - old[w]) < 0.33 * err[w]))
+
+
+def _subsample_keys(spectra_list):
+    """Pseudo-random numbers in [0, 1) from TARGETIDs. Spectra with keys
+    less than a fraction form a subsample that is independent of MPI
+    decomposition and nested for increasing fractions."""
+    targetids = np.array(
+        [spec.targetid for spec in spectra_list], dtype=np.int64)
+    # Knuth's multiplicative hash
+    hashed = (targetids.astype(np.uint64) * np.uint64(2654435761)) \
+        % np.uint64(2**32)
+    return hashed / 2**32
+
+
 class PiccaContinuumFitter():
     """ Picca continuum fitter class.
 
@@ -132,6 +207,12 @@ class PiccaContinuumFitter():
         Interpolator for eta. Returns one if fiducial var_lss is set.
     niterations: int
         Number of iterations from ``args.num_iterations``.
+    subsample_fraction: float
+        Initial subsample fraction from ``args.subsample_fraction``.
+    subsample_growth: float
+        Growth factor of the subsample from ``args.subsample_growth``.
+    freeze_varlss: bool
+        Stop fitting var_lss and eta once they have converged.
     cont_order: int
         Order of continuum polynomial from ``args.cont_order``.
     outdir: str or None
@@ -212,18 +293,36 @@ class PiccaContinuumFitter():
         else:
             self.varlss_fitter = VarLSSFitter(
                 args.wave1, args.wave2, use_cov=args.var_use_cov,
-                comm=self.comm)
+                comm=self.comm, subsample_dtype=args.var_subsample_dtype)
             self.varlss_interp = self.varlss_fitter.construct_interp(0.1)
 
     def _set_continuum_model(self, args):
-        if args.continuum_model == "picca":
+        if args.continuum_model == "picca" and (
+                args.fit_batch_size > 0 or args.minimizer == "irls"):
+            from qsonic.continuum_models.batched_picca_continuum_model import \
+                BatchedPiccaContinuumModel
+
+            # irls is always solved in batches
+            batch_size = args.fit_batch_size if args.fit_batch_size > 0 \
+                else 256
+            self.model = BatchedPiccaContinuumModel(
+                self.meancont_interp, self.meanflux_interp, self.varlss_interp,
+                self.eta_interp, self.cont_order, self.rfwave[0], self._denom,
+                args.minimizer, max_cache_mb=args.max_model_cache_mb,
+                warm_start=args.warm_start, refit_tol=args.refit_tol,
+                validate_irls=args.validate_irls,
+                fit_workers=args.fit_workers, batch_size=batch_size)
+
+        elif args.continuum_model == "picca":
             from qsonic.continuum_models.picca_continuum_model import \
                 PiccaContinuumModel
 
             self.model = PiccaContinuumModel(
                 self.meancont_interp, self.meanflux_interp, self.varlss_interp,
                 self.eta_interp, self.cont_order, self.rfwave[0], self._denom,
-                args.minimizer)
+                args.minimizer, max_cache_mb=args.max_model_cache_mb,
+                warm_start=args.warm_start, refit_tol=args.refit_tol,
+                validate_irls=args.validate_irls, fit_workers=args.fit_workers)
 
         elif args.continuum_model == "true":
             from qsonic.continuum_models.true_continuum_model import \
@@ -249,11 +348,16 @@ class PiccaContinuumFitter():
 
         self.args = args
         self.niterations = args.num_iterations
+        self.subsample_fraction = min(1., args.subsample_fraction)
+        self.subsample_growth = max(1., args.subsample_growth)
+        self.freeze_varlss = args.freeze_varlss
         self.cont_order = args.cont_order
         self.outdir = args.outdir
         self.fit_eta = args.var_fit_eta
         self.normalize_stacked_flux = args.normalize_stacked_flux
         self.eta_calib_ivar = args.eta_calib_ivar
+        self.batches = None
+        self._spectra_list = None
 
         # We first decide how many bins will approximately satisfy
         # rest-frame wavelength spacing. Then we create wavelength edges, and
@@ -294,22 +398,50 @@ class PiccaContinuumFitter():
         QsonicException
             If there are no valid fits.
         """
-        num_valid_fits = 0
-        num_invalid_fits = 0
+        self.model.fit_continua(spectra_list)
 
-        # For each forest fit continuum
-        for spec in spectra_list:
-            self.model.fit_continuum(spec)
+        counts = self._count_fits(spectra_list)
+        self.comm.Allreduce(MPI.IN_PLACE, counts)
+        self._check_fit_counts(counts)
 
-            if not spec.cont_params['valid']:
-                num_invalid_fits += 1
-            else:
-                num_valid_fits += 1
+    def _count_fits(self, spectra_list):
+        """Counts valid, invalid and skipped fits in this process.
+
+        Arguments
+        ---------
+        spectra_list: list(Spectrum)
+            Spectrum objects that are fit.
+
+        Returns
+        -------
+        counts: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Number of valid, invalid and skipped fits.
+        """
+        num_valid_fits = sum(1 for _ in valid_spectra(spectra_list))
+        num_invalid_fits = len(spectra_list) - num_valid_fits
+        num_skipped = getattr(self.model, 'num_skipped', 0)
+
+        return np.array(
+            [num_valid_fits, num_invalid_fits, num_skipped], dtype=np.int64)
+
+    def _check_fit_counts(self, counts):
+        """Logs the number of fits summed over all MPI processes.
+
+        Arguments
+        ---------
+        counts: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Number of valid, invalid and skipped fits.
 
-        num_valid_fits = self.comm.allreduce(num_valid_fits)
-        num_invalid_fits = self.comm.allreduce(num_invalid_fits)
+        Raises
+        ------
+        QsonicException
+            If there are no valid fits.
+        """
+        num_valid_fits, num_invalid_fits, num_skipped = counts.tolist()
         logging.info(f"Number of valid fits: {num_valid_fits}")
         logging.info(f"Number of invalid fits: {num_invalid_fits}")
+        if num_skipped > 0:
+            logging.info(f"Number of skipped fits: {num_skipped}")
 
         if num_valid_fits == 0:
             raise QsonicException("Crucial error: No valid continuum fits!")
@@ -378,12 +510,81 @@ class PiccaContinuumFitter():
             True if all continuum updates on every point are less than 0.33
             times the error estimates.
         """
+        batches = self._get_batches(spectra_list)
+        self._stack_spectra(batches, self._get_pixels(batches))
+        return self._update_mean_cont()
+
+    def _get_batches(self, spectra_list):
+        """Returns :attr:`batches` if they pack ``spectra_list``. Otherwise,
+        returns temporary batches.
+
+        Arguments
+        ---------
+        spectra_list: list(Spectrum)
+            Spectrum objects.
+
+        Returns
+        -------
+        list(SpectraBatch)
+        """
+        if self.batches is not None and spectra_list == self._spectra_list:
+            return self.batches
+
+        return pack_spectra_batches(spectra_list)
+
+    @staticmethod
+    def _get_pixels(batches, fraction=1):
+        """Valid pixels of each batch.
+
+        Arguments
+        ---------
+        batches: list(SpectraBatch)
+            Batches of spectra.
+        fraction: float, default: 1
+            Only spectra in the subsample of this fraction are selected if
+            less than one. See :func:`_subsample_keys`.
+
+        Returns
+        -------
+        pixels: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Bool arrays of pixels for each batch.
+        """
+        if fraction >= 1:
+            return [batch.get_valid_pixels() for batch in batches]
+
+        return [
+            batch.get_valid_pixels(_subsample_keys(batch.spectra) < fraction)
+            for batch in batches]
+
+    def _stack_spectra(self, batches, pixels):
+        """Stacks pixels in this process without summing over MPI processes.
+
+        Arguments
+        ---------
+        batches: list(SpectraBatch)
+            Batches of spectra.
+        pixels: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Bool arrays of pixels to stack for each batch.
+        """
         self.flux_stacker.reset()
+        for batch, w in zip(batches, pixels):
+            self.model.stack_spectra(batch, self.flux_stacker, w)
 
-        self.model.stack_spectra(
-            valid_spectra(spectra_list), self.flux_stacker)
+    def _update_mean_cont(self, reduced=False):
+        """Updates the mean continuum from the stacks. See
+        :meth:`update_mean_cont`.
 
-        self.flux_stacker.calculate()
+        Arguments
+        ---------
+        reduced: bool, default: False
+            Stacks are already summed over MPI processes.
+
+        Returns
+        ---------
+        has_converged: bool
+            True if the mean continuum has converged.
+        """
+        self.flux_stacker.calculate(reduced)
         w = self.flux_stacker.std_flux_rf > 0
 
         if not all(w):
@@ -434,16 +635,85 @@ class PiccaContinuumFitter():
         ---------
         spectra_list: list(Spectrum)
             Spectrum objects to fit.
+
+        Returns
+        ---------
+        varlss_converged: bool
+            True if all var_lss updates are less than 0.33 times the error
+            estimates.
+        eta_converged: bool
+            Same for eta. Always True if not fitting for eta.
+        """
+        batches = self._get_batches(spectra_list)
+        self._add_var_stats(batches, self._get_pixels(batches))
+        return self._update_var_lss_eta()
+
+    def _count_var_stats(self, batches, pixels):
+        """Resets variance statistics and adds only pixel and quasar numbers
+        of pixels in this process without summing over MPI processes.
+
+        Arguments
+        ---------
+        batches: list(SpectraBatch)
+            Batches of spectra.
+        pixels: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Bool arrays of pixels to add for each batch.
+
+        Returns
+        -------
+        indices: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Bin indices of pixels for each batch.
         """
         self.varlss_fitter.reset()
 
-        for spec in valid_spectra(spectra_list):
-            for arm, wave_arm in spec.forestwave.items():
-                cont = spec.cont_params['cont'][arm]
-                delta = spec.forestflux[arm] / cont - 1
-                ivar = spec.forestivar[arm] * cont**2
+        indices = []
+        for batch, w in zip(batches, pixels):
+            _, ivar, _ = batch.get_deltas(w)
+            indices.append(self.varlss_fitter.count_many(
+                batch.wave[w], ivar, batch.get_offsets(w)))
+
+        return indices
 
-                self.varlss_fitter.add(wave_arm, delta, ivar)
+    def _add_var_stats(self, batches, pixels, indices=None):
+        """Adds variance statistics of pixels in this process without summing
+        over MPI processes.
+
+        Arguments
+        ---------
+        batches: list(SpectraBatch)
+            Batches of spectra.
+        pixels: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Bool arrays of pixels to add for each batch.
+        indices: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`) \
+                or None, default: None
+            Output of :meth:`_count_var_stats`. If None, statistics are reset
+            and pixels are counted first.
+        """
+        if indices is None:
+            indices = self._count_var_stats(batches, pixels)
+
+        for batch, w, indx in zip(batches, pixels, indices):
+            delta, ivar, _ = batch.get_deltas(w)
+            self.varlss_fitter.add_many(
+                batch.wave[w], delta, ivar, batch.get_offsets(w), indx)
+
+    def _update_var_lss_eta(self, reduced=False):
+        """Fits and updates var_lss and eta from the variance statistics. See
+        :meth:`update_var_lss_eta`.
+
+        Arguments
+        ---------
+        reduced: bool, default: False
+            Variance statistics are already summed over MPI processes.
+
+        Returns
+        ---------
+        varlss_converged: bool
+            True if var_lss has converged.
+        eta_converged: bool
+            True if eta has converged.
+        """
+        self.varlss_fitter.calculate_subsampler_stats(reduced)
 
         # Else, fit for var_lss
         if self.fit_eta:
@@ -458,13 +728,19 @@ class PiccaContinuumFitter():
         y, ep = self.varlss_fitter.fit(initial_guess)
 
         if not self.fit_eta:
+            varlss_converged = _has_converged(self.varlss_interp.fp, y, ep)
+            eta_converged = True
             self.varlss_interp.reset(y, ep=ep)
         else:
+            varlss_converged = _has_converged(
+                self.varlss_interp.fp, y[:, 0], ep[:, 0])
+            eta_converged = _has_converged(
+                self.eta_interp.fp, y[:, 1], ep[:, 1])
             self.varlss_interp.reset(y[:, 0], ep=ep[:, 0])
             self.eta_interp.reset(y[:, 1], ep=ep[:, 1])
 
         if self.mpi_rank != 0:
-            return
+            return varlss_converged, eta_converged
 
         step = max(1, self.varlss_fitter.nwbins // 10)
         text = ("Variance fitting results:\n"
@@ -479,8 +755,12 @@ class PiccaContinuumFitter():
             text += \
                 f"\n{w:7.2f}\t| {v:7.2e} +- {ve:7.2e}\t| {n:7.2e} +- {ne:7.2e}"
 
+        text += (f"\nvar_lss converged: {varlss_converged}"
+                 f"\neta converged: {eta_converged}")
         logging.info(text)
 
+        return varlss_converged, eta_converged
+
     def _normalize_flux(self, spectra_list):
         """Multiplies continuum estimates with stacked values in order to
         normalize flux in the observed grid to be 1 if
@@ -525,7 +805,10 @@ class PiccaContinuumFitter():
         Consists of three major steps: initializing, fitting, updating global
         variables. The initialization sets ``cont_params`` variable of every
         Spectrum object. Continuum polynomial order is carried by setting
-        ``cont_params[x]``. At each iteration:
+        ``cont_params[x]``. If :attr:`subsample_fraction` is less than one,
+        early iterations fit a growing random subsample. The full sample is
+        fit once the subsample has converged and in the last iteration. At
+        each iteration:
 
         1. Global variables (mean continuum, var_lss) are saved to
            ``attributes.fits`` file. This ensures the order of what is used in
@@ -534,7 +817,23 @@ class PiccaContinuumFitter():
         3. Mean continuum is updated by stacking, smoothing and removing
            degenarate modes. Check for convergence if update is small.
         4. If fitting for var_lss, fit and update by calculating variance
-           statistics.
+           statistics. If :attr:`freeze_varlss` is set, var_lss and eta are
+           not fit after they converge, and the iteration converges only if
+           they have.
+
+        Spectra are bound to batches (:attr:`batches`) from
+        :func:`qsonic.spectrum.pack_spectra_batches` after initialization.
+        This is a single batch unless spectra are memory-mapped, which then
+        stay mapped. Fit results are copied into the batches after each
+        fit, and stacking and variance statistics use their columns
+        directly.
+
+        Statistics are summed over MPI processes in two nonblocking
+        reductions (see :class:`qsonic.mpi_utils.PackedIallreduce`). Fit
+        counts, stacks and pixel and quasar numbers of variance statistics
+        are summed while the variance subsamples are accumulated. The
+        subsamples are then summed while the mean continuum is updated.
+        Total overlap and wait times are logged at the end.
 
         Arguments
         ---------
@@ -542,33 +841,96 @@ class PiccaContinuumFitter():
             Spectrum objects to fit.
         """
         has_converged = False
+        varlss_frozen = self.varlss_fitter is None
 
         self.model.init_spectra(spectra_list)
+        # Spectra are views of the batches from now on
+        self.batches = pack_spectra_batches(spectra_list)
+        self._spectra_list = list(spectra_list)
+        for batch in self.batches:
+            batch.bind()
 
         fname = f"{self.outdir}/attributes.fits" if self.outdir else ""
         fattr = MPISaver(fname, self.mpi_rank)
 
+        reduction_times = np.zeros(2)
+        fraction = self.subsample_fraction
+        if fraction < 1:
+            subsample_keys = _subsample_keys(spectra_list)
+
         for it in range(self.niterations):
             logging.info(f"Fitting iteration {it+1}/{self.niterations}")
 
             self.save(fattr, f"-{it + 1}")
 
-            # Fit all continua one by one
-            self.fit_continua(spectra_list)
-            # Stack all spectra in each process
-            # Broadcast and recalculate global functions
-            has_converged = self.update_mean_cont(spectra_list)
+            if it == self.niterations - 1:
+                fraction = 1
 
-            if self.varlss_fitter:
-                self.update_var_lss_eta(spectra_list)
+            if fraction < 1:
+                logging.info(f"Fitting a subsample of {fraction:.3f}.")
+                fit_list = [spec for spec, key in zip(
+                    spectra_list, subsample_keys) if key < fraction]
+            else:
+                fit_list = spectra_list
 
-            if has_converged:
+            # Fit all continua one by one
+            self.model.fit_continua(fit_list)
+            counts = self._count_fits(fit_list)
+            for batch in self.batches:
+                batch.update_fit_results()
+            pixels = self._get_pixels(self.batches, fraction)
+            # Stack all spectra in each process
+            self._stack_spectra(self.batches, pixels)
+
+            # Sum counts and stacks while adding variance statistics
+            arrays = [counts, *self.flux_stacker.get_mpi_arrays()]
+            if not varlss_frozen:
+                indices = self._count_var_stats(self.batches, pixels)
+                arrays += self.varlss_fitter.get_count_arrays()
+            reduction = PackedIallreduce(arrays, self.comm)
+            if not varlss_frozen:
+                self._add_var_stats(self.batches, pixels, indices)
+                del indices
+            reduction.wait()
+            reduction_times += (reduction.overlap_time, reduction.wait_time)
+
+            self._check_fit_counts(counts)
+
+            # Sum variance statistics while updating the mean continuum
+            if not varlss_frozen:
+                reduction = self.varlss_fitter.start_reduction()
+            meancont_converged = self._update_mean_cont(reduced=True)
+
+            if not varlss_frozen:
+                reduction.wait()
+                reduction_times += (
+                    reduction.overlap_time, reduction.wait_time)
+                varlss_converged, eta_converged = \
+                    self._update_var_lss_eta(reduced=True)
+                varlss_frozen = (
+                    self.freeze_varlss and fraction == 1
+                    and varlss_converged and eta_converged)
+                if varlss_frozen:
+                    logging.info("var_lss and eta are frozen.")
+
+            has_converged = meancont_converged and (
+                varlss_frozen or not self.freeze_varlss)
+
+            if has_converged and fraction < 1:
+                logging.info("Subsample has converged. Fitting all spectra.")
+                fraction = 1
+                has_converged = False
+            elif has_converged:
                 logging.info("Iteration has converged.")
                 break
 
+            fraction = min(1, fraction * self.subsample_growth)
+
         if not has_converged:
             logging.warning("Iteration has NOT converged.")
 
+        self._log_reduction_times(reduction_times)
+
         self._normalize_flux(spectra_list)
         self._eta_calibate_ivar(spectra_list)
 
@@ -581,11 +943,26 @@ class PiccaContinuumFitter():
         fattr.close()
         logging.info("All continua are fit.")
 
+    def _log_reduction_times(self, reduction_times):
+        """Logs the maximum time of local work overlapped with nonblocking
+        reductions and the maximum time spent waiting for them over all MPI
+        processes.
+
+        Arguments
+        ---------
+        reduction_times: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Overlap and wait times of this process in seconds.
+        """
+        self.comm.Allreduce(MPI.IN_PLACE, reduction_times, op=MPI.MAX)
+        logging.info(
+            f"Reductions overlapped {reduction_times[0]:.2f} s of local work"
+            f" and waited {reduction_times[1]:.2f} s.")
+
     def fit_final_varlss(self, spectra_list):
         logging.info("**These DO NOT go into weights**")
         self.varlss_fitter = VarLSSFitter(
             self.args.wave1, self.args.wave2, use_cov=self.args.var_use_cov,
-            comm=self.comm)
+            comm=self.comm, subsample_dtype=self.args.var_subsample_dtype)
         self.varlss_interp = self.varlss_fitter.construct_interp(0.1)
         self.eta_interp = self.varlss_fitter.construct_interp(1.0)
 
@@ -681,19 +1058,55 @@ class PiccaContinuumFitter():
             fts.close()
 
 
-@njit("f8[:, :](i8[:], f8[:], f8[:], i8)")
-def _fast_weighted_vector_bincount(x, delta, var, minlength):
-    xvec = np.zeros((4, minlength), dtype=np.float_)
-    y = delta**2
-    y2 = y**2
-
-    for i in range(x.size):
-        xvec[0, x[i]] += delta[i]
-        xvec[1, x[i]] += y[i]
-        xvec[2, x[i]] += y2[i]
-        xvec[3, x[i]] += var[i]
-
-    return xvec
+@njit("void(i8[:], i8[:], i8[:], i8[:])")
+def _fast_bin_counts(offsets, x, num_pixels, num_qso):
+    # Each segment offsets[k]:offsets[k + 1] counts once in num_qso
+    last_segment = np.full(num_qso.size, -1)
+
+    for k in range(offsets.size - 1):
+        for i in range(offsets[k], offsets[k + 1]):
+            j = x[i]
+            num_pixels[j] += 1
+
+            if last_segment[j] != k:
+                last_segment[j] = k
+                num_qso[j] += 1
+
+
+@njit(["void(i8[:], i8[:], i8[:], f8[:], f8[:], f8[:, :, :], f8[:, :, :])",
+       "void(i8[:], i8[:], i8[:], f8[:], f8[:], f4[:, :, :], f4[:, :, :])"])
+def _fast_subsample_bincount(
+        offsets, isamples, x, delta, var, measurements, weights
+):
+    # Segment k is pixels offsets[k]:offsets[k + 1] and goes to isamples[k].
+    # Each segment is summed in float64 scratch, which is then flushed into
+    # its subsample, so float32 subsamples add only one term per segment.
+    scratch = np.zeros((5, measurements.shape[2]))
+    touched = np.empty(measurements.shape[2], dtype=np.int64)
+
+    for k in range(isamples.size):
+        s = isamples[k]
+        ntouched = 0
+        for i in range(offsets[k], offsets[k + 1]):
+            j = x[i]
+            if scratch[4, j] == 0:
+                touched[ntouched] = j
+                ntouched += 1
+
+            y = delta[i]**2
+            scratch[0, j] += delta[i]
+            scratch[1, j] += y
+            scratch[2, j] += y**2
+            scratch[3, j] += var[i]
+            scratch[4, j] += 1
+
+        for t in range(ntouched):
+            j = touched[t]
+            for m in range(4):
+                measurements[s, m, j] += scratch[m, j]
+                scratch[m, j] = 0
+            weights[s, 0, j] += scratch[4, j]
+            scratch[4, j] = 0
 
 
 class VarLSSFitter():
@@ -754,6 +1167,11 @@ class VarLSSFitter():
         Use the Jackknife covariance when fitting.
     comm: MPI.COMM_WORLD or None, default: None
         MPI comm object to allreduce if enabled.
+    subsample_dtype: :external+numpy:py:class:`dtype <numpy.dtype>`, \
+            default: float64
+        Storage type of the subsamples. float32 halves their memory. Each
+        spectrum is summed in float64 before it is added to its subsample,
+        and the Jackknife statistics are always calculated in float64.
 
     Attributes
     ----------
@@ -807,7 +1225,8 @@ class VarLSSFitter():
     def __init__(
             self, w1obs, w2obs, nwbins=None,
             var1=1e-4, var2=20., nvarbins=100,
-            nsubsamples=None, use_cov=False, comm=None
+            nsubsamples=None, use_cov=False, comm=None,
+            subsample_dtype=np.float64
     ):
         if nwbins is None:
             nwbins = int(round((w2obs - w1obs) / 120.))
@@ -817,6 +1236,11 @@ class VarLSSFitter():
         self.use_cov = use_cov
         self.comm = comm
         self._stats_calculated = False
+        self._populated = None
+        self._compact = None
+        self._mean = None
+        self._variance = None
+        self._covariance = None
 
         # Set up wavelength and inverse variance bins
         wave_edges, self.dwobs = np.linspace(
@@ -835,8 +1259,8 @@ class VarLSSFitter():
             wbinslice = np.s_[i1:i2]
             self.wvalid_bins[wbinslice] = True
 
-        self._num_pixels = np.zeros(self.minlength, dtype=int)
-        self._num_qso = np.zeros(self.minlength, dtype=int)
+        self._num_pixels = np.zeros(self.minlength, dtype=np.int64)
+        self._num_qso = np.zeros(self.minlength, dtype=np.int64)
 
         # If ran with MPI, save mpi_rank first
         # Then shift each container to remove possibly over adding to 0th bin.
@@ -855,7 +1279,7 @@ class VarLSSFitter():
         # Axis 2 is var2_delta
         # Axis 3 is var_centers
         self.subsampler = SubsampleCov(
-            (4, self.minlength), nsubsamples, istart)
+            (4, self.minlength), nsubsamples, istart, subsample_dtype)
 
     def construct_interp(self, y0=1.0):
         """Return a `FastCubic1DInterp` object that interpolates in observed
@@ -881,6 +1305,11 @@ class VarLSSFitter():
         self._num_pixels.fill(0)
         self._num_qso.fill(0)
         self._stats_calculated = False
+        self._populated = None
+        self._compact = None
+        self._mean = None
+        self._variance = None
+        self._covariance = None
 
     def add(self, wave, delta, ivar):
         """Add statistics of a single spectrum. Updates delta and num arrays.
@@ -896,27 +1325,133 @@ class VarLSSFitter():
         ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
             Inverse variance array.
         """
+        self.add_many(wave, delta, ivar, np.array([0, wave.size]))
+
+    def _get_bin_indices(self, wave, ivar):
         # add 1 to match searchsorted/bincount output/input
         wave_indx = np.clip(
             ((wave - self.waveobs[0]) / self.dwobs + 1.5).astype(int),
             0, self.nwbins + 1
         )
         ivar_indx = np.searchsorted(self.ivar_edges, ivar)
-        all_indx = ivar_indx + wave_indx * (self.nvarbins + 2)
-        var = np.zeros_like(ivar)
+        return (ivar_indx + wave_indx * (self.nvarbins + 2)).astype(np.int64)
+
+    def count_many(self, wave, ivar, offsets):
+        """Adds only the pixel and quasar numbers of many spectra
+        concatenated into single arrays. Each ``offsets[k]:offsets[k + 1]``
+        segment counts as one quasar in :attr:`num_qso`, so arms of a
+        spectrum are counted separately as in :meth:`add`. This is cheap
+        compared to :meth:`add_many`, so the numbers can be summed over MPI
+        processes while the subsamples are accumulated.
+
+        Arguments
+        ---------
+        wave: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Wavelength array.
+        ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Inverse variance array.
+        offsets: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Segment offsets. Size is number of segments plus one.
+
+        Returns
+        -------
+        indices: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Bin indices of pixels to pass to :meth:`add_many`.
+        """
+        indices = self._get_bin_indices(wave, ivar)
+        _fast_bin_counts(
+            offsets.astype(np.int64), indices, self._num_pixels,
+            self._num_qso)
+
+        return indices
+
+    def add_many(self, wave, delta, ivar, offsets, indices=None):
+        """Add statistics of many spectra concatenated into single arrays,
+        e.g. from :class:`qsonic.spectrum.SpectraBatch`. Equivalent to calling
+        :meth:`add` for each ``offsets[k]:offsets[k + 1]`` segment, but
+        statistics are accumulated directly into the subsamples without
+        creating temporary arrays for each segment. Segments are summed in
+        float64 and then added to their subsamples, so float32 subsamples
+        only round once per segment and bin.
+
+        Assumes no spectra has ``wave < w1obs`` or ``wave > w2obs``.
+
+        Arguments
+        ---------
+        wave: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Wavelength array.
+        delta: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Delta array.
+        ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Inverse variance array.
+        offsets: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Segment offsets. Size is number of segments plus one.
+        indices: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Bin indices returned by :meth:`count_many`. If passed, pixel and
+            quasar numbers are already added and are not added again.
+        """
+        if indices is None:
+            indices = self.count_many(wave, ivar, offsets)
+
+        # Inputs may be stored in float32
+        delta = delta.astype(np.float64, copy=False)
+        ivar = ivar.astype(np.float64, copy=False)
+        var = np.zeros(ivar.size)
         w = ivar > 0
         var[w] = 1. / ivar[w]
 
-        npix = np.bincount(all_indx, minlength=self.minlength)
-        self._num_pixels += npix
-        xvec = _fast_weighted_vector_bincount(
-            all_indx, delta, var, self.minlength)
-        self.subsampler.add_measurement(xvec, npix)
+        isamples = self.subsampler.reserve_samples(offsets.size - 1)
+        _fast_subsample_bincount(
+            offsets.astype(np.int64), isamples.astype(np.int64), indices,
+            delta, var, self.subsampler.all_measurements,
+            self.subsampler.all_weights)
+
+    def get_count_arrays(self):
+        """Pixel and quasar number arrays that must be summed over MPI
+        processes before :meth:`start_reduction`.
+
+        Returns
+        -------
+        list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        """
+        return [self._num_pixels, self._num_qso]
+
+    def _take_populated_bins(self):
+        """Sets :attr:`_populated` to the bins with pixels and
+        :attr:`_compact` to a float64 copy of these bins of the subsamples.
+        If :attr:`use_cov` is set, whole wavelength bins are kept to
+        calculate block covariances.
+        """
+        populated = self._num_pixels > 0
+        if self.use_cov:
+            blockdim = self.nvarbins + 2
+            populated = np.repeat(
+                populated.reshape(-1, blockdim).any(axis=1), blockdim)
+
+        self._populated = populated
+        self._compact = self.subsampler.take(populated, np.float64)
+
+    def start_reduction(self):
+        """Starts summing the subsamples over MPI processes with a
+        nonblocking reduction. Arrays in :meth:`get_count_arrays` must be
+        summed before, since only bins populated in any process are copied in
+        float64 and summed. Empty bins are neither communicated nor used in
+        Jackknife calculations. Every process must call this. Wait on the
+        returned reduction before calling :meth:`calculate_subsampler_stats`
+        with ``reduced=True``.
+
+        Returns
+        -------
+        reduction: PackedIallreduce
+            Nonblocking reduction of the populated bins.
+        """
+        self._take_populated_bins()
 
-        npix[npix > 0] = 1
-        self._num_qso += npix
+        return PackedIallreduce(
+            [self._compact.all_measurements, self._compact.all_weights],
+            self.comm)
 
-    def calculate_subsampler_stats(self):
+    def calculate_subsampler_stats(self, reduced=False):
         """ Calculates mean, variance and error on the variance.
 
         It also calculates the delete-one Jackknife variance over
@@ -929,43 +1464,69 @@ class VarLSSFitter():
         Covariance is calculated if :attr:`use_cov` is set to True in init.
         Covariance of mean_delta^2 is propagated using the formula in
         :func:`qsonic.mathtools.block_covariance_of_square`.
+
+        Statistics are calculated on populated bins only. Empty bins have
+        zero mean and variance.
+
+        Arguments
+        ---------
+        reduced: bool, default: False
+            :meth:`start_reduction` is already called and waited on.
         """
         if self._stats_calculated:
             return
 
-        if self.comm is not None:
-            self.subsampler.allreduce(self.comm, MPI.IN_PLACE)
+        if not reduced:
+            if self.comm is not None:
+                for arr in self.get_count_arrays():
+                    self.comm.Allreduce(MPI.IN_PLACE, arr)
 
-            self.comm.Allreduce(MPI.IN_PLACE, self._num_pixels)
-            self.comm.Allreduce(MPI.IN_PLACE, self._num_qso)
+            self._take_populated_bins()
+            if self.comm is not None:
+                self._compact.allreduce(self.comm, MPI.IN_PLACE)
 
-        self.subsampler.get_mean_n_var()
+        populated = self._populated
+        subsampler = self._compact
+        self._compact = None
+
+        subsampler.get_mean_n_var()
         if self.use_cov:
-            self.subsampler.get_mean_n_cov(
+            subsampler.get_mean_n_cov(
                 indices=[0, 1], blockdim=self.nvarbins + 2)
+        mean, variance = subsampler.mean, subsampler.variance
 
-        m2 = self.subsampler.mean[0]**2
-        self.subsampler.mean[1] -= m2
-        self.subsampler.mean[2] -= self.subsampler.mean[1]**2
+        m2 = mean[0]**2
+        mean[1] -= m2
+        mean[2] -= mean[1]**2
 
-        w = self._num_pixels > 0
-        self.subsampler.mean[2, w] /= self._num_pixels[w]
+        num_pixels = self._num_pixels[populated]
+        w = num_pixels > 0
+        mean[2, w] /= num_pixels[w]
 
         # Update variance / covariance
         if self.use_cov:
-            self.subsampler.covariance[1] += block_covariance_of_square(
-                self.subsampler.mean[0],
-                self.subsampler.variance[0],
-                self.subsampler.covariance[0])
+            subsampler.covariance[1] += block_covariance_of_square(
+                mean[0], variance[0], subsampler.covariance[0])
         else:
-            self.subsampler.variance[1] += 4 * m2 * self.subsampler.variance[0]
-            self.subsampler.variance[1] += 2 * self.subsampler.variance[0]**2
+            variance[1] += 4 * m2 * variance[0]
+            variance[1] += 2 * variance[0]**2
             # Regularized jackknife errors
-            self.subsampler.variance[1] = np.where(
-                self.subsampler.variance[1] > self.subsampler.mean[2],
-                self.subsampler.variance[1],
-                self.subsampler.mean[2]
-            )
+            variance[1] = np.where(variance[1] > mean[2], variance[1], mean[2])
+
+        # Expand to all bins
+        self._mean = np.zeros((4, self.minlength))
+        self._mean[:, populated] = mean
+        self._variance = np.zeros((4, self.minlength))
+        self._variance[:, populated] = variance
+
+        if self.use_cov:
+            blockdim = self.nvarbins + 2
+            populated_blocks = populated[::blockdim]
+            self._covariance = [None] * 4
+            for jj in [0, 1]:
+                cov = np.zeros((self.nwbins + 2, blockdim, blockdim))
+                cov[populated_blocks] = subsampler.covariance[jj]
+                self._covariance[jj] = cov
 
         self._stats_calculated = True
 
@@ -1175,13 +1736,13 @@ class VarLSSFitter():
     @property
     def mean_delta(self):
         """:external+numpy:py:class:`ndarray <numpy.ndarray>`: Mean delta."""
-        return self.subsampler.mean[0][self.wvalid_bins]
+        return self._mean[0][self.wvalid_bins]
 
     @property
     def var_delta(self):
         """:external+numpy:py:class:`ndarray <numpy.ndarray>`:
         Variance delta."""
-        return self.subsampler.mean[1][self.wvalid_bins]
+        return self._mean[1][self.wvalid_bins]
 
     @property
     def e_var_delta(self):
@@ -1191,7 +1752,7 @@ class VarLSSFitter():
         :attr:`var2_delta`. See source code of
         :meth:`calculate_subsampler_stats`.
         """
-        return np.sqrt(self.subsampler.variance[1][self.wvalid_bins])
+        return np.sqrt(self._variance[1][self.wvalid_bins])
 
     @property
     def cov_var_delta(self):
@@ -1203,26 +1764,26 @@ class VarLSSFitter():
         None if :attr:`use_cov` is False."""
         if not self.use_cov:
             return None
-        cov = self.subsampler.covariance[1]
+        cov = self._covariance[1]
         return cov[1:-1, 1:-1, 1:-1]
 
     @property
     def var2_delta(self):
         """:external+numpy:py:class:`ndarray <numpy.ndarray>`:
         Variance delta^2."""
-        return self.subsampler.mean[2][self.wvalid_bins]
+        return self._mean[2][self.wvalid_bins]
 
     @property
     def var_centers(self):
         """:external+numpy:py:class:`ndarray <numpy.ndarray>`:
         Mean variance for the bin centers in **descending** order."""
-        return self.subsampler.mean[3][self.wvalid_bins]
+        return self._mean[3][self.wvalid_bins]
 
     @property
     def e_var_centers(self):
         """:external+numpy:py:class:`ndarray <numpy.ndarray>`:
         Error on the mean variance for the bin centers."""
-        return np.sqrt(self.subsampler.variance[3][self.wvalid_bins])
+        return np.sqrt(self._variance[3][self.wvalid_bins])
 
 
 class FluxStacker():
@@ -1324,14 +1885,28 @@ class FluxStacker():
         self._interp_rf.ep += np.bincount(
             wave_indx, weights=weight, minlength=self.nwrfbins)
 
-    def calculate(self):
-        """Calculate stacked flux by allreducing if necessary."""
-        if self.comm is not None:
-            self.comm.Allreduce(MPI.IN_PLACE, self._interp.fp)
-            self.comm.Allreduce(MPI.IN_PLACE, self._interp.ep)
+    def get_mpi_arrays(self):
+        """Arrays that are summed over MPI processes in :meth:`calculate`.
+
+        Returns
+        -------
+        list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        """
+        return [self._interp.fp, self._interp.ep,
+                self._interp_rf.fp, self._interp_rf.ep]
+
+    def calculate(self, reduced=False):
+        """Calculate stacked flux by allreducing if necessary.
 
-            self.comm.Allreduce(MPI.IN_PLACE, self._interp_rf.fp)
-            self.comm.Allreduce(MPI.IN_PLACE, self._interp_rf.ep)
+        Arguments
+        ---------
+        reduced: bool, default: False
+            Arrays in :meth:`get_mpi_arrays` are already summed over MPI
+            processes, e.g. with :class:`qsonic.mpi_utils.PackedIallreduce`.
+        """
+        if self.comm is not None and not reduced:
+            for arr in self.get_mpi_arrays():
+                self.comm.Allreduce(MPI.IN_PLACE, arr)
 
         w = self._interp.ep > 0
         self._interp.fp[w] /= self._interp.ep[w]
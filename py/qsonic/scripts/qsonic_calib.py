@@ -13,7 +13,7 @@ import qsonic.io
 from qsonic.masks import BALMask
 from qsonic.mpi_utils import mpi_parse, mpi_fnc_bcast, MPISaver
 from qsonic.picca_continuum import VarLSSFitter
-from qsonic.spectrum import add_wave_region_parser
+from qsonic.spectrum import Spectrum, add_wave_region_parser
 
 
 def get_parser(add_help=True):
@@ -57,6 +57,10 @@ def get_parser(add_help=True):
     iogroup.add_argument(
         "--remove-targetid-list",
         help="Text file with TARGETIDs to exclude from analysis.")
+    iogroup.add_argument(
+        "--storage-dtype", default="float64", choices=["float64", "float32"],
+        help=("Floating point type to store deltas, ivar, weights and "
+              "resolution matrices. Sums are accumulated in float64."))
 
     vargroup = parser.add_argument_group(
         'Variance fitting parameters')
@@ -66,6 +70,11 @@ def get_parser(add_help=True):
     vargroup.add_argument(
         "--var-use-cov", action="store_true",
         help="Use covariance in varlss-eta fitting.")
+    vargroup.add_argument(
+        "--var-subsample-dtype", default="float64",
+        choices=["float64", "float32"],
+        help=("Floating point type to store Jackknife subsamples. "
+              "Statistics are calculated in float64."))
     vargroup.add_argument(
         "--nwbins", default=None, type=int,
         help="Number of wavelength bins. None creates bins with 120 A spacing")
@@ -116,7 +125,7 @@ def mpi_set_targetid_list_to_remove(args, comm=None, mpi_rank=0):
         ids_to_remove = mpi_fnc_bcast(
             np.loadtxt, comm, mpi_rank,
             "Error while reading remove_targetid_list.",
-            args.remove_targetid_list, dtype=int)
+            args.remove_targetid_list, dtype=int, ndmin=1)
 
     if args.catalog:
         catalog = qsonic.catalog.mpi_read_quasar_catalog(
@@ -145,7 +154,32 @@ def mpi_set_targetid_list_to_remove(args, comm=None, mpi_rank=0):
     return ids_to_remove
 
 
-def mpi_read_all_deltas(args, comm=None, mpi_rank=0, mpi_size=1):
+def mpi_read_all_deltas(
+        args, comm=None, mpi_rank=0, mpi_size=1, predicate=None
+):
+    """Reads delta files of this rank. Only ``LAMBDA``, ``DELTA``, ``IVAR``
+    and ``WEIGHT`` columns of deltas that pass ``predicate`` are read. See
+    :func:`qsonic.io.read_deltas`.
+
+    Arguments
+    ---------
+    args: argparse.Namespace
+        Options passed to script.
+    comm: MPI.COMM_WORLD or None, default: None
+        Communication object broadcast data.
+    mpi_rank: int, default: 0
+        Rank of the MPI process.
+    mpi_size: int, default: 1
+        Number of MPI processes.
+    predicate: Callable or None, default: None
+        Function of ``(targetid, mean_snr)`` that returns True to keep the
+        delta.
+
+    Returns
+    -------
+    deltas_list: list(list(Delta))
+        Deltas in each file.
+    """
     start_time = time.time()
     logging.info("Reading deltas.")
 
@@ -165,7 +199,10 @@ def mpi_read_all_deltas(args, comm=None, mpi_rank=0, mpi_size=1):
     i2 = min(ndelta_all, i1 + nfiles_per_rank)
     files_this_rank = all_delta_files[i1:i2]
 
-    deltas_list = [qsonic.io.read_deltas(fname) for fname in files_this_rank]
+    deltas_list = [
+        qsonic.io.read_deltas(
+            fname, predicate, columns=['WEIGHT'], skip_resomat=True)
+        for fname in files_this_rank]
 
     etime = (time.time() - start_time) / 60  # min
     logging.info(f"Rank{mpi_rank} read {i2-i1} deltas in {etime:.1f} mins.")
@@ -211,20 +248,25 @@ def mpi_run_all(comm, mpi_rank, mpi_size):
     varfitter = VarLSSFitter(
         args.wave1, args.wave2, args.nwbins,
         args.var1, args.var2, args.nvarbins,
-        use_cov=args.var_use_cov, comm=comm)
+        use_cov=args.var_use_cov, comm=comm,
+        subsample_dtype=args.var_subsample_dtype)
 
-    ids_to_remove = mpi_set_targetid_list_to_remove(args, comm, mpi_rank)
+    ids_to_remove = set(np.atleast_1d(
+        mpi_set_targetid_list_to_remove(args, comm, mpi_rank)).tolist())
+    Spectrum.set_storage_dtype(args.storage_dtype)
 
-    def _is_kept(delta):
+    def _is_kept(targetid, mean_snr):
         return (
-            (delta.targetid not in ids_to_remove)
-            and (delta.mean_snr > args.min_snr)
-            and (delta.mean_snr < args.max_snr)
+            (targetid not in ids_to_remove)
+            and (mean_snr > args.min_snr)
+            and (mean_snr < args.max_snr)
         )
 
-    deltas_list = mpi_read_all_deltas(args, comm, mpi_rank, mpi_size)
-    # Flatten this list of lists and remove quasars
-    deltas_list = [x for alist in deltas_list for x in alist if _is_kept(x)]
+    # Quasars are removed before reading their data
+    deltas_list = mpi_read_all_deltas(
+        args, comm, mpi_rank, mpi_size, _is_kept)
+    # Flatten this list of lists
+    deltas_list = [x for alist in deltas_list for x in alist]
 
     for delta in deltas_list:
         varfitter.add(delta.wave, delta.delta, delta.ivar)
@@ -10,6 +10,7 @@ import fitsio
 import healpy
 
 import qsonic.io
+import qsonic.spectrum
 
 
 def get_parser():
@@ -36,6 +37,10 @@ def get_parser():
         "--nest", action="store_true", help="Use NESTED pixelization.")
     parser.add_argument(
         "--nproc", type=int, default=None, help="Number of processes.")
+    parser.add_argument(
+        "--storage-dtype", default="float64", choices=["float64", "float32"],
+        help=("Floating point type to store deltas, ivar, weights and "
+              "resolution matrices. Output is always float64."))
     return parser
 
 
@@ -106,6 +111,7 @@ def main():
         datefmt='%Y/%m/%d %I:%M:%S %p',
         level=logging.DEBUG)
 
+    qsonic.spectrum.Spectrum.set_storage_dtype(args.storage_dtype)
     forest_dict = read_dirs_to_dict(args.input_dirs, args.nproc)
 
     logging.info("Grouping into healpixels.")
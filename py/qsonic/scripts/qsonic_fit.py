@@ -3,6 +3,7 @@ import logging
 import time
 
 from os import makedirs as os_makedirs
+from os import path as os_path
 
 import numpy as np
 
@@ -12,7 +13,9 @@ import qsonic.catalog
 import qsonic.io
 import qsonic.spectrum
 import qsonic.masks
-from qsonic.mpi_utils import mpi_parse
+from qsonic.mpi_utils import (
+    mpi_parse, mpi_fnc_bcast, mpi_exchange_arrays, get_redistribution_plan,
+    DynamicQueue, LoadCostModel, MPISaver)
 from qsonic.picca_continuum import (
     PiccaContinuumFitter, add_picca_continuum_parser)
 
@@ -79,7 +82,9 @@ def args_logic_fnc_qsonic_fit(args):
         (args.tile_format and args.save_by_hpx,
             "Cannot save deltas in healpixes in tile format."),
         (args.exposures != "disable" and args.tile_format,
-            "Cannot save exposures in tile format.")
+            "Cannot save exposures in tile format."),
+        (args.dynamic_schedule and args.cache_dir,
+            "Dynamic scheduling does not support cache directory.")
     ]
 
     condition_msg = [_ for _ in condition_msg if _[0]]
@@ -95,6 +100,86 @@ def args_logic_fnc_qsonic_fit(args):
     return not condition_msg
 
 
+def mpi_get_load_cost_model(args, comm, mpi_rank):
+    """Returns the cost model for load balancing. Coefficients are calibrated
+    from ``args.timing_log`` if passed.
+
+    Arguments
+    ---------
+    args: argparse.Namespace
+        Options passed to script.
+    comm: MPI.COMM_WORLD
+        Communication object for broadcasting data.
+    mpi_rank: int
+        Rank of the MPI process.
+
+    Returns
+    -------
+    cost_model: LoadCostModel or None
+        None if ``args.load_balance`` is not ``cost``.
+
+    Raises
+    ------
+    QsonicException
+        If error occurs while reading the timing log or calibrating.
+    """
+    if args.load_balance != "cost":
+        return None
+
+    timing_log = None
+    if args.timing_log:
+        logging.info(f"Calibrating cost model from {args.timing_log}.")
+        timing_log = mpi_fnc_bcast(
+            LoadCostModel.read_timing_log, comm, mpi_rank,
+            "Error while reading timing log.", args.timing_log)
+
+    cost_model = LoadCostModel.from_args(args, timing_log)
+    logging.info(
+        f"Cost model coefficients (file, quasar, pixel): "
+        f"{cost_model.file_cost:.3g}, {cost_model.quasar_cost:.3g}, "
+        f"{cost_model.pixel_cost:.3g}.")
+
+    return cost_model
+
+
+def save_timing_log(timing, args, comm, mpi_rank):
+    """Gathers read times of files to the master node and saves them to
+    ``args.save_timing_log``, which can be passed as ``--timing-log`` to
+    calibrate the cost model. Columns are ``KEY`` (healpix or tile), ``NQSO``,
+    ``NPIX`` (estimated forest pixels), ``TIME`` (s) and ``RANK``. Fitting
+    times are not recorded, because spectra are not fit per file and can be
+    moved between ranks by :func:`mpi_redistribute_spectra`.
+
+    Arguments
+    ---------
+    timing: list(tuple)
+        ``(key, nqso, npix, time)`` for each file read on this rank.
+    args: argparse.Namespace
+        Options passed to script.
+    comm: MPI.COMM_WORLD
+        Communication object for gathering data.
+    mpi_rank: int
+        Rank of the MPI process.
+    """
+    all_timing = comm.gather(timing)
+    if mpi_rank != 0:
+        return
+
+    ranks = np.concatenate([
+        np.full(len(t), r, dtype=int) for r, t in enumerate(all_timing)])
+    all_timing = [x for t in all_timing for x in t]
+    if not all_timing:
+        return
+
+    key, nqso, npix, rtime = (np.array(x) for x in zip(*all_timing))
+    mpi_saver = MPISaver(args.save_timing_log, mpi_rank)
+    mpi_saver.write(
+        [key, nqso, npix, rtime, ranks],
+        names=['KEY', 'NQSO', 'NPIX', 'TIME', 'RANK'], extname="TIMING")
+    mpi_saver.close()
+    logging.info(f"Timing log saved in {args.save_timing_log}.")
+
+
 def mpi_read_spectra_local_queue(local_queue, args, comm):
     """ Read local spectra for the MPI rank. Set forest and observed wavelength
     range.
@@ -103,7 +188,9 @@ def mpi_read_spectra_local_queue(local_queue, args, comm):
     ---------
     local_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
         Catalog from :func:`qsonic.catalog.mpi_get_local_queue`. Each
-        element is a catalog for one healpix.
+        element is a catalog for one healpix. If
+        :class:`DynamicQueue <qsonic.mpi_utils.DynamicQueue>`, catalogs are
+        received while reading and the queue is closed afterwards.
     args: argparse.Namespace
         Options passed to script.
     comm: MPI.COMM_WORLD
@@ -122,12 +209,30 @@ def mpi_read_spectra_local_queue(local_queue, args, comm):
 
     readerFunction = qsonic.io.get_spectra_reader_function(
         args.input_dir, args.arms, args.mock_analysis, args.skip_resomat,
-        args.true_continuum, args.tile_format, args.exposures == "before")
+        args.true_continuum, args.tile_format, args.exposures == "before",
+        forest_limits=(
+            args.wave1, args.wave2, args.forest_w1, args.forest_w2))
 
-    spectra_list = []
-    # Each process reads its own list
-    for cat in local_queue:
+    timing = []
+    cost_model = LoadCostModel.from_args(args)
+    split_key = "TILEID" if args.tile_format else "HPXPIXEL"
+
+    def _timed_reader(cat):
+        t0 = time.time()
         local_specs = readerFunction(cat)
+        timing.append((
+            cat[split_key][0], cat.size,
+            cost_model.get_forest_pixels(cat['Z']).sum(), time.time() - t0))
+        return local_specs
+
+    spectra_list = []
+    # Each process reads its own list. Next files are read in the background
+    # while the current ones are processed.
+    wait_time = 0
+    t1 = time.time()
+    for local_specs in qsonic.io.prefetch_spectra(
+            _timed_reader, local_queue, args.prefetch_depth):
+        wait_time += time.time() - t1
 
         for spec in local_specs:
             spec.set_forest_region(
@@ -138,15 +243,32 @@ def mpi_read_spectra_local_queue(local_queue, args, comm):
             spec for spec in local_specs
             if spec.forestwave and spec.rsnr >= args.min_rsnr
         ])
+        t1 = time.time()
 
     if args.coadd_arms == "before":
         logging.info("Coadding arms with pure IVAR weights.")
         for spec in spectra_list:
             spec.coadd_arms_forest()
 
+    if isinstance(local_queue, DynamicQueue):
+        local_queue.close()
+        nstolen = comm.reduce(local_queue.nstolen)
+        nfiles = comm.gather(len(local_queue.local_queue))
+        if nfiles is not None:
+            logging.info(
+                f"Processes read {min(nfiles)} to {max(nfiles)} files. "
+                f"{nstolen} files are taken from other processes.")
+
     nspec_all = comm.reduce(len(spectra_list))
+    wait_time = comm.reduce(wait_time, max)
     etime = (time.time() - start_time) / 60  # min
     logging.info(f"All {nspec_all} {read_mode} are read in {etime:.1f} mins.")
+    if wait_time is not None:
+        logging.info(
+            f"Maximum time waiting for file reads is {wait_time:.1f} s.")
+
+    if args.save_timing_log:
+        save_timing_log(timing, args, comm, comm.Get_rank())
 
     return spectra_list
 
@@ -228,7 +350,10 @@ def apply_masks(maskers, spectra_list, mpi_rank=0):
     :class:`BALMask <qsonic.masks.BALMask>` and
     :class:`DLAMask <qsonic.masks.DLAMask>`. Masking is set by setting
     ``forestivar=0``. :class:`DLAMask <qsonic.masks.DLAMask>` further corrects
-    for Lya and Lyb damping wings. Empty arms are removed after masking.
+    for Lya and Lyb damping wings. Spectra are packed into a bound
+    :class:`SpectraBatch <qsonic.spectrum.SpectraBatch>`, so that sky masking
+    is applied to all spectra at once and forests are stored contiguously
+    afterwards. Empty arms are removed after masking.
 
     Arguments
     ---------
@@ -244,9 +369,12 @@ def apply_masks(maskers, spectra_list, mpi_rank=0):
 
     start_time = time.time()
     logging.info("Applying masks.")
+    batch = qsonic.spectrum.SpectraBatch(spectra_list)
+    batch.bind()
+    for masker in maskers:
+        masker.apply_batch(batch)
+
     for spec in spectra_list:
-        for masker in maskers:
-            masker.apply(spec)
         spec.drop_short_arms()
     etime = (time.time() - start_time) / 60   # min
     logging.info(f"Masks are applied in {etime:.1f} mins.")
@@ -264,17 +392,279 @@ def remove_short_spectra(spectra_list, lya1, lya2, skip_ratio):
     return spectra_list
 
 
+def mpi_report_memory(spectra_list, comm):
+    """ Logs the memory used by Spectrum objects in total, per spectrum and
+    the maximum over MPI processes. Use this to size the number of MPI
+    processes per node. See
+    :meth:`Spectrum.memory_footprint
+    <qsonic.spectrum.Spectrum.memory_footprint>`.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectrum objects for the local MPI rank.
+    comm: MPI.COMM_WORLD
+        Communication object for reducing data.
+    """
+    local_mb = qsonic.spectrum.memory_footprint(spectra_list) / 1024**2
+    total_mb = comm.reduce(local_mb)
+    max_mb = comm.reduce(local_mb, max)
+    nspec_all = comm.reduce(len(spectra_list))
+
+    if comm.Get_rank() != 0:
+        return
+
+    per_spec_kb = 1024 * total_mb / max(1, nspec_all)
+    logging.info(
+        f"Spectra use {total_mb:.1f} MB in total ({per_spec_kb:.1f} KB per "
+        f"spectrum). Maximum in a process is {max_mb:.1f} MB.")
+
+
+def _mpi_exchange_spectra(send_spectra, comm, with_continuum=False):
+    """Sends spectra to other ranks as packed arrays. See
+    :meth:`SpectraBatch.to_arrays
+    <qsonic.spectrum.SpectraBatch.to_arrays>`. Every rank must call this
+    function.
+
+    Arguments
+    ---------
+    send_spectra: dict(int, list(Spectrum))
+        Spectra to send keyed by the destination rank.
+    comm: MPI.COMM_WORLD
+        Communication object.
+    with_continuum: bool, default: False
+        Sends continua and weights as well.
+
+    Returns
+    -------
+    spectra_list: list(Spectrum)
+        Received spectra.
+    """
+    send_arrays = {
+        dest: qsonic.spectrum.SpectraBatch(specs).to_arrays(with_continuum)
+        for dest, specs in send_spectra.items() if specs}
+
+    recv_arrays = mpi_exchange_arrays(send_arrays, comm)
+    spectra_list = []
+    for arrays in recv_arrays.values():
+        spectra_list.extend(
+            qsonic.spectrum.SpectraBatch.from_arrays(arrays).spectra)
+
+    return spectra_list
+
+
+def mpi_get_spectra_owners(spectra_list, args, comm):
+    """Ranks that own the healpixels (or tiles) of spectra before
+    :func:`mpi_redistribute_spectra`.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectrum objects for the local MPI rank.
+    args: argparse.Namespace
+        Options passed to script.
+    comm: MPI.COMM_WORLD
+        Communication object.
+
+    Returns
+    -------
+    owners: dict(int, int)
+        Rank of each healpix (or tile).
+    """
+    key = 'TILEID' if args.tile_format else 'HPXPIXEL'
+    local_keys = set(int(spec.catrow[key]) for spec in spectra_list)
+    owners = {}
+    for rank, keys in enumerate(comm.allgather(local_keys)):
+        for k in keys:
+            owners.setdefault(k, rank)
+
+    return owners
+
+
+def mpi_redistribute_spectra(spectra_list, comm, mpi_rank):
+    """Moves spectra from ranks with more forest pixels than the mean to
+    ranks with fewer, so that continuum fitting iterations are not waiting
+    for the slowest rank. Spectra are sent as packed arrays. Remaining
+    spectra of sending ranks are packed into a new bound
+    :class:`SpectraBatch <qsonic.spectrum.SpectraBatch>` to release the
+    memory of the sent ones. Must be called before smoothing the inverse
+    variance.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectrum objects for the local MPI rank.
+    comm: MPI.COMM_WORLD
+        Communication object.
+    mpi_rank: int
+        Rank of the MPI process.
+
+    Returns
+    -------
+    spectra_list: list(Spectrum)
+        Spectrum objects for the local MPI rank after redistribution.
+    """
+    start_time = time.time()
+    logging.info("Redistributing spectra.")
+    # Ranks that have not read any file do not have the wavelength grid.
+    for wave in comm.allgather(qsonic.spectrum.Spectrum._wave):
+        if wave:
+            qsonic.spectrum.Spectrum._set_wave(wave)
+            break
+
+    sizes = [
+        sum(wave_arm.size for wave_arm in spec.forestwave.values())
+        for spec in spectra_list]
+    loads = np.array(comm.allgather(sum(sizes)))
+    plan = get_redistribution_plan(loads)
+
+    send_spectra = {}
+    for src, dest, amount in plan:
+        if src != mpi_rank:
+            continue
+
+        # Take spectra from the end until the amount of pixels is reached
+        specs, npix = [], 0
+        while spectra_list and npix + sizes[-1] / 2 < amount:
+            specs.append(spectra_list.pop())
+            npix += sizes.pop()
+        send_spectra[dest] = specs
+
+    spectra_list.extend(_mpi_exchange_spectra(send_spectra, comm))
+    if send_spectra:
+        qsonic.spectrum.SpectraBatch(spectra_list).bind()
+
+    new_loads = comm.gather(sum(
+        sum(wave_arm.size for wave_arm in spec.forestwave.values())
+        for spec in spectra_list))
+    etime = time.time() - start_time
+    if mpi_rank == 0:
+        logging.info(
+            f"Maximum forest pixels in a process is {np.max(new_loads)} "
+            f"(was {loads.max()}, mean {loads.mean():.0f}). Redistribution "
+            f"took {etime:.1f} s.")
+
+    return spectra_list
+
+
+def mpi_route_spectra_to_owners(spectra_list, owners, args, comm, mpi_rank):
+    """Sends spectra back to the ranks that own their healpixels (or tiles)
+    after :func:`mpi_redistribute_spectra`, so that each delta file is
+    written by one rank. Continua and weights are sent as well.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectrum objects for the local MPI rank.
+    owners: dict(int, int)
+        Rank of each healpix (or tile). See :func:`mpi_get_spectra_owners`.
+    args: argparse.Namespace
+        Options passed to script.
+    comm: MPI.COMM_WORLD
+        Communication object.
+    mpi_rank: int
+        Rank of the MPI process.
+
+    Returns
+    -------
+    spectra_list: list(Spectrum)
+        Spectrum objects of healpixels owned by this rank.
+    """
+    key = 'TILEID' if args.tile_format else 'HPXPIXEL'
+    local_spectra, send_spectra = [], {}
+    for spec in spectra_list:
+        dest = owners.get(int(spec.catrow[key]), mpi_rank)
+        if dest == mpi_rank:
+            local_spectra.append(spec)
+        else:
+            send_spectra.setdefault(dest, []).append(spec)
+
+    local_spectra.extend(_mpi_exchange_spectra(
+        send_spectra, comm, with_continuum=True))
+
+    return local_spectra
+
+
+def load_cached_spectra(local_queue, args):
+    """ Loads spectra of healpixels that are in the cache directory. See
+    :func:`qsonic.io.get_spectra_cache_fname`. Cached files are
+    memory-mapped in copy-on-write mode if ``args.cache_mmap`` is set.
+
+    Arguments
+    ---------
+    local_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Catalog from :func:`qsonic.catalog.mpi_get_local_queue`.
+    args: argparse.Namespace
+        Options passed to script.
+
+    Returns
+    ---------
+    spectra_list: list(Spectrum)
+        Cached Spectrum objects.
+    uncached_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Catalogs of healpixels that are not in the cache.
+    """
+    if not args.cache_dir:
+        return [], local_queue
+
+    mmap_mode = 'c' if args.cache_mmap else None
+    spectra_list, uncached_queue = [], []
+    for cat in local_queue:
+        fname = qsonic.io.get_spectra_cache_fname(cat, args)
+        if os_path.isdir(fname):
+            spectra_list.extend(
+                qsonic.io.load_spectra_cache(fname, mmap_mode))
+        else:
+            uncached_queue.append(cat)
+
+    return spectra_list, uncached_queue
+
+
+def save_spectra_to_cache(spectra_list, local_queue, args):
+    """ Saves spectra of each healpix (or tile) in ``local_queue`` to the
+    cache directory. Healpixels without any remaining spectra are saved as
+    empty, so they are not read again.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectrum objects read from ``local_queue``.
+    local_queue: list(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+        Catalogs of healpixels that were read.
+    args: argparse.Namespace
+        Options passed to script.
+    """
+    if not args.cache_dir:
+        return
+
+    key = 'TILEID' if args.tile_format else 'HPXPIXEL'
+    groups = {}
+    for spec in spectra_list:
+        groups.setdefault(spec.catrow[key], []).append(spec)
+
+    os_makedirs(args.cache_dir, exist_ok=True)
+    for cat in local_queue:
+        qsonic.io.save_spectra_cache(
+            groups.get(cat[key][0], []),
+            qsonic.io.get_spectra_cache_fname(cat, args))
+
+
 def mpi_read_calibrate_mask_select_spectra(
         local_queue, maskers, args, comm, mpi_rank
 ):
     """ Read local spectra for the MPI rank. Set forest and observed wavelength
     range. Apply noise and flux calibration and maskers. Remove short spectra,
-    and apply minimum forest SNR cut. Calls the following:
+    and apply minimum forest SNR cut. If ``args.cache_dir`` is set, cached
+    healpixels are loaded instead, and the others are saved to the cache
+    after these steps. Calls the following:
 
+        - :func:`load_cached_spectra`,
         - :func:`mpi_read_spectra_local_queue`,
         - :func:`mpi_noise_flux_calibrate`,
         - :func:`apply_masks`,
-        - :func:`remove_short_spectra`.
+        - :func:`remove_short_spectra`,
+        - :func:`save_spectra_to_cache`,
+        - :func:`mpi_report_memory`.
 
     Arguments
     ---------
@@ -295,6 +685,11 @@ def mpi_read_calibrate_mask_select_spectra(
     spectra_list: list(Spectrum)
         Spectrum objects for the local MPI rank.
     """
+    cached_spectra, local_queue = load_cached_spectra(local_queue, args)
+    if args.cache_dir:
+        ncached = comm.reduce(len(cached_spectra))
+        logging.info(f"Loaded {ncached} spectra from the cache.")
+
     spectra_list = mpi_read_spectra_local_queue(local_queue, args, comm)
 
     mpi_noise_flux_calibrate(spectra_list, args, comm, mpi_rank)
@@ -309,6 +704,11 @@ def mpi_read_calibrate_mask_select_spectra(
     spectra_list = [spec for spec in spectra_list
                     if spec.get_effective_meansnr() >= args.min_forestsnr]
 
+    save_spectra_to_cache(spectra_list, local_queue, args)
+    spectra_list.extend(cached_spectra)
+
+    mpi_report_memory(spectra_list, comm)
+
     return spectra_list
 
 
@@ -461,25 +861,38 @@ def mpi_run_all(comm, mpi_rank, mpi_size):
     zmax_qso = args.wave2 / (args.forest_w1 + tol) - 1
 
     # read catalog
+    cost_model = mpi_get_load_cost_model(args, comm, mpi_rank)
     local_queue = qsonic.catalog.mpi_get_local_queue(
         args.catalog, comm, mpi_rank, mpi_size, args.mock_analysis,
-        args.tile_format, args.keep_surveys, zmin_qso, zmax_qso)
+        args.tile_format, args.keep_surveys, zmin_qso, zmax_qso,
+        cost_function=cost_model, dynamic=args.dynamic_schedule)
+    # Any file can be read by this rank with dynamic scheduling.
+    if args.dynamic_schedule:
+        rank_catalogs = local_queue.split_catalog
+    else:
+        rank_catalogs = local_queue
 
     # Blinding
     if args.mock_analysis:
         maxlastnight = None
     else:
-        maxlastnight = np.max([_['LASTNIGHT'].max() for _ in local_queue])
+        maxlastnight = np.max([_['LASTNIGHT'].max() for _ in rank_catalogs])
         maxlastnight = comm.allreduce(maxlastnight, max)
     qsonic.spectrum.Spectrum.set_blinding(maxlastnight, args)
+    qsonic.spectrum.Spectrum.set_storage_dtype(args.storage_dtype)
 
     # Read masks before data
-    maskers = mpi_read_masks(local_queue, args, comm, mpi_rank)
+    maskers = mpi_read_masks(rank_catalogs, args, comm, mpi_rank)
 
     spectra_list = mpi_read_calibrate_mask_select_spectra(
         local_queue, maskers, args, comm, mpi_rank
     )
 
+    if args.redistribute_spectra:
+        owners = mpi_get_spectra_owners(spectra_list, args, comm)
+        spectra_list = mpi_redistribute_spectra(
+            spectra_list, comm, mpi_rank)
+
     # Create smoothed ivar as intermediate variable
     if args.smoothing_scale > 0:
         for spec in spectra_list:
@@ -496,11 +909,31 @@ def mpi_run_all(comm, mpi_rank, mpi_size):
     for spec in spectra_list:
         spec.drop_short_arms(args.forest_w1, args.forest_w2, args.skip)
 
+    # Each healpix must be on one rank when saving by healpix
+    if args.redistribute_spectra and args.save_by_hpx:
+        spectra_list = mpi_route_spectra_to_owners(
+            spectra_list, owners, args, comm, mpi_rank)
+
     # Save deltas
     logging.info("Saving deltas.")
+    if args.outdir and args.writer_queue_size > 0:
+        writer = qsonic.io.DeltaWriter(args.writer_queue_size)
+    else:
+        writer = None
+
     qsonic.io.save_deltas(
         spectra_list, args.outdir,
-        save_by_hpx=args.save_by_hpx, mpi_rank=mpi_rank)
+        save_by_hpx=args.save_by_hpx, mpi_rank=mpi_rank,
+        delta_format=args.delta_format, writer=writer)
+
+    if writer is not None:
+        throughput = writer.close()
+        wait_time = comm.reduce(writer.wait_time, max)
+        throughput = comm.reduce(throughput, min)
+        if mpi_rank == 0:
+            logging.info(
+                f"Minimum delta write throughput is {throughput:.1f} MB/s. "
+                f"Maximum time waiting for the writer is {wait_time:.1f} s.")
 
 
 def main():
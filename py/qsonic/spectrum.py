@@ -1,4 +1,5 @@
 import argparse
+import sys
 
 import numpy as np
 
@@ -40,9 +41,24 @@ def add_wave_region_parser(parser=None):
 
 
 def generate_spectra_list_from_data(cat_by_survey, data):
+    """Creates Spectrum objects for every row in the catalog. Spectra keep a
+    reference to ``cat_by_survey`` and their row index instead of a copy of
+    the row.
+
+    Arguments
+    ---------
+    cat_by_survey: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Catalog. ``data`` must have the same ordering.
+    data: dict
+        Dictionary of spectral data. See :meth:`Spectrum.from_dictionary`.
+
+    Returns
+    -------
+    list(Spectrum)
+    """
     return [
-        Spectrum.from_dictionary(catrow, data, idx)
-        for idx, catrow in enumerate(cat_by_survey)
+        Spectrum.from_dictionary(cat_by_survey, data, idx)
+        for idx in range(cat_by_survey.size)
     ]
 
 
@@ -51,13 +67,221 @@ def valid_spectra(spectra_list):
     return (spec for spec in spectra_list if spec.cont_params['valid'])
 
 
+def pack_spectra_batches(spectra_list):
+    """Packs spectra into batches without copying memory-mapped forests.
+
+    Spectra whose forests are views of the same memory-mapped array (e.g.
+    loaded from one cached healpix with ``--cache-mmap``) are packed into
+    their own batch, which reuses the mapped columns if the forests are
+    still contiguous. All other spectra are packed into one batch.
+
+    Arguments
+    ---------
+    spectra_list: list(Spectrum)
+        Spectrum objects to pack.
+
+    Returns
+    -------
+    batches: list(SpectraBatch)
+        Batches. Empty if ``spectra_list`` is empty.
+    """
+    groups = {}
+    for spec in spectra_list:
+        key = None
+        for flux_arm in spec.forestflux.values():
+            root = _get_root_array(flux_arm)
+            if isinstance(root, np.memmap):
+                key = id(root)
+            break
+        groups.setdefault(key, []).append(spec)
+
+    return [SpectraBatch(specs) for specs in groups.values()]
+
+
+def memory_footprint(objects):
+    """Total memory in bytes used by Spectrum or Delta objects. See
+    :meth:`Spectrum.memory_footprint`.
+
+    Arguments
+    ---------
+    objects: list(Spectrum) or list(Delta)
+        Objects to account for.
+
+    Returns
+    -------
+    int
+    """
+    return sum(obj.memory_footprint() for obj in objects)
+
+
+def _array_nbytes(arr):
+    """Bytes of an array. ``sys.getsizeof`` includes the buffer only if the
+    array owns its data, so viewed elements are added for views. Memory-mapped
+    arrays are in the page cache, which is shared between processes, so
+    their elements are not counted."""
+    if arr is None:
+        return 0
+    if isinstance(arr, np.memmap):
+        return sys.getsizeof(arr)
+    return sys.getsizeof(arr) + arr.nbytes * (arr.base is not None)
+
+
+def _get_root_array(arr):
+    """Array that owns the memory of ``arr``, or the memory-mapped array it
+    is a view of."""
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr
+
+
+def _get_column_view(segments, dtype):
+    """Returns the column spanned by ``segments`` without copying if they
+    are consecutive views of one contiguous 1D array of ``dtype``.
+    Otherwise, returns None."""
+    if not segments:
+        return None
+
+    root = _get_root_array(segments[0])
+    if (root.ndim != 1 or root.dtype != dtype
+            or not root.flags.c_contiguous):
+        return None
+
+    root_address = root.__array_interface__['data'][0]
+    start = segments[0].__array_interface__['data'][0]
+    address = start
+    for seg in segments:
+        if (seg.dtype != dtype or not seg.flags.c_contiguous
+                or seg.__array_interface__['data'][0] != address
+                or _get_root_array(seg) is not root):
+            return None
+        address += seg.nbytes
+
+    i1 = (start - root_address) // root.itemsize
+    i2 = (address - root_address) // root.itemsize
+    return root[i1:i2]
+
+
+def _dict_of_arrays_nbytes(dicts, seen):
+    """Bytes of dictionaries and the arrays they hold. Objects in ``seen``
+    are not counted again, and ``seen`` is updated."""
+    nbytes = 0
+    for d in dicts:
+        if d is None or id(d) in seen:
+            continue
+        seen.add(id(d))
+        nbytes += sys.getsizeof(d)
+
+        for arr in d.values():
+            if id(arr) not in seen:
+                seen.add(id(arr))
+                nbytes += _array_nbytes(arr)
+
+    return nbytes
+
+
+class ContinuumParams():
+    """Fixed-layout record for the continuum parameters of a Spectrum.
+
+    Fields can be accessed as attributes or items, i.e. ``cont_params.x``
+    and ``cont_params['x']`` are the same. Unknown keys raise ``KeyError``.
+
+    Attributes
+    ----------
+    method: str
+        Continuum fitting method.
+    valid: bool
+        Whether the continuum is valid.
+    x: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Continuum parameters.
+    xcov: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Covariance of continuum parameters.
+    chi2: float
+        Chi2 of the fit. -1 if not set.
+    dof: int
+        Degrees of freedom.
+    cont: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`) or None
+        Continuum in each arm.
+    true_data_w1, true_data_dwave: float or None
+        First wavelength and wavelength spacing of the true continuum.
+    true_data: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+        True continuum.
+    input_w1, input_dwave: float or None
+        First rest-frame wavelength and wavelength spacing of the input
+        continuum.
+    input_data: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+        Input continuum.
+    """
+    __slots__ = (
+        'method', 'valid', 'x', 'xcov', 'chi2', 'dof', 'cont',
+        'true_data_w1', 'true_data_dwave', 'true_data',
+        'input_w1', 'input_dwave', 'input_data')
+
+    def __init__(self):
+        self.method = ''
+        self.valid = False
+        self.x = np.array([1., 0.])
+        self.xcov = np.eye(2)
+        self.chi2 = -1.
+        self.dof = 0
+        self.cont = {}
+        self.true_data_w1 = None
+        self.true_data_dwave = None
+        self.true_data = None
+        self.input_w1 = None
+        self.input_dwave = None
+        self.input_data = None
+
+    def __getitem__(self, key):
+        if key not in ContinuumParams.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in ContinuumParams.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in ContinuumParams.__slots__
+
+    def keys(self):
+        """tuple(str): Field names."""
+        return ContinuumParams.__slots__
+
+    def copy(self):
+        """Shallow copy.
+
+        Returns
+        -------
+        ContinuumParams
+        """
+        new = ContinuumParams.__new__(ContinuumParams)
+        for key in ContinuumParams.__slots__:
+            setattr(new, key, getattr(self, key))
+        return new
+
+    def memory_footprint(self):
+        """int: Memory in bytes used by the record and its arrays."""
+        nbytes = sys.getsizeof(self) + _dict_of_arrays_nbytes(
+            [self.cont], set())
+        for arr in [self.x, self.xcov, self.true_data, self.input_data]:
+            nbytes += _array_nbytes(arr)
+        return nbytes
+
+
 class Spectrum():
     """An object to represent one spectrum.
 
+    Spectrum uses ``__slots__`` to reduce the memory overhead per object.
+
     Parameters
     ----------
     catrow: :external+numpy:py:class:`ndarray <numpy.ndarray>`
-        Catalog row.
+        Catalog row or the entire catalog. Only a reference to the catalog
+        and the row index are stored. If the entire catalog is passed, the
+        row is ``catalog[idx]``, which is how
+        :func:`generate_spectra_list_from_data` creates spectra. A single row
+        is copied into a one-element catalog.
     wave: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
         Dictionary of arrays specifying the wavelength grid. Static variable!
     flux: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
@@ -71,6 +295,10 @@ class Spectrum():
     idx: int
         Index to access in flux, ivar, mask and reso that corresponds to the
         quasar in `catrow`.
+    pix0: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`), optional
+        Dictionary of arrays for the index of the first pixel of flux, ivar,
+        mask and reso in the wavelength grid. Readers that read only the
+        forest window set this. Arms not in the dictionary start at zero.
 
     Attributes
     ----------
@@ -78,12 +306,22 @@ class Spectrum():
         Average SNR above Lya. Calculated in :meth:`set_forest_region`.
     mean_snr: dict(float)
         Mean signal-to-noise ratio in the forest.
+    _pix0: dict(int)
+        Index of the first pixel of :attr:`flux`, :attr:`ivar` and
+        :attr:`reso` in :attr:`wave` for each arm. Missing arms start at zero.
     _f1, _f2: dict(int)
         Forest indices. Set up using :meth:`set_forest_region` method. Then use
         property functions to access forest wave, flux, ivar instead.
-    cont_params: dict
+    cont_params: ContinuumParams
         Continuum parameters. Initial estimates are constructed.
     """
+    __slots__ = (
+        '_catalog', '_icat', '_current_wave', 'flux', 'ivar', 'reso',
+        'rsnr', 'mean_snr', '_pix0', '_f1', '_f2', '_forestwave',
+        '_forestflux', '_forestivar', '_forestivar_sm', '_forestreso',
+        '_forestweight', '_smoothing_scale', 'cont_params', '__weakref__')
+    """tuple(str): Attributes. ``__weakref__`` allows weak references in
+    continuum model caches."""
     WAVE_LYA_A = 1215.67
     """float: Lya wavelength in A."""
     _wave = None
@@ -98,6 +336,10 @@ class Spectrum():
     """str or None: Blinding. Must be set for certain data."""
     _fits_colnames = ['LAMBDA', 'DELTA', 'IVAR', 'WEIGHT', 'CONT']
     """list(str): Column names to save in delta files."""
+    _storage_dtype = np.dtype('f8')
+    """:external+numpy:py:class:`dtype <numpy.dtype>`: Storage type of flux,
+    inverse variance, weight and resolution arrays in Spectrum and Delta
+    objects. Wavelength and continuum are always float64."""
 
     @staticmethod
     def _set_wave(wave, check_consistency=False):
@@ -166,6 +408,19 @@ class Spectrum():
         if not args.skip_resomat:
             Spectrum._fits_colnames.append('RESOMAT')
 
+    @staticmethod
+    def set_storage_dtype(dtype):
+        """Set the storage type of flux, inverse variance, weight and
+        resolution arrays for all Spectrum and Delta objects created
+        afterwards. Sums over pixels are still accumulated in float64.
+
+        Arguments
+        ---------
+        dtype: str or :external+numpy:py:class:`dtype <numpy.dtype>`
+            ``float64`` or ``float32``.
+        """
+        Spectrum._storage_dtype = np.dtype(dtype)
+
     @staticmethod
     def blinding_not_set():
         """bool: ``True`` if blinding is not set."""
@@ -188,7 +443,7 @@ class Spectrum():
         Spectrum
         """
         spec = cls(catrow, data['wave'], data['flux'], data['ivar'],
-                   data['mask'], data['reso'], idx)
+                   data['mask'], data['reso'], idx, data.get('pix0'))
 
         if "cont" in data.keys():
             spec.cont_params['true_data_w1'] = data['cont']['w1']
@@ -197,10 +452,31 @@ class Spectrum():
 
         return spec
 
-    def __init__(self, catrow, wave, flux, ivar, mask, reso, idx):
-        self.catrow = catrow
-        Spectrum._set_wave(wave)
+    @classmethod
+    def _from_catalog(cls, catalog, idx):
+        """Creates a Spectrum without any pixels. Used to unpack forests,
+        e.g. in :meth:`SpectraBatch.from_arrays`.
 
+        Arguments
+        ---------
+        catalog: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Catalog.
+        idx: int
+            Row index in the catalog.
+
+        Returns
+        -------
+        Spectrum
+        """
+        spec = cls.__new__(cls)
+        spec._init_attributes(catalog, idx)
+        spec._current_wave = {}
+        spec.mean_snr = {}
+        return spec
+
+    def _init_attributes(self, catalog, idx):
+        self._catalog = catalog
+        self._icat = idx
         self._current_wave = Spectrum._wave
         self.flux = {}
         self.ivar = {}
@@ -208,6 +484,7 @@ class Spectrum():
 
         self.rsnr = None
         self.mean_snr = None
+        self._pix0 = {}
         self._f1 = {}
         self._f2 = {}
         self._forestwave = {}
@@ -218,10 +495,23 @@ class Spectrum():
         self._forestweight = {}
 
         self._smoothing_scale = 0
+        self.cont_params = ContinuumParams()
+
+    def __init__(self, catrow, wave, flux, ivar, mask, reso, idx,
+                 pix0=None):
+        Spectrum._set_wave(wave)
+        if np.ndim(catrow) == 0:
+            self._init_attributes(np.array([catrow]), 0)
+        else:
+            self._init_attributes(catrow, idx)
 
+        dtype = Spectrum._storage_dtype
         for arm, wave_arm in self.wave.items():
-            self.flux[arm] = flux[arm][idx].copy()
-            self.ivar[arm] = ivar[arm][idx].copy()
+            if pix0 and arm in pix0:
+                self._pix0[arm] = int(pix0[arm][idx])
+
+            self.flux[arm] = flux[arm][idx].astype(dtype)
+            self.ivar[arm] = ivar[arm][idx].astype(dtype)
             w = (mask[arm][idx] != 0) | np.isnan(self.flux[arm]) \
                 | np.isnan(self.ivar[arm]) | (self.ivar[arm] < 0)
             self.flux[arm][w] = 0
@@ -229,19 +519,11 @@ class Spectrum():
 
             if not reso:
                 continue
-            elif reso[arm].ndim == 2:
-                self.reso[arm] = reso[arm].copy()
+            elif isinstance(reso[arm], np.ndarray) and reso[arm].ndim == 2:
+                i0 = self._pix0.get(arm, 0)
+                self.reso[arm] = reso[arm][:, i0:].astype(dtype)
             else:
-                self.reso[arm] = reso[arm][idx].copy()
-
-        self.cont_params = {}
-        self.cont_params['method'] = ''
-        self.cont_params['valid'] = False
-        self.cont_params['x'] = np.array([1., 0.])
-        self.cont_params['xcov'] = np.eye(2)
-        self.cont_params['chi2'] = -1.
-        self.cont_params['dof'] = 0
-        self.cont_params['cont'] = {}
+                self.reso[arm] = reso[arm][idx].astype(dtype)
 
         self._set_rsnr()
 
@@ -254,7 +536,8 @@ class Spectrum():
             # Calculate SNR above Lya
             ii1 = np.searchsorted(
                 wave_arm, (1 + self.z_qso) * Spectrum.WAVE_LYA_A)
-            weight = np.sqrt(self.ivar[arm][ii1:])
+            ii1 = max(0, ii1 - self._pix0.get(arm, 0))
+            weight = np.sqrt(self.ivar[arm][ii1:], dtype=np.float64)
             self.rsnr += np.dot(self.flux[arm][ii1:], weight)
             rsnr_weight += np.sum(weight > 0)
 
@@ -272,15 +555,17 @@ class Spectrum():
             flux_arm = self.forestflux[arm]
             w = flux_arm > 0
 
-            self.cont_params['x'][0] += np.dot(flux_arm[w], ivar_arm[w])
-            cont_params_weight += np.sum(ivar_arm[w])
+            self.cont_params['x'][0] += np.dot(
+                flux_arm[w], ivar_arm[w].astype(np.float64))
+            cont_params_weight += np.sum(ivar_arm[w], dtype=np.float64)
 
             self.mean_snr[arm] = 0
             armpix = np.sum(ivar_arm > 0)
             if armpix == 0:
                 continue
 
-            self.mean_snr[arm] = np.dot(np.sqrt(ivar_arm), flux_arm) / armpix
+            self.mean_snr[arm] = np.dot(
+                np.sqrt(ivar_arm, dtype=np.float64), flux_arm) / armpix
 
         self.cont_params['x'][0] /= cont_params_weight
 
@@ -320,8 +605,12 @@ class Spectrum():
 
         for arm, wave_arm in self.wave.items():
             # Slice to forest limits
+            i0 = self._pix0.get(arm, 0)
             ii1, ii2 = np.searchsorted(wave_arm, [l1, l2])
-            real_size_arm = np.sum(self.ivar[arm][ii1:ii2] > 0)
+            ii1 = max(ii1, i0)
+            # Local indices into flux, ivar and reso
+            jj1, jj2 = ii1 - i0, max(ii1, ii2) - i0
+            real_size_arm = np.sum(self.ivar[arm][jj1:jj2] > 0)
             if real_size_arm == 0:
                 continue
 
@@ -331,10 +620,10 @@ class Spectrum():
             # Slicing creates views, not copies. Bases of views are not removed
             # from memory!
             self._forestwave[arm] = wave_arm[ii1:ii2].copy()
-            self._forestflux[arm] = self.flux[arm][ii1:ii2].copy()
-            self._forestivar[arm] = self.ivar[arm][ii1:ii2].copy()
+            self._forestflux[arm] = self.flux[arm][jj1:jj2].copy()
+            self._forestivar[arm] = self.ivar[arm][jj1:jj2].copy()
             if self.reso:
-                self._forestreso[arm] = self.reso[arm][:, ii1:ii2].copy()
+                self._forestreso[arm] = self.reso[arm][:, jj1:jj2].copy()
 
         self._forestivar_sm = self._forestivar
         self._forestweight = self._forestivar
@@ -379,6 +668,7 @@ class Spectrum():
         self.flux = {}
         self.ivar = {}
         self.reso = {}
+        self._pix0 = {}
 
     def get_real_size(self):
         """
@@ -458,7 +748,8 @@ class Spectrum():
             self._smoothing_scale = smoothing_size
             sigma_pix = smoothing_size / self.dwave
             self._forestivar_sm = {
-                arm: get_smooth_ivar(ivar_arm, sigma_pix)
+                arm: get_smooth_ivar(ivar_arm, sigma_pix).astype(
+                    Spectrum._storage_dtype, copy=False)
                 for arm, ivar_arm in self.forestivar.items()
             }
 
@@ -494,7 +785,9 @@ class Spectrum():
             var_lss = varlss_interp(wave_arm) * cont_est**2
             eta = eta_interp(wave_arm)
             ivar_arm = self.forestivar_sm[arm]
-            self._forestweight[arm] = ivar_arm / (eta + ivar_arm * var_lss)
+            self._forestweight[arm] = (
+                ivar_arm / (eta + ivar_arm * var_lss)
+            ).astype(Spectrum._storage_dtype, copy=False)
 
     def calc_continuum_chi2(self):
         """ Calculate the chi2 of the continuum fitting. This is just a sum
@@ -544,12 +837,13 @@ class Spectrum():
 
         idxes = {}
         for arm, wave_arm in self.wave.items():
+            wave_arm = wave_arm[self._pix0.get(arm, 0):]
             idx = ((wave_arm - min_wave) / self.dwave + 0.1).astype(int)
             idxes[arm] = idx
 
             weight = self.ivar[arm]
 
-            var = np.zeros_like(weight)
+            var = np.zeros(weight.size)
             w = self.ivar[arm] > 0
             var[w] = 1 / self.ivar[arm][w]
 
@@ -567,7 +861,9 @@ class Spectrum():
             coadd_norm *= 0
 
             for arm, reso_arm in self.reso.items():
-                weight = self.ivar[arm].copy()
+                # Resolution matrices read in forest windows can be shorter
+                nreso = reso_arm.shape[1]
+                weight = self.ivar[arm][:nreso].copy()
                 weight[weight == 0] = 1e-8
 
                 ddia = max_ndia - reso_arm.shape[0]
@@ -576,15 +872,17 @@ class Spectrum():
                 if ddia > 0:
                     reso_arm = np.pad(reso_arm, ((ddia, ddia), (0, 0)))
 
-                coadd_reso[:, idxes[arm]] += weight * reso_arm
-                coadd_norm[idxes[arm]] += weight
+                coadd_reso[:, idxes[arm][:nreso]] += weight * reso_arm
+                coadd_norm[idxes[arm][:nreso]] += weight
 
-            coadd_reso /= coadd_norm
-            self.reso = {'brz': coadd_reso}
+            w = coadd_norm > 0
+            coadd_reso[:, w] /= coadd_norm[w]
+            self.reso = {'brz': coadd_reso.astype(Spectrum._storage_dtype)}
 
         self._current_wave = Spectrum._coadd_wave
-        self.flux = {'brz': coadd_flux}
-        self.ivar = {'brz': coadd_ivar}
+        self._pix0 = {}
+        self.flux = {'brz': coadd_flux.astype(Spectrum._storage_dtype)}
+        self.ivar = {'brz': coadd_ivar.astype(Spectrum._storage_dtype)}
 
     def coadd_arms_forest(
             self, varlss_interp=_zero_function, eta_interp=_one_function
@@ -621,7 +919,7 @@ class Spectrum():
 
             weight = self.forestweight[arm]
 
-            var = np.zeros_like(weight)
+            var = np.zeros(weight.size)
             w = self.forestivar[arm] > 0
             var[w] = 1 / self.forestivar[arm][w]
 
@@ -634,8 +932,10 @@ class Spectrum():
         coadd_ivar[w] = coadd_norm[w]**2 / coadd_ivar[w]
 
         self._forestwave = {'brz': coadd_wave}
-        self._forestflux = {'brz': coadd_flux}
-        self._forestivar = {'brz': coadd_ivar}
+        self._forestflux = {
+            'brz': coadd_flux.astype(Spectrum._storage_dtype, copy=False)}
+        self._forestivar = {
+            'brz': coadd_ivar.astype(Spectrum._storage_dtype, copy=False)}
 
         if self.cont_params['cont']:
             coadd_cont = np.empty(nwaves)
@@ -666,7 +966,8 @@ class Spectrum():
                 coadd_norm[idxes[arm]] += weight
 
             coadd_reso /= coadd_norm
-            self._forestreso = {'brz': coadd_reso}
+            self._forestreso = {
+                'brz': coadd_reso.astype(Spectrum._storage_dtype, copy=False)}
 
         self.set_smooth_forestivar(self._smoothing_scale)
         self.set_forest_weight(varlss_interp, eta_interp)
@@ -713,18 +1014,15 @@ class Spectrum():
         rms_in_pixel = np.abs(off_idx).dot(new_ratios) / np.sqrt(2.) / norm
         return rms_in_pixel * 3e5 * self.dwave / lambda_eff
 
-    def write(self, fts_file):
-        """Writes each arm to FITS file separately.
+    def _get_header(self):
+        """Header keys common to all arms and the extension name suffix.
 
-        Writes 'LAMBDA', 'DELTA', 'IVAR', 'WEIGHT', 'CONT' columns and
-        'RESOMAT' column if resolution matrix is present to extension name
-        ``targetid-arm``. FITS file must be initialized before.
-        Each arm has its own `MEANSNR`.
-
-        Arguments
-        ---------
-        fts_file: FITS file
-            The file handler, not filename.
+        Returns
+        -------
+        hdr_dict: dict
+            Header dictionary. ``MEANSNR`` is set to zero.
+        expid: str
+            ``-EXPID`` if catalog has ``EXPID`` column, empty string otherwise.
         """
         hdr_dict = {
             'LOS_ID': self.targetid,
@@ -750,26 +1048,98 @@ class Spectrum():
         else:
             expid = ""
 
+        return hdr_dict, expid
+
+    def _get_arm_table(self, arm, cols, hdr_dict, expid):
+        """Table of a single arm given delta columns. Resolution matrix is
+        appended if present. Header dictionary is copied.
+
+        Returns
+        -------
+        table: dict
+            Keyword arguments to ``fitsio.FITS.write``.
+        """
+        hdr_dict = hdr_dict.copy()
+        hdr_dict['MEANSNR'] = self.mean_snr[arm]
+
+        if self.forestreso:
+            hdr_dict['MEANRESO'] = self.mean_resolution(arm)
+            cols.append(self.forestreso[arm].T.astype('f8'))
+
+        return {
+            'data': cols, 'names': Spectrum._fits_colnames,
+            'header': hdr_dict, 'extname': f"{self.targetid}-{arm}{expid}"}
+
+    def get_tables(self):
+        """Delta tables of each arm without writing. See :meth:`write`.
+
+        Returns
+        -------
+        tables: list(dict)
+            Keyword arguments to ``fitsio.FITS.write`` for each arm.
+        """
+        hdr_dict, expid = self._get_header()
+        tables = []
+
         for arm, wave_arm in self.forestwave.items():
             if self.mean_snr[arm] == 0:
                 continue
 
-            hdr_dict['MEANSNR'] = self.mean_snr[arm]
-
             cont_est = self.cont_params['cont'][arm]
             delta = self.forestflux[arm] / cont_est - 1
             ivar = self.forestivar[arm] * cont_est**2
             weight = self.forestweight[arm] * cont_est**2
             delta[ivar == 0] = 0
 
-            cols = [wave_arm, delta, ivar, weight, cont_est]
-            if self.forestreso:
-                hdr_dict['MEANRESO'] = self.mean_resolution(arm)
-                cols.append(self.forestreso[arm].T.astype('f8'))
+            tables.append(self._get_arm_table(
+                arm, [wave_arm, delta, ivar, weight, cont_est],
+                hdr_dict, expid))
+
+        return tables
+
+    def write(self, fts_file):
+        """Writes each arm to FITS file separately.
+
+        Writes 'LAMBDA', 'DELTA', 'IVAR', 'WEIGHT', 'CONT' columns and
+        'RESOMAT' column if resolution matrix is present to extension name
+        ``targetid-arm``. FITS file must be initialized before.
+        Each arm has its own `MEANSNR`. See :meth:`SpectraBatch.write` to
+        write many spectra.
+
+        Arguments
+        ---------
+        fts_file: FITS file
+            The file handler, not filename.
+        """
+        for table in self.get_tables():
+            fts_file.write(**table)
 
-            fts_file.write(
-                cols, names=Spectrum._fits_colnames, header=hdr_dict,
-                extname=f"{self.targetid}-{arm}{expid}")
+    def memory_footprint(self):
+        """Memory in bytes used by this object, its dictionaries and arrays.
+        Arrays that own their data count their buffers. Views, e.g. forests
+        bound to a :class:`SpectraBatch`, count the size of the viewed
+        elements. Shared catalog and static wavelength grids are excluded.
+
+        Returns
+        -------
+        int
+        """
+        nbytes = sys.getsizeof(self) + self.cont_params.memory_footprint()
+        nbytes += _dict_of_arrays_nbytes([
+            self.flux, self.ivar, self.reso, self._forestwave,
+            self._forestflux, self._forestivar, self._forestivar_sm,
+            self._forestreso, self._forestweight], set())
+
+        for d in [self.mean_snr, self._pix0, self._f1, self._f2]:
+            if d is not None:
+                nbytes += sys.getsizeof(d)
+
+        return nbytes
+
+    @property
+    def catrow(self):
+        """:external+numpy:py:class:`ndarray <numpy.ndarray>`: Catalog row."""
+        return self._catalog[self._icat]
 
     @property
     def z_qso(self):
@@ -847,6 +1217,624 @@ class Spectrum():
         return self._forestreso
 
 
+class SpectraBatch():
+    """Columnar store for the forests of many spectra.
+
+    Forest pixels of all spectra and arms are concatenated into a few large
+    contiguous arrays. Each (spectrum, arm) pair is a segment. Pixels of
+    segment ``k`` are ``offsets[k]:offsets[k + 1]``, and segments of spectrum
+    ``i`` are ``spec_offsets[i]:spec_offsets[i + 1]``. Operations such as
+    stacking, variance statistics, masking and writing are then performed on
+    the whole batch at once instead of looping over spectra and arms.
+
+    Forest dictionaries of Spectrum objects are not modified by default. Call
+    :meth:`bind` to replace them with views of the batch arrays, after which
+    the Spectrum objects act as thin views and in-place modifications are
+    shared. Structural modifications of a Spectrum (e.g.
+    :meth:`Spectrum.drop_arm`, :meth:`Spectrum.coadd_arms_forest`) replace its
+    views and do not update the batch. Create a new batch after those.
+    Continuum fits replace the weight and continuum arrays of spectra. Call
+    :meth:`update_fit_results` to copy them back into a bound batch, which
+    is how :class:`qsonic.picca_continuum.PiccaContinuumFitter` keeps a
+    single batch during iterations.
+
+    Without binding, a batch is a temporary copy, e.g. to write deltas of a
+    healpix in :func:`qsonic.io.save_deltas`.
+
+    Wavelength, flux and inverse variance columns are not copied if these
+    forests are already consecutive views of one array, e.g. a bound batch
+    or memory-mapped arrays from :meth:`from_arrays`. The batch then shares
+    memory with that array, and memory-mapped forests stay mapped. Weights
+    and continua are always copied. See :func:`pack_spectra_batches`.
+
+    Resolution matrices are not stored in the batch.
+
+    Parameters
+    ----------
+    spectra_list: list(Spectrum)
+        Spectrum objects to pack.
+
+    Attributes
+    ----------
+    spectra: list(Spectrum)
+        Packed Spectrum objects.
+    arms: list(str)
+        Arm names. :attr:`arm_index` points to this list.
+    offsets: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Pixel offsets of segments. Size is ``nseg + 1``.
+    spec_offsets: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Segment offsets of spectra. Size is ``nspec + 1``.
+    spec_index: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Spectrum index of each segment.
+    arm_index: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Arm index of each segment.
+    z_qso: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Quasar redshifts of spectra.
+    valid: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        ``cont_params['valid']`` of spectra at the time of packing.
+    wave, flux, ivar, ivar_sm, weight: \
+            :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Forest wavelength, flux, inverse variance, smoothed inverse variance
+        and weight fields.
+    cont: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+        Continuum. Zero for spectra without a continuum.
+    """
+    _columns = {
+        'wave': '_forestwave', 'flux': '_forestflux', 'ivar': '_forestivar',
+        'ivar_sm': '_forestivar_sm', 'weight': '_forestweight'
+    }
+    """dict: Batch column names mapped to Spectrum attributes."""
+    _storage_columns = ('flux', 'ivar', 'ivar_sm', 'weight')
+    """tuple(str): Columns stored in :attr:`Spectrum._storage_dtype`."""
+    _view_columns = ('wave', 'flux', 'ivar', 'ivar_sm')
+    """tuple(str): Columns that are not copied if forests are contiguous.
+    Weights and continua are overwritten by fits, so they are always
+    copied."""
+    _flat_header_keys = (
+        'BLINDING', 'WAVE_SOLUTION', 'DELTA_LAMBDA', 'SMSCALE')
+    """tuple(str): Header keys common to all spectra in the flat delta
+    format. See :meth:`write_flat`."""
+
+    def __init__(self, spectra_list):
+        self.spectra = list(spectra_list)
+        self.arms = []
+        nspec = len(self.spectra)
+
+        segments = {key: [] for key in SpectraBatch._columns}
+        segments['cont'] = []
+        sizes, spec_index, arm_index = [], [], []
+        self.spec_offsets = np.zeros(nspec + 1, dtype=int)
+        self.z_qso = np.empty(nspec)
+        self.valid = np.empty(nspec, dtype=bool)
+
+        for i, spec in enumerate(self.spectra):
+            self.z_qso[i] = spec.z_qso
+            self.valid[i] = spec.cont_params['valid']
+            cont = spec.cont_params['cont']
+
+            for arm, wave_arm in spec.forestwave.items():
+                if arm not in self.arms:
+                    self.arms.append(arm)
+
+                for key, attr in SpectraBatch._columns.items():
+                    segments[key].append(getattr(spec, attr)[arm])
+
+                if cont and arm in cont:
+                    segments['cont'].append(cont[arm])
+                else:
+                    segments['cont'].append(np.zeros(wave_arm.size))
+
+                sizes.append(wave_arm.size)
+                spec_index.append(i)
+                arm_index.append(self.arms.index(arm))
+
+            self.spec_offsets[i + 1] = len(sizes)
+
+        self.offsets = np.zeros(len(sizes) + 1, dtype=int)
+        np.cumsum(sizes, out=self.offsets[1:])
+        self.spec_index = np.array(spec_index, dtype=int)
+        self.arm_index = np.array(arm_index, dtype=int)
+
+        for key, values in segments.items():
+            if key in SpectraBatch._storage_columns:
+                dtype = Spectrum._storage_dtype
+            else:
+                dtype = np.float64
+
+            column = None
+            if key in SpectraBatch._view_columns:
+                column = _get_column_view(values, dtype)
+            if column is None and values:
+                column = np.concatenate(values, dtype=dtype)
+            elif column is None:
+                column = np.empty(0, dtype=dtype)
+            setattr(self, key, column)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Unpacks the output of :meth:`to_arrays` into a new batch of new
+        Spectrum objects. Batch columns are the arrays in ``arrays`` without
+        copying if they already have the storage type, and forests of the
+        spectra are views of these columns. Therefore, memory-mapped arrays
+        stay memory-mapped. Smoothed inverse variance and
+        weights of the spectra point to :attr:`Spectrum.forestivar` as after
+        :meth:`Spectrum.set_forest_region`. Continua are not set. If
+        ``arrays`` has continua (``to_arrays(with_continuum=True)``),
+        weights, continua, validity and smoothing scales are set instead.
+
+        Arguments
+        ---------
+        arrays: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Arrays from :meth:`to_arrays`.
+
+        Returns
+        -------
+        SpectraBatch
+        """
+        batch = cls.__new__(cls)
+        batch.arms = [str(arm) for arm in arrays['arms']]
+        batch.offsets = arrays['offsets']
+        batch.spec_offsets = arrays['spec_offsets']
+        batch.arm_index = arrays['arm_index']
+        nspec = batch.spec_offsets.size - 1
+        batch.spec_index = np.repeat(
+            np.arange(nspec), np.diff(batch.spec_offsets))
+
+        dtype = Spectrum._storage_dtype
+        batch.wave = arrays['wave'].astype(np.float64, copy=False)
+        batch.flux = arrays['flux'].astype(dtype, copy=False)
+        batch.ivar = arrays['ivar'].astype(dtype, copy=False)
+        batch.ivar_sm = batch.ivar
+        batch.weight = batch.ivar
+        batch.cont = np.zeros(batch.size)
+        with_continuum = 'cont' in arrays
+        if with_continuum:
+            batch.weight = arrays['weight'].astype(dtype, copy=False)
+            batch.cont = arrays['cont'].astype(np.float64, copy=False)
+        reso = arrays.get('reso')
+        if reso is not None:
+            reso = reso.astype(dtype, copy=False)
+        true_data = arrays.get('true_data')
+
+        batch.spectra = []
+        for i in range(nspec):
+            spec = Spectrum._from_catalog(arrays['catalog'], i)
+            spec.rsnr = float(arrays['rsnr'][i])
+            spec.cont_params['x'][0] = arrays['x0'][i]
+            if true_data is not None:
+                spec.cont_params['true_data_w1'] = \
+                    float(arrays['true_data_w1'][i])
+                spec.cont_params['true_data_dwave'] = \
+                    float(arrays['true_data_dwave'][i])
+                spec.cont_params['true_data'] = true_data[i]
+
+            for k in range(batch.spec_offsets[i], batch.spec_offsets[i + 1]):
+                arm = batch.arms[batch.arm_index[k]]
+                sl = np.s_[batch.offsets[k]:batch.offsets[k + 1]]
+                spec.mean_snr[arm] = float(arrays['mean_snr'][k])
+                spec._f1[arm] = int(arrays['f1'][k])
+                spec._f2[arm] = int(arrays['f2'][k])
+                spec._forestwave[arm] = batch.wave[sl]
+                spec._forestflux[arm] = batch.flux[sl]
+                spec._forestivar[arm] = batch.ivar[sl]
+                if reso is not None:
+                    spec._forestreso[arm] = reso[:, sl]
+                if with_continuum:
+                    spec._forestweight[arm] = batch.weight[sl]
+                    spec.cont_params['cont'][arm] = batch.cont[sl]
+
+            spec._forestivar_sm = spec._forestivar
+            if with_continuum:
+                spec.cont_params['valid'] = bool(arrays['valid'][i])
+                spec._smoothing_scale = float(arrays['smoothing_scale'][i])
+            else:
+                spec._forestweight = spec._forestivar
+            batch.spectra.append(spec)
+
+        batch.z_qso = np.array([spec.z_qso for spec in batch.spectra])
+        if with_continuum:
+            batch.valid = arrays['valid'].astype(bool)
+        else:
+            batch.valid = np.zeros(nspec, dtype=bool)
+
+        return batch
+
+    def to_arrays(self, with_continuum=False):
+        """Packs the batch, resolution matrices and the quantities that are
+        calculated while reading into a dictionary of plain arrays, which can
+        be saved or communicated without pickling. Only the state up to
+        masking is stored by default: smoothed inverse variance, weights and
+        continua are not. Resolution matrices are stored if every segment
+        has one. Their diagonals are padded to the largest number of
+        diagonals.
+
+        Arguments
+        ---------
+        with_continuum: bool, default: False
+            Also stores the state needed to save deltas after continuum
+            fitting: weights, continua, validity and smoothing scales.
+
+        Returns
+        -------
+        arrays: dict(:external+numpy:py:class:`ndarray <numpy.ndarray>`)
+            Keys are ``arms, offsets, spec_offsets, arm_index, wave, flux,
+            ivar, rsnr, x0, mean_snr, f1, f2`` and ``catalog`` if the batch is
+            not empty. Optional keys are ``reso`` with shape
+            ``(ndiags, size)``, ``true_data, true_data_w1,
+            true_data_dwave`` and ``weight, cont, valid, smoothing_scale``
+            if ``with_continuum``.
+        """
+        arrays = {
+            'arms': np.array(self.arms, dtype='U3'),
+            'offsets': self.offsets,
+            'spec_offsets': self.spec_offsets,
+            'arm_index': self.arm_index,
+            'wave': self.wave,
+            'flux': self.flux,
+            'ivar': self.ivar,
+            'rsnr': np.array(
+                [spec.rsnr for spec in self.spectra], dtype=float),
+            'x0': np.array(
+                [spec.cont_params['x'][0] for spec in self.spectra],
+                dtype=float),
+            'mean_snr': np.empty(self.nseg),
+            'f1': np.empty(self.nseg, dtype=int),
+            'f2': np.empty(self.nseg, dtype=int)
+        }
+        if with_continuum:
+            arrays['weight'] = self.weight
+            arrays['cont'] = self.cont
+            arrays['valid'] = self.valid
+            arrays['smoothing_scale'] = np.array(
+                [spec._smoothing_scale for spec in self.spectra],
+                dtype=float)
+
+        reso = []
+        for k in range(self.nseg):
+            spec = self.spectra[self.spec_index[k]]
+            arm = self.arms[self.arm_index[k]]
+            arrays['mean_snr'][k] = spec.mean_snr[arm]
+            arrays['f1'][k] = spec._f1.get(arm, 0)
+            arrays['f2'][k] = spec._f2.get(arm, 0)
+            if arm in spec.forestreso:
+                reso.append(spec.forestreso[arm])
+
+        if reso and len(reso) == self.nseg:
+            max_ndia = max(reso_arm.shape[0] for reso_arm in reso)
+            reso = [
+                np.pad(r, (((max_ndia - r.shape[0]) // 2,) * 2, (0, 0)))
+                for r in reso]
+            arrays['reso'] = np.concatenate(
+                reso, axis=1, dtype=Spectrum._storage_dtype)
+
+        if self.nspec == 0:
+            return arrays
+
+        arrays['catalog'] = np.concatenate(
+            [spec._catalog[[spec._icat]] for spec in self.spectra])
+
+        if self.spectra[0].cont_params['true_data'] is not None:
+            for key in ['true_data', 'true_data_w1', 'true_data_dwave']:
+                arrays[key] = np.array(
+                    [spec.cont_params[key] for spec in self.spectra])
+
+        return arrays
+
+    @property
+    def nspec(self):
+        """int: Number of spectra."""
+        return len(self.spectra)
+
+    @property
+    def nseg(self):
+        """int: Number of (spectrum, arm) segments."""
+        return self.spec_index.size
+
+    @property
+    def size(self):
+        """int: Total number of pixels."""
+        return self.offsets[-1]
+
+    @property
+    def segment_sizes(self):
+        """:external+numpy:py:class:`ndarray <numpy.ndarray>`: Number of
+        pixels in each segment."""
+        return np.diff(self.offsets)
+
+    def get_pixel_segment_index(self):
+        """
+        Returns
+        -------
+        :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Segment index of every pixel.
+        """
+        return np.repeat(np.arange(self.nseg), self.segment_sizes)
+
+    def get_pixel_z_qso(self):
+        """
+        Returns
+        -------
+        :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Quasar redshift of every pixel.
+        """
+        return np.repeat(self.z_qso[self.spec_index], self.segment_sizes)
+
+    def get_wave_rf(self):
+        """
+        Returns
+        -------
+        :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Rest-frame wavelength of every pixel.
+        """
+        return self.wave / (1 + self.get_pixel_z_qso())
+
+    def bind(self):
+        """Replaces forest dictionaries of spectra and ``cont_params['cont']``
+        with views of the batch arrays. Dictionaries that point to the same
+        object, e.g. :attr:`Spectrum.forestivar_sm` and
+        :attr:`Spectrum.forestivar` before smoothing, keep pointing to the
+        same object.
+        """
+        for k in range(self.nseg):
+            spec = self.spectra[self.spec_index[k]]
+            arm = self.arms[self.arm_index[k]]
+            sl = np.s_[self.offsets[k]:self.offsets[k + 1]]
+
+            bound = []
+            for key, attr in SpectraBatch._columns.items():
+                forest_dict = getattr(spec, attr)
+                if any(forest_dict is _ for _ in bound):
+                    continue
+                forest_dict[arm] = getattr(self, key)[sl]
+                bound.append(forest_dict)
+
+            cont = spec.cont_params['cont']
+            if cont and arm in cont:
+                cont[arm] = self.cont[sl]
+
+    def update_fit_results(self):
+        """Copies ``cont_params['valid']``, weights and continua of spectra
+        into the batch after continuum fitting, and binds them as views
+        again. Spectra without a continuum have zero continuum. The weight
+        and continuum arrays created by the fits are then released, so the
+        batch remains the only storage.
+        """
+        for i, spec in enumerate(self.spectra):
+            self.valid[i] = spec.cont_params['valid']
+
+        for k in range(self.nseg):
+            spec = self.spectra[self.spec_index[k]]
+            arm = self.arms[self.arm_index[k]]
+            sl = np.s_[self.offsets[k]:self.offsets[k + 1]]
+
+            self.weight[sl] = spec.forestweight[arm]
+            cont = spec.cont_params['cont']
+            if cont and arm in cont:
+                self.cont[sl] = cont[arm]
+            else:
+                self.cont[sl] = 0
+
+        self.bind()
+
+    def mask(self, w):
+        """Masks pixels by setting **only** :attr:`flux` and :attr:`ivar` to
+        zero. Bound spectra are masked as well.
+
+        Arguments
+        ---------
+        w: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Bool array of size :attr:`size`. True pixels are masked.
+        """
+        self.flux[w] = 0
+        self.ivar[w] = 0
+
+    def get_valid_pixels(self, selected=None):
+        """
+        Arguments
+        ---------
+        selected: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Bool array of size :attr:`nspec` to select spectra, e.g. a
+            subsample. None selects all spectra.
+
+        Returns
+        -------
+        :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Bool array that is True for pixels of valid (and selected)
+            spectra with a positive continuum.
+        """
+        valid = self.valid
+        if selected is not None:
+            valid = valid & selected
+        w = np.repeat(valid[self.spec_index], self.segment_sizes)
+        return w & (self.cont > 0)
+
+    def get_offsets(self, w):
+        """Segment offsets of the pixels selected by ``w`` after masking.
+        Segments without selected pixels are skipped.
+
+        Arguments
+        ---------
+        w: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Bool array of size :attr:`size`.
+
+        Returns
+        -------
+        offsets: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Pixel offsets of nonempty segments in ``array[w]``.
+        """
+        sizes = np.bincount(
+            self.get_pixel_segment_index()[w], minlength=self.nseg)
+        sizes = sizes[sizes > 0]
+        offsets = np.zeros(sizes.size + 1, dtype=int)
+        np.cumsum(sizes, out=offsets[1:])
+
+        return offsets
+
+    def get_deltas(self, w=None):
+        """Calculates delta, inverse variance and weight fields for the
+        whole batch or the pixels selected by ``w``. Pixels without a
+        continuum are zero.
+
+        Arguments
+        ---------
+        w: :external+numpy:py:class:`ndarray <numpy.ndarray>` or None
+            Bool array of size :attr:`size` to select pixels. None selects
+            all pixels.
+
+        Returns
+        -------
+        delta: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Deltas.
+        ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Inverse variance of deltas.
+        weight: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Weight of deltas.
+        """
+        if w is None:
+            flux, ivar, weight, cont = (
+                self.flux, self.ivar, self.weight, self.cont)
+        else:
+            flux, ivar, weight, cont = (
+                self.flux[w], self.ivar[w], self.weight[w], self.cont[w])
+
+        delta = np.divide(
+            flux, cont, out=np.ones(cont.size), where=cont > 0) - 1
+        cont2 = cont**2
+        ivar = ivar * cont2
+        weight = weight * cont2
+        delta[ivar == 0] = 0
+
+        return delta, ivar, weight
+
+    def get_tables(self, delta_format="hdu"):
+        """Delta tables of valid spectra without writing. Deltas are
+        calculated for the whole batch. See :meth:`write` and
+        :meth:`write_flat` for the file formats.
+
+        Arguments
+        ---------
+        delta_format: str, default: "hdu"
+            ``hdu`` for a table for each arm. ``flat`` for the index and
+            deltas tables.
+
+        Returns
+        -------
+        tables: list(dict)
+            Keyword arguments to ``fitsio.FITS.write`` for each table.
+        """
+        if delta_format == "flat":
+            return self._get_flat_tables()
+
+        delta, ivar, weight = self.get_deltas()
+        tables = []
+
+        for i, spec in enumerate(self.spectra):
+            if not self.valid[i]:
+                continue
+
+            hdr_dict, expid = spec._get_header()
+
+            for k in range(self.spec_offsets[i], self.spec_offsets[i + 1]):
+                arm = self.arms[self.arm_index[k]]
+                if spec.mean_snr[arm] == 0:
+                    continue
+
+                sl = np.s_[self.offsets[k]:self.offsets[k + 1]]
+                cols = [self.wave[sl], delta[sl], ivar[sl], weight[sl],
+                        self.cont[sl]]
+                tables.append(
+                    spec._get_arm_table(arm, cols, hdr_dict, expid))
+
+        return tables
+
+    def write(self, fts_file):
+        """Writes each arm of valid spectra to FITS file separately. Deltas
+        are calculated for the whole batch before writing. See
+        :meth:`Spectrum.write` for the file format.
+
+        Arguments
+        ---------
+        fts_file: FITS file
+            The file handler, not filename.
+        """
+        for table in self.get_tables():
+            fts_file.write(**table)
+
+    def write_flat(self, fts_file):
+        """Writes valid spectra in the flat delta format: one ``DELTAS``
+        table with the pixels of all arms concatenated and one ``INDEX``
+        table with a row for each arm. Index columns are ``ARM``, ``OFFSET``
+        and ``LENGTH`` of the pixels in the ``DELTAS`` table, and the header
+        keys of :meth:`Spectrum.write` that differ between spectra (e.g.
+        ``TARGETID, Z, MEANSNR, RSNR``). Keys in :attr:`_flat_header_keys`
+        are written to the ``INDEX`` header. Columns of ``DELTAS`` are the
+        same as :meth:`Spectrum.write`. Nothing is written if there are no
+        valid spectra.
+
+        Arguments
+        ---------
+        fts_file: FITS file
+            The file handler, not filename.
+        """
+        for table in self.get_tables("flat"):
+            fts_file.write(**table)
+
+    def _get_flat_tables(self):
+        rows, reso = [], []
+        keep = np.zeros(self.nseg, dtype=bool)
+        for i, spec in enumerate(self.spectra):
+            if not self.valid[i]:
+                continue
+
+            hdr_dict, _ = spec._get_header()
+
+            for k in range(self.spec_offsets[i], self.spec_offsets[i + 1]):
+                arm = self.arms[self.arm_index[k]]
+                if spec.mean_snr[arm] == 0:
+                    continue
+
+                row = hdr_dict.copy()
+                row['ARM'] = arm
+                row['MEANSNR'] = spec.mean_snr[arm]
+                if spec.forestreso:
+                    row['MEANRESO'] = spec.mean_resolution(arm)
+                    reso.append(spec.forestreso[arm])
+                rows.append(row)
+                keep[k] = True
+
+        if not rows:
+            return []
+
+        header = {key: rows[0][key] for key in SpectraBatch._flat_header_keys}
+        lengths = self.segment_sizes[keep]
+        index_cols = {
+            key: np.array([row[key] for row in rows]) for key in rows[0]
+            if key not in header}
+        index_cols['LENGTH'] = lengths
+        index_cols['OFFSET'] = np.cumsum(lengths) - lengths
+        tables = [{
+            'data': list(index_cols.values()),
+            'names': list(index_cols.keys()),
+            'header': header, 'extname': "INDEX"}]
+
+        w = np.repeat(keep, self.segment_sizes)
+        delta, ivar, weight = self.get_deltas()
+        cols = [self.wave[w], delta[w], ivar[w], weight[w], self.cont[w]]
+        if reso:
+            max_ndia = max(reso_arm.shape[0] for reso_arm in reso)
+            reso = [
+                np.pad(r, (((max_ndia - r.shape[0]) // 2,) * 2, (0, 0)))
+                for r in reso]
+            cols.append(np.concatenate(reso, axis=1, dtype='f8').T)
+
+        cols = [col.astype('f8', copy=False) for col in cols]
+        tables.append({
+            'data': cols, 'names': Spectrum._fits_colnames,
+            'extname': "DELTAS"})
+
+        return tables
+
+
 class Delta():
     """An object to read one delta from HDU.
 
@@ -874,9 +1862,9 @@ class Delta():
     ivar: :external+numpy:py:class:`ndarray <numpy.ndarray>`
         Inverse variance.
     weight: :external+numpy:py:class:`ndarray <numpy.ndarray>`
-        Weights, which includes var_lss.
+        Weights, which includes var_lss. ``None`` if not read.
     cont: :external+numpy:py:class:`ndarray <numpy.ndarray>`
-        Continuum.
+        Continuum. ``None`` if not read.
     reso: :external+numpy:py:class:`ndarray <numpy.ndarray>`
         Resolution matrix. ``None`` if not present.
     header: FITS header
@@ -886,6 +1874,10 @@ class Delta():
     mean_snr: float
         MEANSNR from header.
     """
+    __slots__ = (
+        'header', 'targetid', 'mean_snr', 'wave', 'delta', 'ivar', 'weight',
+        'cont', 'reso', '_is_blinded')
+    """tuple(str): Attributes."""
     _accepted_wave_columns = set(["LAMBDA", "LOGLAM"])
     """set: Supported column names for wavelength."""
     _accepted_delta_columns = set(['DELTA', 'DELTA_BLIND'])
@@ -909,7 +1901,31 @@ class Delta():
         return key.pop()
 
     def __init__(self, hdu):
-        self.header = hdu.read_header()
+        self._init_from_table(hdu.read_header(), hdu.read())
+
+    @classmethod
+    def from_table(cls, header, data):
+        """Creates a Delta from a header and table rows, e.g. a slice of the
+        flat delta format. See :func:`qsonic.io.read_deltas`.
+
+        Arguments
+        ---------
+        header: dict or FITS header
+            Header keys. Must have ``MEANSNR`` and one of the accepted
+            TARGETID keys.
+        data: :external+numpy:py:class:`ndarray <numpy.ndarray>`
+            Structured array with the delta columns.
+
+        Returns
+        -------
+        Delta
+        """
+        delta = cls.__new__(cls)
+        delta._init_from_table(header, data)
+        return delta
+
+    def _init_from_table(self, header, data):
+        self.header = header
         key = Delta._accepted_targetid_keys.intersection(self.header.keys())
         if not key:
             raise RuntimeError(
@@ -920,8 +1936,7 @@ class Delta():
         self.targetid = self.header[key]
         self.mean_snr = self.header['MEANSNR']
 
-        colnames = hdu.get_colnames()
-        data = hdu.read()
+        colnames = data.dtype.names
 
         key = Delta._check_hdu(colnames, "wave")
         if key == "LOGLAM":
@@ -929,20 +1944,41 @@ class Delta():
         else:
             self.wave = data[key].astype("f8")
 
+        dtype = Spectrum._storage_dtype
         key = Delta._check_hdu(colnames, "delta")
         self._is_blinded = key == "DELTA_BLIND"
-        self.delta = data[key].astype("f8")
-        self.ivar = data['IVAR'].astype("f8")
-        self.weight = data['WEIGHT'].astype("f8")
-        self.cont = data['CONT'].astype("f8")
+        self.delta = data[key].astype(dtype)
+        self.ivar = data['IVAR'].astype(dtype)
+        if 'WEIGHT' in colnames:
+            self.weight = data['WEIGHT'].astype(dtype)
+        else:
+            self.weight = None
+        if 'CONT' in colnames:
+            self.cont = data['CONT'].astype("f8")
+        else:
+            self.cont = None
 
         self.delta[self.ivar == 0] = 0
 
         if 'RESOMAT' in colnames:
-            self.reso = data['RESOMAT'].T.astype("f8")
+            self.reso = data['RESOMAT'].T.astype(dtype)
         else:
             self.reso = None
 
+    def memory_footprint(self):
+        """Memory in bytes used by this object, its header and arrays. See
+        :meth:`Spectrum.memory_footprint`.
+
+        Returns
+        -------
+        int
+        """
+        nbytes = sys.getsizeof(self) + sys.getsizeof(self.header)
+        for arr in [self.wave, self.delta, self.ivar, self.weight, self.cont,
+                    self.reso]:
+            nbytes += _array_nbytes(arr)
+        return nbytes
+
     def write(self, fts_file):
         """Writes to FITS file. This function is aimed at saving coadded
         deltas.
@@ -969,6 +2005,8 @@ class Delta():
             cols.append(self.reso.T)
             names.append('RESOMAT')
 
+        cols = [col.astype('f8', copy=False) for col in cols]
+
         fts_file.write(
             cols, names=names, header=hdr_dict,
             extname=f"{self.targetid}")
@@ -992,7 +2030,7 @@ class Delta():
             coadd_norm[idxes[j]] += weight
 
         coadd_reso /= coadd_norm
-        self.reso = coadd_reso
+        self.reso = coadd_reso.astype(Spectrum._storage_dtype, copy=False)
 
     def coadd(self, other, dwave=0.8):
         min_wave = min(self.wave[0], other.wave[0])
@@ -1012,7 +2050,7 @@ class Delta():
             idx = np.s_[i0:i0 + obj.wave.size]
             idxes[j] = idx
 
-            var = np.zeros_like(obj.weight)
+            var = np.zeros(obj.weight.size)
             w = (obj.weight > 0) & (obj.ivar > 0)
             var[w] = 1 / obj.ivar[w]
 
@@ -1031,10 +2069,12 @@ class Delta():
         if self.reso is not None:
             self._coadd_reso(other, nwaves, idxes)
 
+        dtype = Spectrum._storage_dtype
         self.wave = coadd_wave
-        self.delta = coadd_delta
-        self.ivar = coadd_ivar
-        self.weight = self.ivar / (1 + self.ivar * coadd_lss)
+        self.delta = coadd_delta.astype(dtype, copy=False)
+        self.ivar = coadd_ivar.astype(dtype, copy=False)
+        self.weight = (coadd_ivar / (1 + coadd_ivar * coadd_lss)).astype(
+            dtype, copy=False)
         self.cont = coadd_cont
 
         self.mean_snr = np.dot(
@@ -7,6 +7,7 @@ import numpy as np
 import numpy.testing as npt
 
 import qsonic.io
+import qsonic.spectrum
 
 
 class TestIOParsers(object):
@@ -33,6 +34,30 @@ class TestIOParsers(object):
 
 
 class TestIOReading(object):
+    def test_read_imagehdu(self, tmp_path):
+        rng = np.random.default_rng(1)
+        flux = rng.random((20, 50))
+        reso = rng.random((20, 5, 50))
+        fname = tmp_path / "image.fits"
+        with fitsio.FITS(fname, 'rw', clobber=True) as fts:
+            fts.write(flux, extname="FLUX")
+            fts.write(reso, extname="RESOLUTION")
+
+        pix1 = rng.integers(0, 30, size=20)
+        pix2 = pix1 + rng.integers(0, 20, size=20)
+        with fitsio.FITS(fname) as fts:
+            for rows in [np.array([7, 2, 3, 4, 12, 11]),
+                         rng.permutation(20)]:
+                for hdu, truth in zip(["FLUX", "RESOLUTION"], [flux, reso]):
+                    data = qsonic.io._read_imagehdu(fts[hdu], rows)
+                    npt.assert_allclose(data, truth[rows])
+
+                    data = qsonic.io._read_imagehdu_windows(
+                        fts[hdu], rows, pix1[rows], pix2[rows])
+                    for j, row in enumerate(rows):
+                        npt.assert_allclose(
+                            data[j], truth[row, ..., pix1[row]:pix2[row]])
+
     def test_read_onehealpix_file_data_coadd(self, my_setup_fits):
         cat_by_survey, input_dir, xarms, indata = my_setup_fits
 
@@ -58,6 +83,89 @@ class TestIOReading(object):
         with pytest.raises(Exception, match=expected_msg):
             qsonic.io.save_deltas([], "outdir", None)
 
+    def test_delta_writer(self, tmp_path, setup_data):
+        cat_by_survey, _, data = setup_data(3)
+        cat_by_survey['HPXPIXEL'] = 8258
+        cat_by_survey['Z'] = [2.5, 2.6, 2.7]
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1180.)
+            spec.remove_nonforest_pixels()
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+        qsonic.spectrum.Spectrum._blinding = "none"
+
+        (tmp_path / "sync").mkdir()
+        (tmp_path / "async").mkdir()
+        qsonic.io.save_deltas(
+            spectra_list, tmp_path / "sync", save_by_hpx=True)
+
+        writer = qsonic.io.DeltaWriter(maxsize=1)
+        qsonic.io.save_deltas(
+            spectra_list, tmp_path / "async", save_by_hpx=True,
+            writer=writer)
+        assert (writer.close() > 0)
+        assert (writer.nbytes > 0)
+
+        deltas1 = qsonic.io.read_deltas(tmp_path / "sync/delta-8258.fits")
+        deltas2 = qsonic.io.read_deltas(tmp_path / "async/delta-8258.fits")
+        assert (len(deltas1) == len(deltas2))
+        for d1, d2 in zip(deltas1, deltas2):
+            assert (d1.targetid == d2.targetid)
+            npt.assert_equal(d1.delta, d2.delta)
+
+        writer = qsonic.io.DeltaWriter()
+        writer.put(tmp_path / "nodir/delta-0.fits", [])
+        with pytest.raises(Exception):
+            writer.close()
+
+    @pytest.mark.parametrize("delta_format", ["hdu", "flat"])
+    def test_read_deltas_selective(self, tmp_path, setup_data, delta_format):
+        cat_by_survey, _, data = setup_data(3)
+        cat_by_survey['HPXPIXEL'] = 8258
+        cat_by_survey['Z'] = [2.5, 2.6, 2.7]
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1180.)
+            spec.remove_nonforest_pixels()
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+        qsonic.spectrum.Spectrum._blinding = "none"
+        qsonic.io.save_deltas(
+            spectra_list, tmp_path, save_by_hpx=True,
+            delta_format=delta_format)
+        fname = tmp_path / "delta-8258.fits"
+
+        all_deltas = qsonic.io.read_deltas(fname)
+        assert (all(d.cont is not None for d in all_deltas))
+        removed_tid = all_deltas[0].targetid
+
+        def _is_kept(targetid, mean_snr):
+            return targetid != removed_tid
+
+        deltas = qsonic.io.read_deltas(
+            fname, _is_kept, columns=['WEIGHT'], skip_resomat=True)
+        expected = [d for d in all_deltas if d.targetid != removed_tid]
+        assert (len(deltas) == len(expected))
+        assert (len(deltas) < len(all_deltas))
+        for d1, d2 in zip(deltas, expected):
+            assert (d1.targetid == d2.targetid)
+            assert (d1.cont is None)
+            assert (d1.reso is None)
+            npt.assert_equal(d1.wave, d2.wave)
+            npt.assert_equal(d1.delta, d2.delta)
+            npt.assert_equal(d1.weight, d2.weight)
+
+        assert (qsonic.io.read_deltas(fname, lambda t, s: False) == [])
+
     def test_read_spectra_onehealpix(self, my_setup_fits):
         cat_by_survey, input_dir, xarms, data = my_setup_fits
 
@@ -87,6 +195,117 @@ class TestIOReading(object):
                 npt.assert_allclose(spec.flux[arm], data['flux'][arm][jj])
                 npt.assert_allclose(spec.ivar[arm], data['ivar'][arm][jj])
 
+    def test_prefetch_spectra(self):
+        local_queue = [np.arange(i, i + 3) for i in range(6)]
+
+        def reader(cat):
+            return list(cat * 2)
+
+        for depth in [0, 1, 3]:
+            result = list(qsonic.io.prefetch_spectra(
+                reader, local_queue, depth))
+            assert (result == [reader(cat) for cat in local_queue])
+
+        def bad_reader(cat):
+            if cat[0] == 2:
+                raise ValueError("bad file")
+            return list(cat)
+
+        with pytest.raises(ValueError, match="bad file"):
+            list(qsonic.io.prefetch_spectra(bad_reader, local_queue, 2))
+
+        # Consumer stops early. Background thread must end.
+        for spectra_list in qsonic.io.prefetch_spectra(
+                reader, local_queue, 1):
+            break
+
+    def test_spectra_cache(self, tmp_path, setup_data):
+        cat_by_survey, _, data = setup_data(3)
+        cat_by_survey['HPXPIXEL'] = 8258
+        cat_by_survey['Z'] = [2.5, 2.6, 2.7]
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1180.)
+            spec.remove_nonforest_pixels()
+
+        parser = argparse.ArgumentParser()
+        qsonic.io.add_io_parser(parser)
+        qsonic.spectrum.add_wave_region_parser(parser)
+        args = parser.parse_args(
+            f"-i indir --catalog cat --cache-dir {tmp_path}".split(' '))
+
+        fname = qsonic.io.get_spectra_cache_fname(cat_by_survey, args)
+        assert (fname.startswith(f"{tmp_path}/8258-"))
+        args.forest_w1 = 1040.
+        assert (fname != qsonic.io.get_spectra_cache_fname(
+            cat_by_survey, args))
+        assert (fname != qsonic.io.get_spectra_cache_fname(
+            cat_by_survey[:2], args))
+
+        qsonic.io.save_spectra_cache(spectra_list, fname)
+        slist = qsonic.io.load_spectra_cache(fname)
+        assert (len(slist) == len(spectra_list))
+        for spec, spec2 in zip(spectra_list, slist):
+            assert (spec2.targetid == spec.targetid)
+            assert (spec2.dwave == spec.dwave)
+            for arm in spec.forestwave:
+                npt.assert_equal(spec2.forestflux[arm], spec.forestflux[arm])
+                npt.assert_equal(spec2.forestivar[arm], spec.forestivar[arm])
+
+        slist = qsonic.io.load_spectra_cache(fname, mmap_mode='c')
+        flux = slist[0].forestflux['B']
+        assert (isinstance(flux, np.memmap))
+        npt.assert_equal(flux, spectra_list[0].forestflux['B'])
+        assert (slist[0].memory_footprint()
+                < spectra_list[0].memory_footprint())
+        # Bound batches of mapped spectra stay mapped
+        batches = qsonic.spectrum.pack_spectra_batches(slist)
+        assert (len(batches) == 1)
+        batches[0].bind()
+        assert (isinstance(batches[0].flux, np.memmap))
+        assert (isinstance(slist[0].forestflux['B'], np.memmap))
+        npt.assert_equal(
+            slist[0].forestflux['B'], spectra_list[0].forestflux['B'])
+        flux = slist[0].forestflux['B']
+        # Copy-on-write does not change the file
+        flux[:] = 0
+        slist = qsonic.io.load_spectra_cache(fname)
+        npt.assert_equal(
+            slist[0].forestflux['B'], spectra_list[0].forestflux['B'])
+
+        # Second save keeps the existing cache.
+        qsonic.io.save_spectra_cache([], fname)
+        assert (len(qsonic.io.load_spectra_cache(fname)) == 3)
+
+    def test_read_forest_windows(self, my_setup_fits):
+        cat_by_survey, input_dir, xarms, data = my_setup_fits
+        cat_by_survey['Z'] = np.linspace(2.5, 3.0, cat_by_survey.size)
+        forest_limits = (3600., 6000., 1050., 1180.)
+
+        slist_full = qsonic.io.read_onehealpix_file_data_coadd(
+            cat_by_survey, input_dir, xarms, False)
+        slist = qsonic.io.read_onehealpix_file_data_coadd(
+            cat_by_survey, input_dir, xarms, False,
+            forest_limits=forest_limits)
+
+        assert (len(slist) == len(slist_full))
+        for spec, spec_full in zip(slist, slist_full):
+            assert (spec.flux['B'].size < spec_full.flux['B'].size)
+            assert (spec.rsnr == spec_full.rsnr)
+
+            spec.set_forest_region(*forest_limits)
+            spec_full.set_forest_region(*forest_limits)
+            assert (spec.forestwave.keys() == spec_full.forestwave.keys())
+            assert (spec._f1 == spec_full._f1)
+            for arm in spec.forestwave:
+                npt.assert_allclose(
+                    spec.forestflux[arm], spec_full.forestflux[arm])
+                npt.assert_allclose(
+                    spec.forestivar[arm], spec_full.forestivar[arm])
+                npt.assert_allclose(
+                    spec.forestreso[arm], spec_full.forestreso[arm])
+
     def test_read_onehealpix_file_data_uncoadd(self, my_setup_fits_spectra):
         cat_by_survey, input_dir, xarms, data = my_setup_fits_spectra
         _, w = np.unique(cat_by_survey['TARGETID'], return_index=True)
@@ -133,6 +352,8 @@ def my_setup_fits(tmp_path, setup_data):
             fts.write(data['flux'][arm], extname=f"{arm}_FLUX")
             fts.write(data['ivar'][arm], extname=f"{arm}_IVAR")
             fts.write(np.zeros(shape, dtype='i4'), extname=f"{arm}_MASK")
+            reso = np.random.default_rng(0).random((shape[0], 11, shape[1]))
+            fts.write(reso, extname=f"{arm}_RESOLUTION")
 
     # return sorted data truth
     # Sort the generated catalog first.
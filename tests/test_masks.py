@@ -1,10 +1,13 @@
+import copy
 import os
 import pytest
 
+import fitsio
+import numpy as np
 import numpy.testing as npt
 
 import qsonic.masks
-from qsonic.spectrum import Spectrum
+from qsonic.spectrum import Spectrum, SpectraBatch
 
 
 def test_skymask(tmp_path, setup_data):
@@ -37,5 +40,120 @@ def test_skymask(tmp_path, setup_data):
         npt.assert_equal(spec.forestivar[arm][~w], 1)
 
 
+def test_skymask_apply_batch(tmp_path, setup_data):
+    fname_skymask = tmp_path / "test_skymask.txt"
+    with open(fname_skymask, 'w') as file_sky:
+        file_sky.write("Ca\t 3700\t 3750\t OBS\n")
+        file_sky.write("RF\t 1142\t 1150\t RF\n")
+        file_sky.write("Ca\t 3720\t 3800\t OBS\n")
+
+    skymask = qsonic.masks.SkyMask(fname_skymask)
+
+    cat_by_survey, _, data = setup_data(3)
+    cat_by_survey['Z'] = [2.1, 2.3, 2.5]
+    spectra_list = [
+        Spectrum(catrow, data['wave'], data['flux'], data['ivar'],
+                 data['mask'], data['reso'], idx)
+        for idx, catrow in enumerate(cat_by_survey)]
+    for spec in spectra_list:
+        spec.set_forest_region(3600., 6000., 1000., 2000.)
+
+    batch = SpectraBatch(spectra_list)
+    batch.bind()
+    skymask.apply_batch(batch)
+
+    for spec in spectra_list:
+        z_qso = spec.z_qso
+        for arm, wave_arm in spec.forestwave.items():
+            w = (wave_arm >= 3700.) & (wave_arm < 3800.)
+            w |= ((wave_arm >= 1142 * (1 + z_qso))
+                  & (wave_arm < 1150 * (1 + z_qso)))
+            npt.assert_equal(spec.forestivar[arm][w], 0)
+            npt.assert_equal(spec.forestivar[arm][~w], 1)
+
+
+def get_spectra_list(cat_by_survey, data):
+    spectra_list = [
+        Spectrum(catrow, data['wave'], data['flux'], data['ivar'],
+                 data['mask'], data['reso'], idx)
+        for idx, catrow in enumerate(cat_by_survey)]
+    for spec in spectra_list:
+        spec.set_forest_region(3600., 6000., 1000., 2000.)
+    return spectra_list
+
+
+def assert_batch_equals_apply(masker, spectra_list):
+    expected_list = copy.deepcopy(spectra_list)
+    for spec in expected_list:
+        masker.apply(spec)
+
+    batch = SpectraBatch(spectra_list)
+    batch.bind()
+    masker.apply_batch(batch)
+
+    for spec, expected in zip(spectra_list, expected_list):
+        for arm in spec.forestwave:
+            npt.assert_allclose(
+                spec.forestflux[arm], expected.forestflux[arm], rtol=1e-12)
+            npt.assert_allclose(
+                spec.forestivar[arm], expected.forestivar[arm], rtol=1e-12)
+
+    return expected_list
+
+
+def test_balmask_apply_batch(setup_data):
+    cat_by_survey, _, data = setup_data(3)
+    bal_dtype = [
+        (col, 'f8', (2,)) for col in qsonic.masks.BALMask.expected_columns]
+    catalog = np.zeros(
+        cat_by_survey.size, dtype=cat_by_survey.dtype.descr + bal_dtype)
+    for col in cat_by_survey.dtype.names:
+        catalog[col] = cat_by_survey[col]
+    catalog['Z'] = [2.1, 2.3, 2.5]
+    # First has two troughs, second has none, third has one in each
+    catalog['VMIN_CIV_450'][0] = [2000., 8000.]
+    catalog['VMAX_CIV_450'][0] = [5000., 9000.]
+    catalog['VMIN_CIV_2000'][2] = [3000., 0.]
+    catalog['VMAX_CIV_2000'][2] = [6000., 0.]
+    catalog['VMIN_CIV_450'][2] = [1000., 0.]
+    catalog['VMAX_CIV_450'][2] = [1500., 0.]
+    qsonic.masks.BALMask.check_catalog(catalog)
+
+    spectra_list = get_spectra_list(catalog, data)
+    expected_list = assert_batch_equals_apply(
+        qsonic.masks.BALMask, spectra_list)
+
+    nmasked = [sum(np.sum(ivar_arm == 0)
+                   for ivar_arm in spec.forestivar.values())
+               for spec in expected_list]
+    assert (nmasked[0] > 0)
+    assert (nmasked[1] == 0)
+    assert (nmasked[2] > 0)
+
+
+def test_dlamask_apply_batch(tmp_path, setup_data):
+    cat_by_survey, _, data = setup_data(3)
+    cat_by_survey['Z'] = [2.1, 2.3, 2.5]
+
+    fname = tmp_path / "dlacat.fits"
+    dlacat = np.array([
+        (cat_by_survey['TARGETID'][0], 2.05, 20.5),
+        (cat_by_survey['TARGETID'][0], 2.2, 20.3),
+        (cat_by_survey['TARGETID'][2], 2.15, 21.0),
+        (cat_by_survey['TARGETID'][2] + 100, 2.15, 21.0)],
+        dtype=[('TARGETID', 'i8'), ('Z_DLA', 'f8'), ('NHI', 'f8')])
+    with fitsio.FITS(fname, 'rw', clobber=True) as fts:
+        fts.write(dlacat, extname="DLACAT")
+
+    dlamask = qsonic.masks.DLAMask(fname)
+    spectra_list = get_spectra_list(cat_by_survey, data)
+    expected_list = assert_batch_equals_apply(dlamask, spectra_list)
+
+    for i, modified in enumerate([True, False, True]):
+        flux = expected_list[i].forestflux
+        assert (any(np.any(flux[arm] != data['flux'][arm][i])
+                    for arm in flux) == modified)
+
+
 if __name__ == '__main__':
     pytest.main()
@@ -54,6 +54,13 @@ class TestMathtools(object):
 
         npt.assert_allclose(yarr, ytrue)
 
+        xin, dxp = np.linspace(320., 550., 3, retstep=True)
+        fp = np.power(xin / 100. - 4., 2)
+        fast_interp = qsonic.mathtools.FastCubic1DInterp(
+            xin[0], dxp, fp, bc_type='not-a-knot')
+        xarr = np.linspace(310., 560., 100)
+        npt.assert_allclose(fast_interp(xarr), np.power(xarr / 100. - 4., 2))
+
     def test_mypoly1d(self):
         coefs = np.array([5.5, 1.5, 0.7])
         xarr = np.linspace(-2, 2, 100)
@@ -176,6 +183,27 @@ class TestMathtools(object):
         npt.assert_equal(subsampler.all_measurements.shape, (20, 3, 10))
         npt.assert_equal(subsampler.all_weights.shape, (20, 1, 10))
 
+    def test_SubsampleCov_take(self):
+        subsampler = qsonic.mathtools.SubsampleCov(
+            (3, 10), 20, dtype=np.float32)
+        randoms = np.random.default_rng(0).normal(size=(100, 3, 10))
+        for r in randoms:
+            subsampler.add_measurement(r, 1)
+        assert (subsampler.all_weights.dtype == np.float32)
+
+        keep = np.arange(10) % 3 == 0
+        compact = subsampler.take(keep, np.float64)
+        assert (compact.ndata == 4)
+        assert (compact.all_measurements.dtype == np.float64)
+        npt.assert_equal(compact.all_measurements.shape, (20, 3, 4))
+        npt.assert_equal(compact.all_weights.shape, (20, 1, 4))
+
+        mean, var = compact.get_mean_n_var()
+        npt.assert_allclose(
+            mean, np.mean(randoms, axis=0)[:, keep], rtol=1e-5, atol=1e-6)
+        full_mean, full_var = subsampler.get_mean_n_var()
+        npt.assert_allclose(var, full_var[:, keep], rtol=1e-5)
+
 
 if __name__ == '__main__':
     pytest.main()
@@ -94,6 +94,129 @@ class TestMPIUtils(TestCase):
         npt.assert_allclose(q0, 3)
         npt.assert_allclose(q1, 2)
 
+        # Cost function overrides the size
+        q0, q1 = qsonic.mpi_utils.balance_load(
+            split_catalog, 2, lambda x: 1 / x.size)
+        assert (len(q0) == 1)
+        assert (len(q1) == 3)
+        npt.assert_allclose(q0[0], 4)
+        npt.assert_allclose(q1[0], 1)
+
+    @pytest.mark.mpi
+    def test_dynamic_queue(self):
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        split_catalog = [i * np.ones(i % 4 + 1) for i in range(23)]
+
+        dyn_queue = qsonic.mpi_utils.DynamicQueue(split_catalog, comm)
+        received = [cat[0] for cat in dyn_queue]
+        npt.assert_allclose(
+            received, [cat[0] for cat in dyn_queue.local_queue])
+        dyn_queue.close()
+
+        all_received = np.concatenate(comm.allgather(received))
+        npt.assert_allclose(np.sort(all_received), np.arange(23))
+
+        # More ranks than catalogs
+        dyn_queue = qsonic.mpi_utils.DynamicQueue(split_catalog[:1], comm)
+        received = [cat[0] for cat in dyn_queue]
+        dyn_queue.close()
+        assert (sum(comm.allgather(len(received))) == 1)
+
+    def test_get_redistribution_plan(self):
+        loads = np.array([10, 0, 5, 1])
+        plan = qsonic.mpi_utils.get_redistribution_plan(loads)
+        assert (plan == [(0, 1, 4), (0, 3, 2), (2, 3, 1)])
+
+        for src, dest, amount in plan:
+            loads[src] -= amount
+            loads[dest] += amount
+        npt.assert_allclose(loads, 4)
+        assert (qsonic.mpi_utils.get_redistribution_plan([3, 3]) == [])
+
+    @pytest.mark.mpi
+    def test_mpi_exchange_arrays(self):
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        mpi_rank, mpi_size = comm.Get_rank(), comm.Get_size()
+
+        catalog = np.zeros(2, dtype=[('TARGETID', 'i8'), ('Z', 'f8')])
+        catalog['TARGETID'] = mpi_rank
+        send_arrays = {
+            dest: {'x': np.full((2, 3), mpi_rank, dtype='f4'),
+                   'arms': np.array(['B', 'R'], dtype='U3'),
+                   'empty': np.zeros(0), 'catalog': catalog}
+            for dest in range(mpi_size) if dest != mpi_rank}
+
+        recv_arrays = qsonic.mpi_utils.mpi_exchange_arrays(send_arrays, comm)
+        assert (sorted(recv_arrays) == [
+            r for r in range(mpi_size) if r != mpi_rank])
+        for source, arrays in recv_arrays.items():
+            assert (arrays['x'].dtype == np.dtype('f4'))
+            npt.assert_equal(arrays['x'], np.full((2, 3), source))
+            npt.assert_equal(arrays['arms'], ['B', 'R'])
+            assert (arrays['empty'].size == 0)
+            npt.assert_equal(arrays['catalog']['TARGETID'], source)
+
+    @pytest.mark.mpi
+    def test_packed_iallreduce(self):
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        mpi_rank, mpi_size = comm.Get_rank(), comm.Get_size()
+
+        counts = np.array([1, mpi_rank], dtype=np.int64)
+        stack = np.full((2, 3), mpi_rank + 1.)
+        large = np.ones(8)
+        reduction = qsonic.mpi_utils.PackedIallreduce(
+            [counts, stack, large], comm, inplace_size=8)
+        reduction.wait()
+        assert (reduction.wait() == reduction.wait_time)
+
+        assert (counts.dtype == np.int64)
+        npt.assert_equal(counts, [mpi_size, mpi_size * (mpi_size - 1) // 2])
+        npt.assert_allclose(stack, mpi_size * (mpi_size + 1) / 2)
+        npt.assert_allclose(large, mpi_size)
+
+        # No comm leaves arrays as they are
+        qsonic.mpi_utils.PackedIallreduce([counts], None).wait()
+        npt.assert_equal(counts, [mpi_size, mpi_size * (mpi_size - 1) // 2])
+
+    def test_load_cost_model(self):
+        model = qsonic.mpi_utils.LoadCostModel(
+            3600., 6000., 1050., 1180., file_cost=2., quasar_cost=0.5,
+            pixel_cost=0.01)
+        npix = model.get_forest_pixels(np.array([1.5, 2.5, 3.5, 5.0]))
+        npt.assert_allclose(npix, [0, 455 / 0.8, 585 / 0.8, 0])
+
+        cat = np.zeros(3, dtype=[('Z', 'f8')])
+        cat['Z'] = 2.5
+        assert (model(cat) == pytest.approx(
+            2. + 1.5 + 0.01 * 3 * 455 / 0.8))
+
+        rng = np.random.default_rng(0)
+        nqso = rng.integers(10, 200, 20)
+        npix = nqso * rng.uniform(300, 600, 20)
+        time = 3. + 0.1 * nqso + 1e-3 * npix
+        model.fit(nqso, npix, time)
+        npt.assert_allclose(
+            [model.file_cost, model.quasar_cost, model.pixel_cost],
+            [3., 0.1, 1e-3])
+
+        # Negative intercept: other coefficients are refit without it
+        time = -3. + 0.1 * nqso + 1e-3 * npix
+        model.fit(nqso, npix, time)
+        assert (model.file_cost == 0)
+        coeffs = np.array(
+            [model.file_cost, model.quasar_cost, model.pixel_cost])
+        design = np.column_stack((np.ones(nqso.size), nqso, npix))
+        clipped = np.clip(np.linalg.lstsq(design, time, rcond=None)[0], 0,
+                          None)
+        assert (np.linalg.norm(design @ coeffs - time)
+                < np.linalg.norm(design @ clipped - time))
+
+        with pytest.raises(QsonicException):
+            model.fit(nqso[:2], npix[:2], time[:2])
+
 
 if __name__ == '__main__':
     pytest.main()
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 import pytest
 
@@ -10,9 +11,14 @@ import qsonic.spectrum
 from qsonic.mpi_utils import mpi_parse
 from qsonic.mathtools import FastLinear1DInterp, FastCubic1DInterp
 from qsonic.picca_continuum import (
-    PiccaContinuumFitter, VarLSSFitter, add_picca_continuum_parser)
+    PiccaContinuumFitter, VarLSSFitter, add_picca_continuum_parser,
+    _has_converged, _subsample_keys)
 
-from qsonic.continuum_models.picca_continuum_model import PiccaContinuumModel
+from qsonic.continuum_models.picca_continuum_model import (
+    PiccaContinuumModel, _fused_continuum_cost, _irls_solve,
+    _pixel_cost_derivatives)
+from qsonic.continuum_models.batched_picca_continuum_model import \
+    BatchedPiccaContinuumModel
 
 
 @pytest.fixture
@@ -54,6 +60,32 @@ def test_add_parser(setup_parser):
     npt.assert_almost_equal(args.rfdwave, 1.2)
 
 
+def test_subsample_keys(setup_data):
+    cat_by_survey, _, data = setup_data(100)
+    cat_by_survey['TARGETID'] = 39627939372861215 + np.arange(100)
+    spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+        cat_by_survey, data)
+
+    keys = _subsample_keys(spectra_list)
+    assert (np.all((keys >= 0) & (keys < 1)))
+    npt.assert_allclose(keys, _subsample_keys(spectra_list))
+    npt.assert_allclose(keys[::-1], _subsample_keys(spectra_list[::-1]))
+    # Roughly uniform
+    assert (20 < np.sum(keys < 0.5) < 80)
+
+
+def test_has_converged():
+    old = np.ones(5)
+    err = 0.1 * np.ones(5)
+    assert (_has_converged(old, old + 0.01, err))
+    assert (not _has_converged(old, old + 0.05, err))
+
+    err[2] = 0
+    new = old + 0.01
+    new[2] = 10
+    assert (_has_converged(old, new, err))
+
+
 def get_mpi():
     from mpi4py import MPI
     comm = MPI.COMM_WORLD
@@ -142,10 +174,72 @@ class TestPiccaContinuumFitter(object):
         npt.assert_allclose(qcfit.meancont_interp.fp, 1, rtol=1e-3)
         npt.assert_almost_equal(qcfit.meancont_interp.fp.mean(), 1)
 
+    @pytest.mark.parametrize(
+        "freeze, meancont_converged, expected_fractions, expected_nvar", [
+            (True, [True, True, False, True], [0.25, 0.5, 1, 1], 3),
+            (False, [True, False, True], [0.25, 1, 1], 3)])
+    def test_iterate_schedule(
+            self, setup_parser, setup_data, freeze, meancont_converged,
+            expected_fractions, expected_nvar
+    ):
+        comm, mpi_rank = get_mpi()
+
+        options = ["--subsample-fraction", "0.25", "--subsample-growth", "2",
+                   "--num-iterations", "6"]
+        if freeze:
+            options.append("--freeze-varlss")
+        args = mpi_parse(setup_parser, comm, mpi_rank, options)
+        qcfit = PiccaContinuumFitter(args)
+
+        cat_by_survey, npix, data = setup_data(40)
+        cat_by_survey['TARGETID'] = 39627939372861215 + np.arange(40)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(
+                3600., 6000., args.forest_w1, args.forest_w2)
+        keys = _subsample_keys(spectra_list)
+
+        # Record the stages that run. Convergence is scripted, var_lss is
+        # always converged.
+        fit_sizes, var_calls = [], []
+        fit_continua = qcfit.model.fit_continua
+        add_var_stats = qcfit._add_var_stats
+        update_mean_cont = qcfit._update_mean_cont
+        meancont_iter = iter(meancont_converged)
+
+        def _fit_continua(fit_list):
+            fit_sizes.append(len(fit_list))
+            fit_continua(fit_list)
+
+        def _add_var_stats(*args):
+            var_calls.append(len(fit_sizes))
+            add_var_stats(*args)
+
+        def _update_mean_cont(reduced=False):
+            update_mean_cont(reduced)
+            return next(meancont_iter)
+
+        def _update_var_lss_eta(reduced=False):
+            qcfit.varlss_fitter.calculate_subsampler_stats(reduced)
+            return True, True
+
+        qcfit.model.fit_continua = _fit_continua
+        qcfit._add_var_stats = _add_var_stats
+        qcfit._update_mean_cont = _update_mean_cont
+        qcfit._update_var_lss_eta = _update_var_lss_eta
+
+        qcfit.iterate(spectra_list)
+
+        expected_sizes = [np.sum(keys < f) for f in expected_fractions]
+        npt.assert_equal(fit_sizes, expected_sizes)
+        npt.assert_equal(var_calls, np.arange(1, expected_nvar + 1))
+        assert (next(meancont_iter, None) is None)
+
 
 class TestPiccaContinuumModel(object):
     @staticmethod
-    def get_qcfit():
+    def get_qcfit(minimizer="iminuit"):
         rfwave, dwrf = np.linspace(1050, 1180, 325, retstep=True)
         denom = np.log(rfwave[-1] / rfwave[0])
         meancont_interp = FastCubic1DInterp(
@@ -162,7 +256,7 @@ class TestPiccaContinuumModel(object):
 
         return PiccaContinuumModel(
             meancont_interp, meanflux_interp, varlss_interp,
-            eta_interp, 1, rfwave[0], denom, "iminuit")
+            eta_interp, 1, rfwave[0], denom, minimizer)
 
     def test_get_continuum_model(self):
         qcfit = TestPiccaContinuumModel.get_qcfit()
@@ -179,8 +273,10 @@ class TestPiccaContinuumModel(object):
         cont_est = qcfit.get_continuum_model(x, wave_rf_arm)
         npt.assert_allclose(cont_est, expected_cont)
 
-    def test_fit_continuum(self, setup_data):
-        qcfit = TestPiccaContinuumModel.get_qcfit()
+    @pytest.mark.parametrize(
+        "minimizer", ["iminuit", "l_bfgs_b", "numba", "irls"])
+    def test_fit_continuum(self, setup_data, minimizer):
+        qcfit = TestPiccaContinuumModel.get_qcfit(minimizer)
         qcfit.varlss_interp.fp *= 0
         npt.assert_allclose(qcfit.meanflux_interp.fp, 1)
 
@@ -195,6 +291,418 @@ class TestPiccaContinuumModel(object):
         assert (spec.cont_params['valid'])
         npt.assert_almost_equal(spec.cont_params['x'], [2.1, 0])
 
+    def test_fit_continuum_float32(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit()
+        cat_by_survey, npix, data = setup_data(1)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+
+        results = []
+        try:
+            for dtype in ["float64", "float32"]:
+                qsonic.spectrum.Spectrum.set_storage_dtype(dtype)
+                spec = qsonic.spectrum.generate_spectra_list_from_data(
+                    cat_by_survey, data)[0]
+                spec.set_forest_region(3600., 6000., 1050., 1180.)
+                qcfit.init_spectra([spec])
+                qcfit.fit_continuum(spec)
+                assert (spec.cont_params['valid'])
+                results.append(spec.cont_params['x'])
+        finally:
+            qsonic.spectrum.Spectrum.set_storage_dtype("float64")
+
+        npt.assert_allclose(results[1], results[0], rtol=1e-4, atol=1e-5)
+
+    def test_warm_start(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit()
+        cat_by_survey, npix, data = setup_data(1)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        spec.set_forest_region(3600., 6000., 1050., 1210.)
+        qcfit.init_spectra([spec])
+
+        x0, xerr = qcfit._get_x0(spec)
+        assert (xerr is None)
+        npt.assert_allclose(x0, [qcfit._get_a0(spec), 0])
+
+        qcfit.fit_continuum(spec)
+        assert (spec.cont_params['valid'])
+        x1 = spec.cont_params['x'].copy()
+        x0, xerr = qcfit._get_x0(spec)
+        assert (xerr is None)
+
+        qcfit.warm_start = True
+        x0, xerr = qcfit._get_x0(spec)
+        npt.assert_allclose(x0, x1)
+        npt.assert_allclose(xerr**2, np.diag(spec.cont_params['xcov']))
+
+        qcfit.fit_continuum(spec)
+        assert (spec.cont_params['valid'])
+        npt.assert_allclose(spec.cont_params['x'], x1, atol=1e-3)
+
+    def test_irls_minimizer(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit("irls")
+        qcfit.validate_irls = True
+        cat_by_survey, npix, data = setup_data(1)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        spec.set_forest_region(3600., 6000., 1050., 1210.)
+        qcfit.init_spectra([spec])
+
+        x0, _ = qcfit._get_x0(spec)
+        result = qcfit.minimizer(spec, x0)
+        expected = qcfit._iminuit_minimizer(spec, x0)
+        assert (result['valid'])
+        assert (qcfit.num_irls_fallbacks == 0)
+        assert (len(qcfit._irls_diffs) == 1)
+        xerr = np.sqrt(np.diag(expected['xcov']))
+        npt.assert_array_less(
+            np.abs(result['x'] - expected['x']), 0.1 * xerr)
+
+    def test_irls_batch(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit("irls")
+        bqcfit = BatchedPiccaContinuumModel(
+            qcfit.meancont_interp, qcfit.meanflux_interp,
+            qcfit.varlss_interp, qcfit.eta_interp, qcfit.cont_order,
+            qcfit.rfwave0, qcfit.denom, "irls", batch_size=2)
+        cat_by_survey, npix, data = setup_data(3)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        # Different lengths are padded
+        for spec, w2 in zip(spectra_list, [1210., 1150., 1180.]):
+            spec.set_forest_region(3600., 6000., 1050., w2)
+        qcfit.init_spectra(spectra_list)
+
+        expected = []
+        for spec in spectra_list:
+            x0, _ = qcfit._get_x0(spec)
+            expected.append(qcfit._irls_minimizer(spec, x0))
+
+        bqcfit.fit_continua(spectra_list)
+        assert (bqcfit.num_fallbacks == 0)
+        assert (bqcfit.num_irls_fallbacks == 0)
+        for spec, result in zip(spectra_list, expected):
+            assert (spec.cont_params['valid'])
+            npt.assert_allclose(
+                spec.cont_params['x'], result['x'], rtol=1e-5)
+            npt.assert_allclose(
+                spec.cont_params['xcov'], result['xcov'], rtol=1e-5)
+
+    def test_irls_solve_degenerate(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit("irls")
+        cat_by_survey, npix, data = setup_data(3)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1210.)
+        # Fully masked forest has singular normal equations
+        for ivar_arm in spectra_list[1].forestivar_sm.values():
+            ivar_arm[:] = 0
+        qcfit.init_spectra(spectra_list)
+
+        caches = [qcfit.get_model_cache(spec) for spec in spectra_list]
+        x0 = np.vstack([qcfit._get_x0(spec)[0] for spec in spectra_list])
+        args = [np.stack([c[key] for c in caches]) for key in (
+            'flux', 'ivar', 'varlss', 'eta')]
+        design = np.stack([qcfit._get_design_matrix(c) for c in caches])
+        x, converged = _irls_solve(design, *args, x0, tol=1e-12)
+
+        npt.assert_array_equal(converged, [True, False, True])
+        for jj in [0, 2]:
+            c = caches[jj]
+            xj, convj = _irls_solve(
+                design[jj], c['flux'], c['ivar'], c['varlss'], c['eta'],
+                x0[jj], tol=1e-12)
+            assert (convj)
+            npt.assert_allclose(x[jj], xj)
+
+    def test_irls_outliers(self, setup_data):
+        # Large outliers make the IRLS normal equations indefinite
+        rng = np.random.default_rng(0)
+        npix = 200
+        design = np.vander(np.linspace(-1, 1, npix), 2, increasing=True)
+        flux = 1 + rng.normal(size=npix) / 10
+        flux[::10] += 30
+        args = (flux, np.full(npix, 100.), np.full(npix, 0.5), np.ones(npix))
+        x, converged = _irls_solve(design, *args, np.array([1., 0.]))
+        _, dcost, fisher = _pixel_cost_derivatives(design @ x, *args)
+        grad = dcost @ design
+        fmat = design.T @ (fisher[:, np.newaxis] * design)
+        edm = 0.25 * grad @ np.linalg.solve(fmat, grad)
+        assert (converged == (edm < 1e-6))
+
+        qcfit = TestPiccaContinuumModel.get_qcfit("irls")
+        cat_by_survey, npix, data = setup_data(1)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        data['flux']['B'][0, ::50] += 30
+        data['ivar']['B'] *= 100
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        spec.set_forest_region(3600., 6000., 1050., 1210.)
+        qcfit.init_spectra([spec])
+
+        x0, _ = qcfit._get_x0(spec)
+        result = qcfit.minimizer(spec, x0)
+        assert (result['valid'])
+        cache = qcfit.get_model_cache(spec)
+        grad = qcfit._continuum_costfn_grad(result['x'], cache)
+        edm = 0.25 * grad @ result['xcov'] @ grad
+        assert (edm < 1e-3)
+
+    def test_batched_irls_outliers(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit("irls")
+        bqcfit = BatchedPiccaContinuumModel(
+            qcfit.meancont_interp, qcfit.meanflux_interp,
+            qcfit.varlss_interp, qcfit.eta_interp, qcfit.cont_order,
+            qcfit.rfwave0, qcfit.denom, "irls", batch_size=2)
+        cat_by_survey, npix, data = setup_data(3)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        data['flux']['B'][1, ::50] += 30
+        data['ivar']['B'] *= 100
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1210.)
+        bqcfit.init_spectra(spectra_list)
+
+        bqcfit.fit_continua(spectra_list)
+        assert (bqcfit.num_fallbacks > 0)
+        for spec in spectra_list:
+            assert (spec.cont_params['valid'])
+            cache = bqcfit.get_model_cache(spec)
+            grad = bqcfit._continuum_costfn_grad(spec.cont_params['x'], cache)
+            edm = 0.25 * grad @ spec.cont_params['xcov'] @ grad
+            assert (edm < 1e-3)
+
+    def test_refit_tol(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit()
+        cat_by_survey, npix, data = setup_data(1)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        spec.set_forest_region(3600., 6000., 1050., 1210.)
+        qcfit.init_spectra([spec])
+        qcfit.refit_tol = 1e-2
+
+        qcfit.fit_continua([spec])
+        assert (qcfit.num_skipped == 0)
+
+        new_meancont = qcfit.meancont_interp.fp * np.linspace(
+            0.999, 1.001, qcfit.meancont_interp.fp.size)
+        qcfit.meancont_interp.reset(new_meancont)
+        expected = copy.deepcopy(spec)
+        qcfit.fit_continua([spec])
+        assert (qcfit.num_skipped == 1)
+        assert (spec.cont_params['valid'])
+
+        qcfit.refit_tol = 0
+        qcfit.fit_continua([expected])
+        assert (qcfit.num_skipped == 0)
+        npt.assert_allclose(
+            spec.cont_params['x'], expected.cont_params['x'], atol=1e-3)
+
+    def test_get_model_cache(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit()
+        cat_by_survey, npix, data = setup_data(1)
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        spec.set_forest_region(3600., 6000., 1050., 1210.)
+
+        cache = qcfit.get_model_cache(spec)
+        assert (qcfit.get_model_cache(spec) is cache)
+        npt.assert_allclose(cache['varlss'], 0.1)
+        assert (qcfit.cache_nbytes == 6 * 8 * cache['flux'].size)
+
+        qcfit.varlss_interp.reset(0.2 * np.ones(3))
+        cache = qcfit.get_model_cache(spec)
+        npt.assert_allclose(cache['varlss'], 0.2)
+        assert (qcfit.cache_nbytes == 6 * 8 * cache['flux'].size)
+
+        qcfit.max_cache_mb = 0
+        qcfit.clear_cache()
+        cache = qcfit.get_model_cache(spec)
+        assert (qcfit.get_model_cache(spec) is not cache)
+        assert (qcfit.cache_nbytes == 0)
+
+    def test_continuum_costfn_grad(self, setup_data):
+        qcfit = TestPiccaContinuumModel.get_qcfit()
+        cat_by_survey, npix, data = setup_data(1)
+        data['flux']['B'] += np.linspace(-0.5, 0.5, npix)
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        spec.set_forest_region(3600., 6000., 1050., 1210.)
+        cache = qcfit.get_model_cache(spec)
+
+        x = np.array([2., 0.3])
+        grad = qcfit._continuum_costfn_grad(x, cache)
+        eps = 1e-6
+        num_grad = np.array([
+            (qcfit._continuum_costfn(x + eps * e, cache)
+             - qcfit._continuum_costfn(x - eps * e, cache)) / (2 * eps)
+            for e in np.eye(2)])
+        npt.assert_allclose(grad, num_grad, rtol=1e-5)
+
+        grad_jit = np.empty(2)
+        cost_jit = _fused_continuum_cost(
+            x, cache['template'], cache['basis'], cache['flux'],
+            cache['ivar'], cache['varlss'], cache['eta'], grad_jit)
+        npt.assert_allclose(cost_jit, qcfit._continuum_costfn(x, cache))
+        npt.assert_allclose(grad_jit, grad)
+
+        fisher = qcfit._continuum_fisher(x, cache)
+        npt.assert_allclose(fisher, fisher.T)
+        assert (np.all(np.linalg.eigvalsh(fisher) > 0))
+
+    @pytest.mark.parametrize("batch_size", [0, 2])
+    def test_fit_workers(self, setup_data, batch_size):
+        qcfit = TestPiccaContinuumModel.get_qcfit("numba")
+        if batch_size > 0:
+            qcfit = BatchedPiccaContinuumModel(
+                qcfit.meancont_interp, qcfit.meanflux_interp,
+                qcfit.varlss_interp, qcfit.eta_interp, qcfit.cont_order,
+                qcfit.rfwave0, qcfit.denom, "numba", batch_size=batch_size)
+
+        cat_by_survey, npix, data = setup_data(12)
+        rng = np.random.default_rng(0)
+        for arm in ['B', 'R']:
+            data['flux'][arm] += rng.normal(size=data['flux'][arm].shape)
+
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1210.)
+        qcfit.init_spectra(spectra_list)
+        expected_list = copy.deepcopy(spectra_list)
+
+        qcfit.fit_continua(expected_list)
+        qcfit.fit_workers = 3
+        qcfit.fit_continua(spectra_list)
+        assert (all(spec.cont_params['valid'] for spec in spectra_list))
+
+        for spec, expected in zip(spectra_list, expected_list):
+            assert (spec.cont_params['valid'] == expected.cont_params['valid'])
+            npt.assert_array_equal(
+                spec.cont_params['x'], expected.cont_params['x'])
+            npt.assert_array_equal(
+                spec.cont_params['xcov'], expected.cont_params['xcov'])
+
+    def test_fit_workers_gil(self):
+        qcfit = TestPiccaContinuumModel.get_qcfit()
+        args = (qcfit.meancont_interp, qcfit.meanflux_interp,
+                qcfit.varlss_interp, qcfit.eta_interp, qcfit.cont_order,
+                qcfit.rfwave0, qcfit.denom)
+
+        for minimizer in ["iminuit", "l_bfgs_b"]:
+            qcfit = PiccaContinuumModel(*args, minimizer, fit_workers=4)
+            assert (qcfit.fit_workers == 1)
+            qcfit = BatchedPiccaContinuumModel(
+                *args, minimizer, fit_workers=4)
+            assert (qcfit.fit_workers == 1)
+
+        for minimizer in ["numba", "irls"]:
+            qcfit = PiccaContinuumModel(*args, minimizer, fit_workers=4)
+            assert (qcfit.fit_workers == 4)
+            qcfit = BatchedPiccaContinuumModel(
+                *args, minimizer, fit_workers=4)
+            assert (qcfit.fit_workers == 4)
+
+    @pytest.mark.parametrize("varlss", [0, 0.1])
+    def test_batched_fit_continua(self, setup_data, varlss):
+        qcfit = TestPiccaContinuumModel.get_qcfit("irls")
+        qcfit.varlss_interp.fp[:] = varlss
+        bqcfit = BatchedPiccaContinuumModel(
+            qcfit.meancont_interp, qcfit.meanflux_interp,
+            qcfit.varlss_interp, qcfit.eta_interp, qcfit.cont_order,
+            qcfit.rfwave0, qcfit.denom, "iminuit", batch_size=2, tol=1e-12)
+
+        cat_by_survey, npix, data = setup_data(3)
+        rng = np.random.default_rng(0)
+        for arm in ['B', 'R']:
+            data['flux'][arm] *= np.linspace(0.8, 1.2, npix)
+            data['flux'][arm] += rng.normal(size=data['flux'][arm].shape)
+
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1210.)
+        qcfit.init_spectra(spectra_list)
+
+        expected = []
+        for spec in spectra_list:
+            cache = qcfit.get_model_cache(spec)
+            design = qcfit._get_design_matrix(cache)
+            if varlss == 0:
+                # Cost is quadratic: weighted linear least squares
+                weight = cache['ivar'] / cache['eta']
+                fisher = design.T @ (weight[:, np.newaxis] * design)
+                x = np.linalg.solve(
+                    fisher, design.T @ (weight * cache['flux']))
+            else:
+                x, converged = _irls_solve(
+                    design, cache['flux'], cache['ivar'], cache['varlss'],
+                    cache['eta'], qcfit._get_x0(spec)[0], tol=1e-12)
+                assert (converged)
+                fisher = qcfit._continuum_fisher(x, cache)
+            expected.append((x, np.linalg.inv(fisher)))
+
+        bqcfit.fit_continua(spectra_list)
+
+        assert (bqcfit.num_fallbacks == 0)
+        for spec, (x, xcov) in zip(spectra_list, expected):
+            assert (spec.cont_params['valid'])
+            npt.assert_allclose(spec.cont_params['x'], x, rtol=1e-6)
+            npt.assert_allclose(spec.cont_params['xcov'], xcov, rtol=1e-6)
+
+
+class TestInputContinuumModel(object):
+    def test_fit_continua(self, setup_data, tmp_path):
+        from healpy import ang2pix
+        from qsonic.continuum_models.input_continuum_model import \
+            InputContinuumModel
+
+        cat_by_survey, npix, data = setup_data(3)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1210.)
+
+        # The last quasar is missing in the input file
+        pixnum = ang2pix(8, 229.86, 6.19, lonlat=True, nest=True)
+        fibermap = np.zeros(2, dtype=[('TARGETID', 'i8')])
+        fibermap['TARGETID'] = cat_by_survey['TARGETID'][:2]
+        continua = np.array([[2.5] * 400, [1.5] * 400])
+        with fitsio.FITS(
+                tmp_path / f"input-continuum-8-{pixnum}.fits", 'rw',
+                clobber=True) as fts:
+            fts.write(fibermap, extname='FIBERMAP')
+            fts.write(continua, extname='CONTINUA',
+                      header={'WAVE1': 1000., 'DWAVE': 1.})
+
+        meanflux_interp = FastLinear1DInterp(3000, 3000, 2 * np.ones(3))
+        varlss_interp = FastLinear1DInterp(3000, 3000, 0.1 * np.ones(3))
+        eta_interp = FastLinear1DInterp(3000, 3000, np.ones(3))
+        model = InputContinuumModel(
+            str(tmp_path), meanflux_interp, varlss_interp, eta_interp)
+
+        model.init_spectra(spectra_list)
+        npt.assert_allclose(spectra_list[0].cont_params['input_w1'], 1000.)
+        npt.assert_allclose(spectra_list[1].cont_params['input_dwave'], 1.)
+        assert (spectra_list[2].cont_params['input_data'] is None)
+        copied = spectra_list[0].cont_params.copy()
+        npt.assert_allclose(copied['input_data'], continua[0])
+
+        model.fit_continua(spectra_list)
+        for spec, expected in zip(spectra_list[:2], [5., 3.]):
+            assert (spec.cont_params['valid'])
+            assert (spec.cont_params['chi2'] > 0)
+            for cont_arm in spec.cont_params['cont'].values():
+                npt.assert_allclose(cont_arm, expected)
+        assert (not spectra_list[2].cont_params['valid'])
+        assert (spectra_list[2].cont_params['cont'] is None)
+
 
 class TestVarLSSFitter(object):
     def test_add(self, setup_data):
@@ -228,6 +736,173 @@ class TestVarLSSFitter(object):
         npt.assert_equal(varlss_fitter.wvalid_bins.sum(), expected_size)
         npt.assert_equal(varlss_fitter.mean_delta.size, expected_size)
 
+    @staticmethod
+    def baseline_add(fitter, wave, delta, ivar):
+        # Reference for a single spectrum arm with one bincount per statistic
+        wave_indx = np.clip(
+            ((wave - fitter.waveobs[0]) / fitter.dwobs + 1.5).astype(int),
+            0, fitter.nwbins + 1)
+        all_indx = (np.searchsorted(fitter.ivar_edges, ivar)
+                    + wave_indx * (fitter.nvarbins + 2))
+        var = np.divide(1, ivar, out=np.zeros_like(ivar), where=ivar > 0)
+
+        npix = np.bincount(all_indx, minlength=fitter.minlength)
+        xvec = np.vstack([
+            np.bincount(all_indx, weights=x, minlength=fitter.minlength)
+            for x in [delta, delta**2, delta**4, var]])
+        fitter.subsampler.add_measurement(xvec, npix)
+        fitter._num_pixels += npix
+        fitter._num_qso += npix > 0
+
+    def assert_same_stats(self, fitter, expected):
+        npt.assert_equal(fitter._num_pixels, expected._num_pixels)
+        npt.assert_equal(fitter._num_qso, expected._num_qso)
+        npt.assert_allclose(
+            fitter.subsampler.all_measurements,
+            expected.subsampler.all_measurements, rtol=1e-12, atol=1e-12)
+        npt.assert_equal(
+            fitter.subsampler.all_weights, expected.subsampler.all_weights)
+
+    def test_add_many(self, setup_data):
+        cat_by_survey, npix, data = setup_data(3)
+        rng = np.random.default_rng(0)
+        fitters = [
+            VarLSSFitter(3600, 4800, nwbins=4, var1=1e-5, var2=2.,
+                         nvarbins=3, nsubsamples=2)
+            for _ in range(3)]
+
+        waves, deltas, ivars = [], [], []
+        for i in range(3):
+            for arm in ['B', 'R']:
+                waves.append(data['wave'][arm])
+                deltas.append(rng.normal(size=npix))
+                ivars.append(rng.uniform(0.5, 10., size=npix))
+                self.baseline_add(fitters[0], waves[-1], deltas[-1], ivars[-1])
+                fitters[1].add(waves[-1], deltas[-1], ivars[-1])
+
+        offsets = np.append(0, np.cumsum([_.size for _ in waves]))
+        fitters[2].add_many(
+            np.concatenate(waves), np.concatenate(deltas),
+            np.concatenate(ivars), offsets)
+
+        self.assert_same_stats(fitters[1], fitters[0])
+        self.assert_same_stats(fitters[2], fitters[0])
+
+    def test_add_many_batch(self, setup_data):
+        cat_by_survey, _, data = setup_data(4)
+        cat_by_survey['Z'] = 2.5 + 0.1 * np.arange(4)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1180.)
+        spectra_list[1].drop_arm('B')
+
+        batch = qsonic.spectrum.SpectraBatch(spectra_list)
+        batch.bind()
+        rng = np.random.default_rng(0)
+        batch.ivar[:] = rng.uniform(0.5, 10., batch.size)
+        batch.ivar[rng.random(batch.size) < 0.1] = 0
+        batch.flux[:] = 1.5 * (1 + rng.normal(size=batch.size))
+        for spec in spectra_list:
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+        batch.update_fit_results()
+        assert (batch.nseg == 7)
+
+        fitters = [
+            VarLSSFitter(3600, 4800, nwbins=4, var1=1e-3, var2=2.,
+                         nvarbins=5, nsubsamples=3)
+            for _ in range(3)]
+
+        # Baseline adds each arm of each spectrum separately
+        for spec in spectra_list:
+            for arm, wave_arm in spec.forestwave.items():
+                cont = spec.cont_params['cont'][arm]
+                delta = spec.forestflux[arm] / cont - 1
+                ivar = spec.forestivar[arm] * cont**2
+                delta[ivar == 0] = 0
+                self.baseline_add(fitters[0], wave_arm, delta, ivar)
+
+        w = batch.get_valid_pixels(np.ones(batch.nspec, dtype=bool))
+        delta, ivar, _ = batch.get_deltas(w)
+        fitters[1].add_many(batch.wave[w], delta, ivar, batch.get_offsets(w))
+
+        self.assert_same_stats(fitters[1], fitters[0])
+
+        # Counting first and then adding with the indices is the same
+        indices = fitters[2].count_many(
+            batch.wave[w], ivar, batch.get_offsets(w))
+        npt.assert_equal(fitters[2].num_pixels, fitters[0].num_pixels)
+        npt.assert_equal(fitters[2].subsampler.all_weights, 0)
+        fitters[2].add_many(
+            batch.wave[w], delta, ivar, batch.get_offsets(w), indices)
+        self.assert_same_stats(fitters[2], fitters[0])
+        assert (fitters[1].num_qso.max() == 7)
+
+    def test_float32_subsamples(self):
+        rng = np.random.default_rng(1)
+        nspec, npix = 4000, 500
+        wave = np.tile(np.linspace(3650, 4750, npix), nspec)
+        ivar = rng.uniform(1, 50, wave.size)
+        delta = 0.3 + rng.normal(size=wave.size) / np.sqrt(ivar)
+        offsets = np.arange(0, wave.size + 1, npix)
+
+        fitters = [
+            VarLSSFitter(3600, 4800, nwbins=2, var1=1e-3, var2=2.,
+                         nvarbins=3, nsubsamples=20, subsample_dtype=dtype)
+            for dtype in [np.float64, np.float32]]
+        for fitter in fitters:
+            fitter.add_many(wave, delta, ivar, offsets)
+            fitter.calculate_subsampler_stats()
+
+        w = fitters[0].num_pixels > 0
+        npt.assert_equal(fitters[1].num_pixels, fitters[0].num_pixels)
+        for attr in ['mean_delta', 'var_delta', 'var_centers']:
+            npt.assert_allclose(
+                getattr(fitters[1], attr)[w], getattr(fitters[0], attr)[w],
+                rtol=1e-6)
+        npt.assert_allclose(
+            fitters[1].e_var_delta[w], fitters[0].e_var_delta[w], rtol=2e-5)
+
+    @pytest.mark.parametrize("use_cov", [False, True])
+    def test_populated_bins(self, use_cov):
+        rng = np.random.default_rng(0)
+        fitters = [
+            VarLSSFitter(3600, 4800, nwbins=4, var1=1e-3, var2=2.,
+                         nvarbins=10, nsubsamples=20, use_cov=use_cov,
+                         subsample_dtype=dtype)
+            for dtype in [np.float64, np.float32]]
+
+        # Only the first wavelength bin is populated
+        wave = np.linspace(3650, 3850, 100)
+        for _ in range(50):
+            ivar = rng.uniform(1, 50, wave.size)
+            delta = rng.normal(size=wave.size) / np.sqrt(ivar)
+            for fitter in fitters:
+                fitter.add(wave, delta, ivar)
+
+        for fitter in fitters:
+            fitter.start_reduction().wait()
+            assert (fitter._compact.all_measurements.dtype == np.float64)
+            assert (fitter._compact.all_weights.dtype == np.float64)
+            fitter.calculate_subsampler_stats(reduced=True)
+
+        populated = fitters[0].num_pixels > 0
+        assert (0 < populated.sum() <= 10)
+        npt.assert_equal(fitters[0].var_delta[~populated], 0)
+        npt.assert_equal(fitters[0].e_var_delta[~populated], 0)
+        assert all(fitters[0].e_var_delta[populated] > 0)
+        npt.assert_allclose(
+            fitters[1].var_delta, fitters[0].var_delta, rtol=1e-5)
+        npt.assert_allclose(
+            fitters[1].e_var_delta, fitters[0].e_var_delta, rtol=1e-4)
+        if use_cov:
+            npt.assert_equal(fitters[0].cov_var_delta.shape, (4, 10, 10))
+            npt.assert_equal(fitters[0].cov_var_delta[1:], 0)
+
     def test_fit(self):
         varlss_fitter = VarLSSFitter(
             3600, 4800, nwbins=1, var1=1e-5, var2=2.)
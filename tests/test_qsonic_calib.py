@@ -1,3 +1,5 @@
+import tempfile
+
 import pytest
 from unittest import TestCase
 
@@ -19,6 +21,24 @@ class TestQsonicCalib(TestCase):
             options = "--catalog incat -o outdir".split(' ')
             parser.parse_args(options)
 
+    def test_targetid_list_to_remove_single(self):
+        parser = qsonic.scripts.qsonic_calib.get_parser()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = f"{tmpdir}/remove.txt"
+            with open(fname, 'w') as file:
+                file.write("39627939372861215\n")
+
+            args = parser.parse_args(
+                f"--input-dir indir --catalog incat -o outdir "
+                f"--remove-targetid-list {fname}".split(' '))
+            args.catalog = None
+            ids_to_remove = \
+                qsonic.scripts.qsonic_calib.mpi_set_targetid_list_to_remove(
+                    args)
+
+        assert (ids_to_remove.ndim == 1)
+        assert (set(ids_to_remove.tolist()) == {39627939372861215})
+
 
 if __name__ == '__main__':
     pytest.main()
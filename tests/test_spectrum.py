@@ -6,6 +6,7 @@ import fitsio
 import numpy as np
 import numpy.testing as npt
 
+import qsonic.io
 import qsonic.spectrum
 from qsonic.mathtools import FastLinear1DInterp
 
@@ -40,6 +41,50 @@ class TestSpectrum(object):
             npt.assert_allclose(spec.flux['R'], data['flux']['R'][idx])
             assert (not spec.forestflux)
             assert (not spec.reso)
+            assert (spec.catrow.base is cat_by_survey)
+
+    def test_slots_and_cont_params(self, setup_data):
+        cat_by_survey, _, data = setup_data(1)
+        spec = qsonic.spectrum.Spectrum(
+            cat_by_survey[0], data['wave'], data['flux'], data['ivar'],
+            data['mask'], data['reso'], 0)
+
+        assert (not hasattr(spec, '__dict__'))
+        with pytest.raises(AttributeError):
+            spec.new_attribute = 1
+        assert (spec.targetid == cat_by_survey['TARGETID'][0])
+
+        cont_params = spec.cont_params
+        cont_params['chi2'] = 5.
+        assert (cont_params.chi2 == 5.)
+        with pytest.raises(KeyError):
+            cont_params['unknown'] = 1
+        with pytest.raises(KeyError):
+            cont_params['unknown']
+
+        cont_params2 = cont_params.copy()
+        cont_params2['cont'] = {}
+        cont_params2['chi2'] = -1
+        assert (cont_params.chi2 == 5.)
+        assert (cont_params2.x is cont_params.x)
+
+    def test_memory_footprint(self, setup_data):
+        cat_by_survey, npix, data = setup_data(2)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+
+        spec = spectra_list[0]
+        nbytes_full = spec.memory_footprint()
+        assert (nbytes_full > 2 * 2 * 8 * npix)
+
+        spec.set_forest_region(3600., 6000., 1050., 1180.)
+        spec.remove_nonforest_pixels()
+        nbytes_forest = spec.memory_footprint()
+        assert (nbytes_forest < nbytes_full)
+        assert (nbytes_forest > 2 * 8 * spec.get_real_size())
+
+        total = qsonic.spectrum.memory_footprint(spectra_list)
+        assert (total == nbytes_forest + spectra_list[1].memory_footprint())
 
     def test_set_forest_region(self, setup_data):
         cat_by_survey, _, data = setup_data(1)
@@ -159,6 +204,35 @@ class TestSpectrum(object):
 
         npt.assert_almost_equal(spec.forestivar['brz'][wbonly:wronly], 2)
 
+    def test_storage_dtype(self, setup_data, float32_storage):
+        cat_by_survey, _, data = setup_data(1)
+        spec = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)[0]
+        assert (spec.flux['B'].dtype == np.float32)
+
+        spec.set_forest_region(3600., 6000., 1050., 1300.)
+        spec.set_smooth_forestivar(16.)
+        spec.cont_params['valid'] = True
+        spec.cont_params['cont'] = {
+            arm: np.ones(farm.size) for arm, farm in spec.forestflux.items()
+        }
+        spec.set_forest_weight(FastLinear1DInterp(0, 1, 0.5 * np.ones(3)))
+        for arm in spec.forestwave:
+            assert (spec.forestwave[arm].dtype == np.float64)
+            assert (spec.forestflux[arm].dtype == np.float32)
+            assert (spec.forestivar_sm[arm].dtype == np.float32)
+            assert (spec.forestweight[arm].dtype == np.float32)
+        npt.assert_allclose(spec.cont_params['x'][0], 2.1, rtol=1e-6)
+
+        batch = qsonic.spectrum.SpectraBatch([spec])
+        assert (batch.flux.dtype == np.float32)
+        assert (batch.cont.dtype == np.float64)
+        assert (batch.get_deltas()[0].dtype == np.float64)
+
+        spec.coadd_arms_forest()
+        assert (spec.forestflux['brz'].dtype == np.float32)
+        npt.assert_allclose(spec.forestflux['brz'], 2.1, rtol=1e-6)
+
     def test_simple_coadd(self, setup_data):
         cat_by_survey, _, data = setup_data(1)
         spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
@@ -191,6 +265,238 @@ class TestSpectrum(object):
         npt.assert_almost_equal(spec.ivar['brz'][wbonly:wronly], 2)
 
 
+class TestSpectraBatch(object):
+    def get_spectra(self, setup_data, nspec=3):
+        cat_by_survey, _, data = setup_data(nspec)
+        cat_by_survey['Z'] = 2.5 + 0.1 * np.arange(nspec)
+        spectra_list = qsonic.spectrum.generate_spectra_list_from_data(
+            cat_by_survey, data)
+        for spec in spectra_list:
+            spec.set_forest_region(3600., 6000., 1050., 1180.)
+        return spectra_list
+
+    def test_init(self, setup_data):
+        spectra_list = self.get_spectra(setup_data)
+        spectra_list[1].drop_arm('B')
+        batch = qsonic.spectrum.SpectraBatch(spectra_list)
+
+        assert (batch.nspec == 3)
+        assert (batch.nseg == 5)
+        assert (batch.arms == ['B', 'R'])
+        npt.assert_equal(batch.spec_offsets, [0, 2, 3, 5])
+        npt.assert_equal(batch.spec_index, [0, 0, 1, 2, 2])
+        npt.assert_equal(batch.arm_index, [0, 1, 1, 0, 1])
+        npt.assert_equal(batch.cont, 0)
+
+        for k in range(batch.nseg):
+            spec = spectra_list[batch.spec_index[k]]
+            arm = batch.arms[batch.arm_index[k]]
+            sl = np.s_[batch.offsets[k]:batch.offsets[k + 1]]
+            npt.assert_equal(batch.wave[sl], spec.forestwave[arm])
+            npt.assert_equal(batch.flux[sl], spec.forestflux[arm])
+            npt.assert_almost_equal(
+                batch.get_wave_rf()[sl], spec.forestwave[arm] / (
+                    1 + spec.z_qso))
+
+        empty_batch = qsonic.spectrum.SpectraBatch([])
+        assert (empty_batch.size == 0)
+        assert (empty_batch.flux.size == 0)
+
+    def test_to_from_arrays(self, setup_data):
+        spectra_list = self.get_spectra(setup_data)
+        spectra_list[1].drop_arm('B')
+        for spec in spectra_list:
+            for arm, wave_arm in spec.forestwave.items():
+                spec._forestreso[arm] = np.ones((5, wave_arm.size))
+
+        arrays = qsonic.spectrum.SpectraBatch(spectra_list).to_arrays()
+        assert (arrays['reso'].shape == (5, arrays['wave'].size))
+        npt.assert_equal(arrays['catalog']['Z'], [2.5, 2.6, 2.7])
+
+        batch = qsonic.spectrum.SpectraBatch.from_arrays(arrays)
+        assert (batch.nspec == 3)
+        assert (batch.arms == ['B', 'R'])
+        npt.assert_equal(batch.spec_index, [0, 0, 1, 2, 2])
+        for spec, spec2 in zip(spectra_list, batch.spectra):
+            assert (spec2.targetid == spec.targetid)
+            assert (spec2.rsnr == spec.rsnr)
+            assert (spec2.forestivar_sm is spec2.forestivar)
+            assert (spec2.cont_params['x'][0] == spec.cont_params['x'][0])
+            for arm in spec.forestwave:
+                assert (spec2.mean_snr[arm] == spec.mean_snr[arm])
+                assert (spec2._f1[arm] == spec._f1[arm])
+                npt.assert_equal(spec2.forestwave[arm], spec.forestwave[arm])
+                npt.assert_equal(spec2.forestflux[arm], spec.forestflux[arm])
+                npt.assert_equal(spec2.forestivar[arm], spec.forestivar[arm])
+                npt.assert_equal(spec2.forestreso[arm], 1)
+                assert (spec2.forestflux[arm].base is batch.flux)
+
+        for spec in spectra_list:
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+            spec.set_smooth_forestivar(16.)
+        spectra_list[1].cont_params['valid'] = False
+        arrays = qsonic.spectrum.SpectraBatch(spectra_list).to_arrays(
+            with_continuum=True)
+        batch = qsonic.spectrum.SpectraBatch.from_arrays(arrays)
+        npt.assert_equal(batch.valid, [True, False, True])
+        for spec, spec2 in zip(spectra_list, batch.spectra):
+            assert (spec2._smoothing_scale == 16.)
+            for arm in spec.forestwave:
+                npt.assert_equal(spec2.cont_params['cont'][arm], 1.5)
+                npt.assert_equal(
+                    spec2.forestweight[arm], spec.forestweight[arm])
+
+        arrays = qsonic.spectrum.SpectraBatch([]).to_arrays()
+        assert ('catalog' not in arrays)
+        assert (qsonic.spectrum.SpectraBatch.from_arrays(arrays).nspec == 0)
+
+    def test_bind(self, setup_data):
+        spectra_list = self.get_spectra(setup_data)
+        batch = qsonic.spectrum.SpectraBatch(spectra_list)
+        batch.bind()
+
+        batch.mask(batch.wave < 3700.)
+        spec = spectra_list[0]
+        assert (spec.forestivar is spec.forestivar_sm)
+        assert (spec.forestivar is spec.forestweight)
+        for arm, wave_arm in spec.forestwave.items():
+            assert np.shares_memory(spec.forestflux[arm], batch.flux)
+            w = wave_arm < 3700.
+            npt.assert_equal(spec.forestivar[arm][w], 0)
+            npt.assert_equal(spec.forestflux[arm][w], 0)
+            npt.assert_equal(spec.forestivar[arm][~w], 1)
+
+        spec.forestflux['B'] *= 2
+        k = batch.spec_offsets[0]
+        npt.assert_equal(
+            batch.flux[batch.offsets[k]:batch.offsets[k + 1]],
+            spec.forestflux['B'])
+
+    def test_update_fit_results(self, setup_data):
+        spectra_list = self.get_spectra(setup_data)
+        batch = qsonic.spectrum.SpectraBatch(spectra_list)
+        batch.bind()
+
+        for spec in spectra_list:
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+        spectra_list[1].cont_params['valid'] = False
+        spectra_list[1].cont_params['cont'] = None
+        for spec in spectra_list:
+            spec.set_forest_weight(eta_interp=lambda w: 2 * np.ones_like(w))
+
+        batch.update_fit_results()
+        npt.assert_equal(batch.valid, [True, False, True])
+        i1, i2 = batch.offsets[batch.spec_offsets[1:3]]
+        npt.assert_equal(batch.weight[:i1], 0.5)
+        npt.assert_equal(batch.weight[i1:i2], 1)
+        npt.assert_equal(batch.cont[i1:i2], 0)
+        npt.assert_equal(batch.cont[:i1], 1.5)
+        for spec in qsonic.spectrum.valid_spectra(spectra_list):
+            for arm, warm in spec.forestweight.items():
+                assert np.shares_memory(warm, batch.weight)
+                assert np.shares_memory(
+                    spec.cont_params['cont'][arm], batch.cont)
+
+        selected = np.array([False, True, True])
+        w = batch.get_valid_pixels(selected)
+        npt.assert_equal(w, np.arange(batch.size) >= i2)
+        npt.assert_equal(
+            batch.get_offsets(w),
+            batch.offsets[batch.spec_offsets[2]:] - i2)
+
+        delta, ivar, weight = batch.get_deltas(w)
+        npt.assert_almost_equal(delta, batch.flux[w] / 1.5 - 1)
+        npt.assert_almost_equal(weight, 0.5 * 2.25)
+
+    def test_write(self, setup_data, tmp_path):
+        spectra_list = self.get_spectra(setup_data)
+        for spec in spectra_list:
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+            spec.forestivar['R'][:5] = 0
+        spectra_list[1].cont_params['valid'] = False
+
+        qsonic.spectrum.Spectrum._blinding = "none"
+        batch = qsonic.spectrum.SpectraBatch(spectra_list)
+        delta, ivar, weight = batch.get_deltas()
+        w = ivar > 0
+        npt.assert_almost_equal(delta[w], batch.flux[w] / 1.5 - 1)
+        npt.assert_almost_equal(weight[w], 2.25)
+        npt.assert_equal(delta[ivar == 0], 0)
+
+        fname1 = tmp_path / "batch.fits"
+        with fitsio.FITS(fname1, 'rw', clobber=True) as fts:
+            batch.write(fts)
+
+        fname2 = tmp_path / "single.fits"
+        with fitsio.FITS(fname2, 'rw', clobber=True) as fts:
+            for spec in qsonic.spectrum.valid_spectra(spectra_list):
+                spec.write(fts)
+
+        with fitsio.FITS(fname1) as fts1, fitsio.FITS(fname2) as fts2:
+            assert (len(fts1) == 5)
+            assert (len(fts1) == len(fts2))
+            for hdu1, hdu2 in zip(fts1[1:], fts2[1:]):
+                assert (hdu1.get_extname() == hdu2.get_extname())
+                assert (hdu1.read_header()['MEANSNR']
+                        == hdu2.read_header()['MEANSNR'])
+                for col in qsonic.spectrum.Spectrum._fits_colnames:
+                    npt.assert_allclose(hdu1[col].read(), hdu2[col].read())
+
+    def test_write_flat(self, setup_data, tmp_path):
+        spectra_list = self.get_spectra(setup_data)
+        for spec in spectra_list:
+            spec.cont_params['valid'] = True
+            spec.cont_params['cont'] = {
+                arm: 1.5 * np.ones_like(farm)
+                for arm, farm in spec.forestflux.items()
+            }
+        spectra_list[1].cont_params['valid'] = False
+
+        qsonic.spectrum.Spectrum._blinding = "none"
+        batch = qsonic.spectrum.SpectraBatch(spectra_list)
+
+        fname1 = tmp_path / "hdu.fits"
+        with fitsio.FITS(fname1, 'rw', clobber=True) as fts:
+            batch.write(fts)
+
+        fname2 = tmp_path / "flat.fits"
+        with fitsio.FITS(fname2, 'rw', clobber=True) as fts:
+            batch.write_flat(fts)
+
+        with fitsio.FITS(fname2) as fts:
+            assert (len(fts) == 3)
+            assert (fts['INDEX'].read_header()['BLINDING'] == "none")
+            assert (fts['INDEX'].get_nrows() == 4)
+
+        deltas1 = qsonic.io.read_deltas(fname1)
+        deltas2 = qsonic.io.read_deltas(fname2)
+        assert (len(deltas1) == len(deltas2))
+        for d1, d2 in zip(deltas1, deltas2):
+            assert (d1.targetid == d2.targetid)
+            assert (d1.header['MEANSNR']
+                    == pytest.approx(d2.header['MEANSNR']))
+            assert (d1.header['Z'] == d2.header['Z'])
+            assert (d1.header['DELTA_LAMBDA']
+                    == pytest.approx(d2.header['DELTA_LAMBDA']))
+            npt.assert_allclose(d1.wave, d2.wave)
+            npt.assert_allclose(d1.delta, d2.delta)
+            npt.assert_allclose(d1.ivar, d2.ivar)
+            npt.assert_allclose(d1.weight, d2.weight)
+            npt.assert_allclose(d1.cont, d2.cont)
+
+
 class TestDelta(object):
     def test_delta_init(self, setup_delta_data):
         fname = setup_delta_data
@@ -230,6 +536,27 @@ class TestDelta(object):
         npt.assert_almost_equal(delta2.delta, delta.delta)
         npt.assert_almost_equal(delta2.wave, wave)
 
+    def test_delta_storage_dtype(self, setup_delta_data, float32_storage):
+        with fitsio.FITS(setup_delta_data) as fts:
+            delta = qsonic.spectrum.Delta(fts[1])
+            delta2 = qsonic.spectrum.Delta(fts[1])
+
+        assert (delta.wave.dtype == np.float64)
+        for arr in [delta.delta, delta.ivar, delta.weight, delta.reso]:
+            assert (arr.dtype == np.float32)
+
+        delta.coadd(delta2)
+        for arr in [delta.delta, delta.ivar, delta.weight, delta.reso]:
+            assert (arr.dtype == np.float32)
+        npt.assert_almost_equal(delta.ivar, 2)
+
+
+@pytest.fixture
+def float32_storage():
+    qsonic.spectrum.Spectrum.set_storage_dtype("float32")
+    yield
+    qsonic.spectrum.Spectrum.set_storage_dtype("float64")
+
 
 @pytest.fixture
 def setup_delta_data(tmp_path):